@@ -0,0 +1,372 @@
+"""
+description: Inference backends evaluating network batches for MCTS.
+secondary author: Tim Straube
+licence: MIT
+"""
+
+import io
+import threading
+import warnings
+import weakref
+import numpy
+import torch
+import torch.nn as nn
+from agents.alphazero.fusednetwork import FusedNetwork
+from agents.alphazero.fusednetwork import build_inference_model
+from agents.alphazero.fusednetwork import input_shape
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+# args entries that configure a backend, see backend_args
+BACKEND_KEYS = (
+    'backend',
+    'backend_path',
+    'inference_mode',
+    'backend_threads',
+    'backend_inter_threads',
+    'graph_optimization',
+    'io_binding',
+    'leaf_batch',
+    'parallel_games',
+)
+
+class InferenceBackend:
+    """Evaluates batches of encoded states for MCTS
+
+    `evaluate(batch)` takes a numpy batch of encoded states and returns
+    the policy logits (K, actions) and values (K,) as numpy arrays.
+    """
+    name = None
+
+    def evaluate(self, batch):
+        raise NotImplementedError
+
+    def __call__(self, batch):
+        return self.evaluate(batch)
+
+    def close(self):
+        pass
+
+
+class TorchBackend(InferenceBackend):
+    """The model itself in eager mode
+    """
+    name = "torch"
+
+    def __init__(self, model):
+        self.model = model
+        self.device = model.device
+
+    def network(self):
+        return self.model
+
+    @torch.no_grad()
+    def evaluate(self, batch):
+        policy, value = self.network()(
+            torch.as_tensor(batch, device = self.device)
+        )
+        return policy.cpu().numpy(), value.cpu().numpy().reshape(-1)
+
+
+# builds per model, see cached_build
+_builds = weakref.WeakKeyDictionary()
+_builds_lock = threading.Lock()
+
+def weights_version(model):
+    """Changes whenever a parameter or buffer of `model` is written to
+
+    Optimizer steps, load_state_dict and the running statistics of batch
+    norms in train mode all bump the tensors' version counters.
+    """
+    return sum(tensor._version for tensor in model.parameters()) + sum(
+        tensor._version for tensor in model.buffers()
+    )
+
+def cached_build(model, key, build):
+    """`build(model)`, redone only when the weights of `model` changed
+
+    Builds are shared by every backend of the same model and `key`,
+    e.g. the trees of a `RootParallelMCTS` in threads mode.
+    """
+    version = weights_version(model)
+    with _builds_lock:
+        builds = _builds.setdefault(model, {})
+        entry = builds.get(key)
+        if entry is None or entry[0] != version:
+            entry = (version, build(model))
+            builds[key] = entry
+        return entry[1]
+
+
+class FusedBackend(TorchBackend):
+    """Batch norm folded, compiled copy of the model, see fusednetwork.py
+    """
+    name = "fused"
+
+    def __init__(self, model, mode="script"):
+        super().__init__(model)
+        self.mode = mode
+
+    def network(self):
+        return cached_build(
+            self.model,
+            (self.name, self.mode),
+            lambda model: build_inference_model(model, self.mode)
+        )
+
+
+def quantize(model):
+    """Folded copy of `model` on the CPU with int8 dynamic Linear layers
+
+    Dynamic quantization only covers the Linear heads, the folded
+    convolutions stay float32.
+    """
+    fused = FusedNetwork(model).to(torch.device("cpu")).eval()
+    with warnings.catch_warnings():
+        # torch.ao quantization is deprecated in favour of torchao
+        warnings.simplefilter("ignore", DeprecationWarning)
+        warnings.simplefilter("ignore", UserWarning)
+        return torch.ao.quantization.quantize_dynamic(
+            fused,
+            {nn.Linear},
+            dtype=torch.qint8
+        )
+
+class QuantizedBackend(TorchBackend):
+    """Dynamic int8 quantized copy of the model, runs on the CPU
+
+    With `path` it serves the static INT8 TorchScript file written by
+    util/quantization.py instead.
+    """
+    name = "quantized"
+
+    def __init__(self, model=None, path=None):
+        if model is None and path is None:
+            raise ValueError("The quantized backend needs a model or a TorchScript file")
+        self.model = model
+        self.device = torch.device("cpu")
+        self.path = path
+        self.module = None
+        if path is not None:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", FutureWarning)
+                self.module = torch.jit.load(path, map_location="cpu")
+
+    def network(self):
+        if self.module is not None:
+            return self.module
+        return cached_build(self.model, (self.name,), quantize)
+
+
+def export_onnx(model):
+    """Serialized ONNX graph of the folded model with a dynamic batch axis
+    """
+    fused = FusedNetwork(model).to(torch.device("cpu")).eval()
+    example = torch.zeros(1, *input_shape(model))
+    options = dict(
+        input_names=['input'],
+        output_names=['policy', 'value'],
+        dynamic_axes={
+            'input': {0: 'batch_size'},
+            'policy': {0: 'batch_size'},
+            'value': {0: 'batch_size'}
+        }
+    )
+    buffer = io.BytesIO()
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)
+        try:
+            # the TorchScript exporter, the dynamo one needs onnxscript
+            torch.onnx.export(fused, example, buffer, dynamo=False, **options)
+        except TypeError:
+            torch.onnx.export(fused, example, buffer, **options)
+    return buffer.getvalue()
+
+# graph optimization levels of onnxruntime by name
+GRAPH_OPTIMIZATIONS = ('disable', 'basic', 'extended', 'all')
+
+class OnnxBackend(InferenceBackend):
+    """ONNX Runtime session of the model, or of the ONNX file at `path`
+
+    Without `path` the model is exported on first use and again after
+    its weights changed. `threads` and `inter_threads` size the
+    session's thread pools (0 lets onnxruntime decide), with more than
+    one inter-op thread the graph runs in parallel execution mode.
+    `optimization` is the graph optimization level.
+
+    With `io_binding` the session reads its input from and writes its
+    outputs into numpy buffers of this backend, preallocated for
+    `capacity` states (the largest leaf batch) and grown when a larger
+    batch comes. A batch is then copied once, into the input buffer,
+    and the returned logits and values are views into the output
+    buffers that stay valid until the next call.
+    """
+    name = "onnx"
+
+    def __init__(
+        self,
+        model=None,
+        path=None,
+        threads=None,
+        inter_threads=None,
+        optimization="all",
+        capacity=1,
+        io_binding=True):
+
+        if onnxruntime is None:
+            raise ImportError("The onnx backend needs the onnxruntime package, install the inference extra: pip install .[inference]")
+        if model is None and path is None:
+            raise ValueError("The onnx backend needs a model or an ONNX file")
+        if optimization not in GRAPH_OPTIMIZATIONS:
+            raise ValueError(f"Unknown graph optimization {optimization!r}, use one of {GRAPH_OPTIMIZATIONS}")
+        self.model = model
+        self.path = path
+        self.threads = threads
+        self.inter_threads = inter_threads
+        self.optimization = optimization
+        self.capacity = max(1, int(capacity))
+        self.io_binding = io_binding
+        # per backend, sessions are shared but a binding is not
+        self.bound_session = None
+        self.binding = None
+        self.session = None if path is None else self.open(path)
+
+    def open(self, graph):
+        options = onnxruntime.SessionOptions()
+        if self.threads:
+            options.intra_op_num_threads = int(self.threads)
+        if self.inter_threads:
+            options.inter_op_num_threads = int(self.inter_threads)
+        # independent nodes only run concurrently with an inter-op pool
+        options.execution_mode = (
+            onnxruntime.ExecutionMode.ORT_PARALLEL
+            if self.inter_threads and int(self.inter_threads) > 1 else
+            onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        )
+        options.graph_optimization_level = {
+            'disable': onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL,
+            'basic': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+            'extended': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+            'all': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL,
+        }[self.optimization]
+        return onnxruntime.InferenceSession(
+            graph,
+            options,
+            providers=['CPUExecutionProvider']
+        )
+
+    def network(self):
+        if self.session is not None:
+            return self.session
+        return cached_build(
+            self.model,
+            (self.name, self.threads, self.inter_threads, self.optimization),
+            lambda model: self.open(export_onnx(model))
+        )
+
+    def bind(self, session, count):
+        """(Re)allocates the buffers for `session` and at least `count` states
+        """
+        inputs = session.get_inputs()[0]
+        policy, value = session.get_outputs()[:2]
+        if not all(isinstance(dim, int) for dim in inputs.shape[1:] + policy.shape[1:]):
+            # symbolic shapes, the buffers can not be sized up front
+            self.io_binding = False
+            return
+        capacity = max(count, self.capacity)
+        self.capacity = capacity
+        self.names = (inputs.name, policy.name, value.name)
+        self.inputs = numpy.zeros((capacity, *inputs.shape[1:]), dtype=numpy.float32)
+        self.policy = numpy.zeros((capacity, policy.shape[1]), dtype=numpy.float32)
+        self.value = numpy.zeros((capacity, 1), dtype=numpy.float32)
+        self.binding = session.io_binding()
+        self.bound_session = session
+        self.bound_count = 0
+
+    def evaluate(self, batch):
+        session = self.network()
+        count = len(batch)
+        if self.io_binding and (
+                session is not self.bound_session or count > self.capacity):
+            # grown geometrically, lockstep batch sizes vary per round
+            self.bind(session, count if count <= self.capacity else max(count, 2 * self.capacity))
+        if not self.io_binding:
+            policy, value = session.run(None, {
+                session.get_inputs()[0].name: numpy.asarray(batch, dtype=numpy.float32)
+            })
+            return policy, value.reshape(-1)
+        self.inputs[:count] = batch
+        if count != self.bound_count:
+            self.rebind(count)
+        session.run_with_iobinding(self.binding)
+        return self.policy[:count], self.value[:count, 0]
+
+    def rebind(self, count):
+        """Points the binding at the first `count` rows of the buffers
+        """
+        input_name, policy_name, value_name = self.names
+        binding = self.binding
+        binding.bind_input(
+            input_name,
+            'cpu',
+            0,
+            numpy.float32,
+            (count, *self.inputs.shape[1:]),
+            self.inputs.ctypes.data
+        )
+        binding.bind_output(
+            policy_name,
+            'cpu',
+            0,
+            numpy.float32,
+            (count, self.policy.shape[1]),
+            self.policy.ctypes.data
+        )
+        binding.bind_output(
+            value_name,
+            'cpu',
+            0,
+            numpy.float32,
+            (count, 1),
+            self.value.ctypes.data
+        )
+        self.bound_count = count
+
+
+BACKENDS = {
+    'torch': TorchBackend,
+    'fused': FusedBackend,
+    'quantized': QuantizedBackend,
+    'onnx': OnnxBackend,
+}
+
+def backend_args(args):
+    """The entries of `args` that configure the backend
+    """
+    return {key: args[key] for key in BACKEND_KEYS if key in args}
+
+def make_backend(args, model):
+    """Backend of `model` selected by args['backend'], torch by default
+    """
+    name = args.get('backend', 'torch') or 'torch'
+    if name == 'torch':
+        return TorchBackend(model)
+    if name == 'fused':
+        return FusedBackend(model, args.get('inference_mode', 'script'))
+    if name == 'quantized':
+        return QuantizedBackend(model, args.get('backend_path', None))
+    if name == 'onnx':
+        return OnnxBackend(
+            model,
+            args.get('backend_path', None),
+            args.get('backend_threads', None),
+            args.get('backend_inter_threads', None),
+            args.get('graph_optimization', 'all'),
+            # the largest batch of a lockstep round
+            args.get('leaf_batch', 1) * args.get('parallel_games', 1),
+            args.get('io_binding', True)
+        )
+    raise ValueError(f"Unknown inference backend {name!r}, use one of {sorted(BACKENDS)}")
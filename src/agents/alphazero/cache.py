@@ -0,0 +1,166 @@
+"""
+description: LRU cache of network evaluations for Monte Carlo Tree Search.
+secondary author: Tim Straube
+licence: MIT
+"""
+
+import hashlib
+import numpy
+from collections import OrderedDict
+
+# dict entry, key and array headers of one cached evaluation, roughly
+ENTRY_OVERHEAD = 200
+
+class EvaluationCache:
+    """Bounded cache of (policy logits, value) keyed by the encoded state
+
+    The key is a 128 bit BLAKE2 digest of the encoded planes. Entries
+    are evicted least recently used first once there are more than
+    `max_entries` of them or they take more than `max_bytes`. Cached
+    outputs belong to one set of weights, `invalidate` drops them all;
+    `watch(optimizer)` does so after every optimizer step and
+    `sync(version)` when a `SharedWeights` version changes.
+    """
+    def __init__(self, max_entries=100_000, max_bytes=None):
+        self.max_entries = max(1, int(max_entries))
+        self.max_bytes = None if max_bytes is None else int(max_bytes)
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.version = None
+        self.hook = None
+
+    @classmethod
+    def from_args(cls, args):
+        """Cache configured by args['eval_cache'] / ['eval_cache_mb'], or None
+        """
+        entries = int(args.get('eval_cache', 0) or 0)
+        if entries <= 0:
+            return None
+        megabytes = args.get('eval_cache_mb', None)
+        return cls(
+            entries,
+            None if not megabytes else int(float(megabytes) * 2**20)
+        )
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def key(encoded_state):
+        return hashlib.blake2b(
+            numpy.ascontiguousarray(encoded_state).tobytes(),
+            digest_size=16
+        ).digest()
+
+    def evaluate(self, batch, forward):
+        """`forward(batch)` output for the batch, cached rows not recomputed
+
+        A state that occurs several times in the batch is evaluated
+        once, its other rows count as hits.
+        """
+        keys = [self.key(encoded_state) for encoded_state in batch]
+        found = [None] * len(batch)
+        # first row of every key missing from the cache
+        first = {}
+        for row, key in enumerate(keys):
+            if key in first:
+                self.hits += 1
+            else:
+                found[row] = self.get(key)
+                if found[row] is None:
+                    first[key] = row
+        missing = list(first.values())
+        if missing:
+            if len(missing) == len(batch):
+                logits, values = forward(batch)
+            else:
+                logits, values = forward(batch[missing])
+            for row, policy, value in zip(missing, logits, values):
+                # copies, the output may be a view into a reused buffer
+                found[row] = self.put(keys[row], policy.copy(), float(value))
+            for row, key in enumerate(keys):
+                if found[row] is None:
+                    found[row] = found[first[key]]
+        return (
+            numpy.stack([logits for logits, _ in found]),
+            numpy.array([value for _, value in found], dtype=numpy.float32)
+        )
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key, logits, value):
+        entry = (logits, value)
+        previous = self.entries.pop(key, None)
+        if previous is not None:
+            self.bytes -= previous[0].nbytes + ENTRY_OVERHEAD
+        self.entries[key] = entry
+        self.bytes += logits.nbytes + ENTRY_OVERHEAD
+        while len(self.entries) > self.max_entries or (
+                self.max_bytes is not None and
+                self.bytes > self.max_bytes and
+                len(self.entries) > 1):
+            _, (old_logits, _) = self.entries.popitem(last=False)
+            self.bytes -= old_logits.nbytes + ENTRY_OVERHEAD
+            self.evictions += 1
+        return entry
+
+    def invalidate(self, *_):
+        """Drops every entry, the weights they were computed with changed
+        """
+        if self.entries:
+            self.entries.clear()
+            self.bytes = 0
+            self.invalidations += 1
+
+    def watch(self, optimizer):
+        """Invalidate after every step of `optimizer`
+        """
+        if self.hook is not None:
+            self.hook.remove()
+        self.hook = optimizer.register_step_post_hook(self.invalidate)
+        return self.hook
+
+    def sync(self, version):
+        """Invalidate when the weights `version` differs from the last one
+        """
+        if version != self.version:
+            self.invalidate()
+            self.version = version
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'bytes': self.bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+        }
+
+
+def combine_stats(stats):
+    """`EvaluationCache.stats` of several caches added up, None for none
+    """
+    stats = [entry for entry in stats if entry is not None]
+    if not stats:
+        return None
+    total = {
+        key: sum(entry[key] for entry in stats)
+        for key in ('entries', 'bytes', 'hits', 'misses', 'evictions', 'invalidations')
+    }
+    lookups = total['hits'] + total['misses']
+    total['hit_rate'] = total['hits'] / lookups if lookups else 0.0
+    return total
@@ -0,0 +1,149 @@
+"""
+description: Inference build of the residual network with folded batch norms.
+secondary author: Tim Straube
+licence: MIT
+"""
+
+import copy
+import warnings
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+def fold(conv, bn):
+    """Conv2d with the eval mode BatchNorm2d behind it folded into its weights
+    """
+    return fuse_conv_bn_eval(copy.deepcopy(conv).eval(), copy.deepcopy(bn).eval())
+
+class FusedResidualBlock(nn.Module):
+    """`ResidualBlock` with both batch norms folded into the convolutions
+    """
+    def __init__(self, block):
+        super().__init__()
+        self.conv1 = fold(block.conv1, block.bn1)
+        self.conv2 = fold(block.conv2, block.bn2)
+
+    def forward(self, x):
+        residual = x
+        x = F.relu(self.conv1(x), inplace=True)
+        x = self.conv2(x)
+        x += residual
+        return F.relu(x, inplace=True)
+
+class FusedNetwork(nn.Module):
+    """Inference only copy of a `ResidualNetwork`
+
+    Every Conv2d + BatchNorm2d pair becomes one Conv2d and the ReLUs
+    run in place. Scripting and freezing it (`build_inference_model`)
+    additionally lets TorchScript fuse the ReLUs into the convolutions.
+    """
+    def __init__(self, model):
+        super().__init__()
+        self.start = fold(model.startBlock[0], model.startBlock[1])
+        self.backBone = nn.ModuleList([
+            FusedResidualBlock(block) for block in model.backBone
+        ])
+        self.policyConv = fold(model.policyHead[0], model.policyHead[1])
+        self.policyLinear = copy.deepcopy(model.policyHead[4])
+        self.valueConv = fold(model.valueHead[0], model.valueHead[1])
+        self.valueLinear = copy.deepcopy(model.valueHead[4])
+
+    def forward(self, x):
+        x = F.relu(self.start(x.to(torch.float32)), inplace=True)
+        for block in self.backBone:
+            x = block(x)
+        policy = self.policyLinear(torch.flatten(
+            F.relu(self.policyConv(x), inplace=True), 1
+        ))
+        value = torch.tanh(self.valueLinear(torch.flatten(
+            F.relu(self.valueConv(x), inplace=True), 1
+        )))
+        return policy, value
+
+class InferenceModel:
+    """Callable compiled network with the `device` attribute MCTS expects
+    """
+    def __init__(self, module, device, mode):
+        self.module = module
+        self.device = device
+        self.mode = mode
+
+    def __call__(self, x):
+        return self.module(x)
+
+    def eval(self):
+        return self
+
+def input_shape(model):
+    """(planes, rows, columns) of one network input
+    """
+    # square board, the policy head flattens 6 planes of it
+    size = int(round((model.policyHead[4].in_features // 6) ** 0.5))
+    return model.startBlock[0].in_channels, size, size
+
+@torch.no_grad()
+def verify_equivalence(model, inference_model, batch_size=32, atol=1e-4, rtol=1e-4):
+    """Compares the inference build with the eager model on random planes
+
+    Raises RuntimeError when policy logits or values differ by more than
+    `atol` plus `rtol` times the largest eager output, otherwise returns
+    the largest differences.
+    """
+    x = torch.randint(
+        0,
+        2,
+        (batch_size, *input_shape(model)),
+        device=model.device
+    ).to(torch.float32)
+    training = model.training
+    model.eval()
+    policy, value = model(x)
+    model.train(training)
+    fused_policy, fused_value = inference_model(x)
+    errors = {
+        'policy': float((policy - fused_policy).abs().max()),
+        'value': float((value - fused_value).abs().max()),
+    }
+    if (errors['policy'] > atol + rtol * float(policy.abs().max()) or
+            errors['value'] > atol + rtol * float(value.abs().max())):
+        raise RuntimeError(f"Inference build differs from the eager model: {errors}")
+    return errors
+
+@torch.no_grad()
+def build_inference_model(model, mode="script", check=True):
+    """Folded, compiled inference copy of a `ResidualNetwork`
+
+    mode "script" scripts, freezes and optimizes the folded network with
+    TorchScript, "compile" uses torch.compile and "eager" keeps the
+    folded module as it is. A mode that is not available on the box
+    falls back to the next simpler one. With `check` the result is
+    compared against `model` by `verify_equivalence`.
+    """
+    fused = FusedNetwork(model).eval()
+    module = fused
+    if mode == "compile":
+        try:
+            module = torch.compile(fused)
+            # compilation happens on the first call
+            verify_equivalence(model, module)
+        except Exception:
+            mode = "script"
+            module = fused
+    if mode == "script":
+        try:
+            with warnings.catch_warnings():
+                # TorchScript is deprecated but still the fastest on CPU here
+                warnings.simplefilter("ignore", FutureWarning)
+                module = torch.jit.freeze(torch.jit.script(fused))
+                try:
+                    module = torch.jit.optimize_for_inference(module)
+                except Exception:
+                    pass
+        except Exception:
+            mode = "eager"
+            module = fused
+    inference_model = InferenceModel(module, model.device, mode)
+    if check:
+        verify_equivalence(model, inference_model)
+    return inference_model
@@ -0,0 +1,308 @@
+"""
+description: Inference server batching network requests of self-play processes.
+secondary author: Tim Straube
+licence: MIT
+"""
+
+import multiprocessing
+import queue
+import time
+import numpy
+import torch
+from multiprocessing import shared_memory
+from agents.alphazero.backends import InferenceBackend
+from agents.alphazero.backends import make_backend
+from agents.alphazero.residualnetwork import ResidualNetwork
+
+# batch size histogram buckets: bucket b counts batches of 2**(b-1) < size <= 2**b
+HISTOGRAM_BUCKETS = 24
+# how often a waiting client checks that the server is still running
+POLL_SECONDS = 1.0
+
+class InferenceBuffers:
+    """Request and response slots of all clients in one shared memory block
+
+    Client c writes up to `capacity` encoded states into `requests[c]`,
+    the server answers in `responses[c]` with the policy logits in the
+    first `actions` columns and the value in the last. The server's
+    statistics live in the same block so the owner can read them.
+    """
+    def __init__(
+        self,
+        clients,
+        capacity,
+        state_shape,
+        state_dtype,
+        actions,
+        name=None):
+
+        self.config = (clients, capacity, tuple(state_shape), numpy.dtype(state_dtype).str, actions)
+        state_dtype = numpy.dtype(state_dtype)
+        shapes = [
+            ("requests", (clients, capacity) + tuple(state_shape), state_dtype),
+            ("responses", (clients, capacity, actions + 1), numpy.dtype(numpy.float32)),
+            ("batch_histogram", (HISTOGRAM_BUCKETS,), numpy.dtype(numpy.int64)),
+            ("queue_depth", (clients + 1,), numpy.dtype(numpy.int64)),
+            ("totals", (3,), numpy.dtype(numpy.int64)),
+        ]
+        offset = 0
+        layout = []
+        for key, shape, dtype in shapes:
+            layout.append((key, shape, dtype, offset))
+            nbytes = int(numpy.prod(shape)) * dtype.itemsize
+            offset += -(-nbytes // 8) * 8
+        if name is None:
+            self.memory = shared_memory.SharedMemory(create=True, size=offset)
+            self.owner = True
+        else:
+            try:
+                self.memory = shared_memory.SharedMemory(name=name, track=False)
+            except TypeError:
+                self.memory = shared_memory.SharedMemory(name=name)
+            self.owner = False
+        self.name = self.memory.name
+        for key, shape, dtype, offset in layout:
+            setattr(self, key, numpy.ndarray(shape, dtype, self.memory.buf, offset))
+        if self.owner:
+            self.batch_histogram[:] = 0
+            self.queue_depth[:] = 0
+            self.totals[:] = 0
+
+    def attach(self):
+        return self.config + (self.name,)
+
+    def close(self):
+        # drop the views before the buffer goes away
+        for key in ("requests", "responses", "batch_histogram", "queue_depth", "totals"):
+            setattr(self, key, None)
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+
+def _serve(stopped, *args):
+    """Server process, sets `stopped` however `_serve_requests` ends
+    """
+    try:
+        _serve_requests(*args)
+    finally:
+        stopped.set()
+
+def _serve_requests(
+    game_config,
+    model_config,
+    weights,
+    buffers,
+    requests,
+    ready,
+    max_batch,
+    max_wait,
+    threads,
+    backend):
+    """Main loop of the server process
+
+    Waits for the first request, then keeps adding requests until
+    `max_batch` states are queued or `max_wait` seconds have passed,
+    and answers all of them with one forward pass.
+    """
+    # imported here so workers.py can import this module
+    from agents.alphazero.workers import SharedWeights
+    game_class, size, ship_sizes, encoded_dtype = game_config
+    torch.set_num_threads(max(1, int(threads)))
+    game = game_class(
+        size,
+        ship_sizes=ship_sizes,
+        encoded_dtype=encoded_dtype
+    )
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model = ResidualNetwork(game, *model_config, device)
+    model.eval()
+    network = make_backend(backend, model)
+    weights = SharedWeights(*weights)
+    version = -1
+    buffers = InferenceBuffers(*buffers)
+    while True:
+        first = requests.get()
+        if first is None:
+            break
+        pending = [first]
+        states = first[1]
+        deadline = time.perf_counter() + max_wait
+        stop = False
+        while states < max_batch:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                request = requests.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if request is None:
+                stop = True
+                break
+            pending.append(request)
+            states += request[1]
+        try:
+            waiting = requests.qsize()
+        except NotImplementedError:
+            waiting = 0
+        if weights.version != version:
+            version = weights.load_into(model)
+        batch = numpy.concatenate([
+            buffers.requests[client, :count]
+            for client, count in pending
+        ])
+        policy, value = network.evaluate(batch)
+        output = numpy.concatenate((
+            policy,
+            value.reshape(-1, 1)
+        ), axis=1)
+        start = 0
+        for client, count in pending:
+            buffers.responses[client, :count] = output[start:start + count]
+            start += count
+            ready[client].release()
+        buffers.batch_histogram[min(
+            int(states - 1).bit_length(),
+            HISTOGRAM_BUCKETS - 1
+        )] += 1
+        buffers.queue_depth[min(
+            len(pending) + waiting,
+            len(buffers.queue_depth) - 1
+        )] += 1
+        buffers.totals += (1, len(pending), states)
+        if stop:
+            break
+    buffers.close()
+    weights.close()
+
+
+class InferenceClient(InferenceBackend):
+    """Inference backend of one actor process, served by the server
+
+    `evaluate(batch)` has the signature of `MCTS.evaluate`. The
+    returned logits and values are views into the client's response
+    slot and stay valid until its next call. It raises RuntimeError
+    instead of waiting forever once the server process has stopped.
+    """
+    def __init__(self, client, buffers, requests, ready, stopped):
+        self.client = client
+        self.buffers = InferenceBuffers(*buffers)
+        self.capacity = self.buffers.requests.shape[1]
+        self.requests = requests
+        self.ready = ready[client]
+        self.stopped = stopped
+
+    def evaluate(self, batch):
+        count = len(batch)
+        if count > self.capacity:
+            policies = []
+            values = []
+            for start in range(0, count, self.capacity):
+                policy, value = self.evaluate(batch[start:start + self.capacity])
+                # copies, the slot is reused for every chunk
+                policies.append(policy.copy())
+                values.append(value.copy())
+            return numpy.concatenate(policies), numpy.concatenate(values)
+        self.buffers.requests[self.client, :count] = batch
+        self.requests.put((self.client, count))
+        self.wait()
+        output = self.buffers.responses[self.client, :count]
+        return output[:, :-1], output[:, -1]
+
+    def wait(self):
+        """Blocks until the server answered the pending request
+        """
+        while not self.ready.acquire(timeout=POLL_SECONDS):
+            # an answer may have come just before the server stopped
+            if self.stopped.is_set() and not self.ready.acquire(block=False):
+                raise RuntimeError(f"The inference server stopped, client {self.client} gets no answer")
+
+
+class InferenceServer:
+    """Process owning the model and serving `clients` actor processes
+
+    Actors write their encoded states into shared memory request slots
+    and put `(client, count)` on a queue; the server merges queued
+    requests into dynamic batches of up to `max_batch` states, waiting
+    at most `max_wait` seconds for a batch to fill. Weights come from a
+    `SharedWeights` block and the batches run on the backend selected
+    by the args entries in `backend` (see `backends.backend_args`).
+    `stats` reports the batch size and queue depth histograms.
+    """
+    def __init__(
+        self,
+        game,
+        model_config,
+        weights,
+        clients,
+        capacity,
+        max_batch=256,
+        max_wait=0.002,
+        threads=None,
+        backend=None,
+        context=None):
+
+        context = context or multiprocessing.get_context("spawn")
+        self.buffers = InferenceBuffers(
+            clients,
+            capacity,
+            (model_config[2], game.rows, game.columns),
+            game.encoded_dtype,
+            game.actions
+        )
+        self.requests = context.Queue()
+        self.ready = [context.Semaphore(0) for _ in range(clients)]
+        # set by the server process when it ends, normally or not
+        self.stopped = context.Event()
+        if threads is None:
+            threads = torch.get_num_threads()
+        self.process = context.Process(
+            target=_serve,
+            args=(
+                self.stopped,
+                (type(game), game.size, game.ship_sizes, game.encoded_dtype),
+                tuple(model_config),
+                weights.attach(),
+                self.buffers.attach(),
+                self.requests,
+                self.ready,
+                int(max_batch),
+                float(max_wait),
+                threads,
+                dict(backend or {})
+            ),
+            daemon=True
+        )
+        self.process.start()
+
+    def client_args(self):
+        """Arguments of `InferenceClient` apart from the client id
+        """
+        return self.buffers.attach(), self.requests, self.ready, self.stopped
+
+    def stats(self):
+        batches, requests, states = (int(total) for total in self.buffers.totals)
+        return {
+            'batches': batches,
+            'requests': requests,
+            'states': states,
+            'mean_batch': states / batches if batches else 0.0,
+            'batch_histogram': {
+                2 ** bucket: int(count)
+                for bucket, count in enumerate(self.buffers.batch_histogram)
+                if count
+            },
+            'queue_depth': {
+                depth: int(count)
+                for depth, count in enumerate(self.buffers.queue_depth)
+                if count
+            },
+        }
+
+    def close(self):
+        self.requests.put(None)
+        self.process.join(timeout=10)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.buffers.close()
@@ -10,12 +10,17 @@ import os
 import sqlite3
 import torch
 import torch.nn.functional as functional
-import concurrent.futures
 from tqdm import trange
 from torch.utils.tensorboard import SummaryWriter
+from agents.alphazero.backends import BACKENDS, GRAPH_OPTIMIZATIONS
 from agents.alphazero.mcts import MCTS
+from agents.alphazero.rootparallel import RootParallelMCTS
+from agents.alphazero.selfplay import LockstepSelfPlay, self_play_steps
+from agents.alphazero.tuning import apply_profile, load_profile, network_config, resolve_profile
+from agents.alphazero.workers import SelfPlayPool
 from agents.alphazero.residualnetwork import ResidualNetwork
 from envs.battleship import Battleship
+from envs.bitboard import BitboardBattleship
 import argparse
 
 class AlphaZero:
@@ -36,13 +41,48 @@ class AlphaZero:
         dirichlet_alpha: float = 0.3,
         logdir: str | None = None,
         save: str | None = None,
+        engine: str = "array",
+        planes: str = "float32",
+        reuse_tree: bool = False,
+        leaf_batch: int = 1,
+        parallel_games: int | None = None,
+        workers: int = 0,
+        seed: int | None = None,
+        inference_server: bool = False,
+        server_max_batch: int | None = None,
+        server_max_wait_ms: float = 2.0,
+        eval_cache: int = 0,
+        eval_cache_mb: float | None = None,
+        transpositions: bool = False,
+        tt_size: int = 100000,
+        search_time_ms: float | None = None,
+        root_search: str = "puct",
+        gumbel_actions: int = 16,
+        expand_top_k: int = 0,
+        expand_prior_mass: float = 1.0,
+        widening: float = 0.0,
+        widening_alpha: float = 0.5,
+        backend: str | None = None,
+        backend_path: str | None = None,
+        inference_mode: str | None = None,
+        backend_threads: int | None = None,
+        graph_optimization: str | None = None,
+        no_io_binding: bool = False,
+        profile: str | None = None,
+        root_parallel: int = 0,
+        root_parallel_mode: str = "threads",
     ):
         print("\nSetup of AlphaZero for training battleship\n")
         model_id = model_id or "alphazero"
         size = int(size or 5)
         if size < 3:
             size = 3
-        self.game = Battleship(size)
+        # uint8 planes are cast to float32 inside ResidualNetwork
+        encoded_dtype = numpy.uint8 if planes == "uint8" else numpy.float32
+        if engine == "bitboard":
+            self.game = BitboardBattleship(size, encoded_dtype=encoded_dtype)
+        else:
+            self.game = Battleship(size, encoded_dtype=encoded_dtype)
         device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         resblocks = int(resblocks or 6)
         hiddenlayers = int(hiddenlayers or 6)
@@ -68,6 +108,7 @@ class AlphaZero:
         self.args = {
             'C': 2,
             'num_searches': searches,
+            'leaf_batch': max(1, int(leaf_batch or 1)),
             'num_iterations': int(num_iterations),
             'num_selfPlay_iterations': int(selfplayiterations),
             'num_epochs': int(num_epochs),
@@ -75,7 +116,60 @@ class AlphaZero:
             'temperature': float(temperature),
             'dirichlet_epsilon': float(dirichlet_epsilon),
             'dirichlet_alpha': float(dirichlet_alpha),
+            'reuse_tree': bool(reuse_tree),
+            'parallel_games': max(1, int(parallel_games or 1)),
+            'workers': max(0, int(workers or 0)),
+            'inference_server': bool(inference_server),
+            'server_max_batch': max(1, int(server_max_batch or 256)),
+            'server_max_wait_ms': float(server_max_wait_ms),
+            'eval_cache': max(0, int(eval_cache or 0)),
+            'eval_cache_mb': eval_cache_mb,
+            'transpositions': bool(transpositions),
+            'tt_size': max(1, int(tt_size or 100000)),
+            'search_time_ms': float(search_time_ms) if search_time_ms else None,
+            'root_search': root_search if root_search in ("puct", "gumbel") else "puct",
+            'gumbel_actions': max(1, int(gumbel_actions or 16)),
+            'gumbel_c_visit': 50,
+            'gumbel_c_scale': 1.0,
+            'expand_top_k': max(0, int(expand_top_k or 0)),
+            'expand_prior_mass': float(expand_prior_mass or 1.0),
+            'widening': max(0.0, float(widening or 0.0)),
+            'widening_alpha': float(widening_alpha),
+            'backend': backend if backend in BACKENDS else "torch",
+            'backend_path': backend_path,
+            'inference_mode': inference_mode if inference_mode in ("script", "compile", "eager") else "script",
+            'backend_threads': max(0, int(backend_threads or 0)),
+            'graph_optimization': graph_optimization if graph_optimization in GRAPH_OPTIMIZATIONS else "all",
+            'io_binding': not no_io_binding,
+            'root_parallel': max(0, int(root_parallel or 0)),
+            'root_parallel_mode': root_parallel_mode if root_parallel_mode in ("threads", "processes") else "threads",
+        }
+        if self.args['root_search'] == 'gumbel' and self.args['search_time_ms']:
+            print("The gumbel root search splits --searches up front, --search-time-ms does not apply to it")
+        # tuned threads, backend and batch size of this machine, for
+        # the options that were left unset (None)
+        explicit = {
+            key for key, value in (
+                ('parallel_games', parallel_games),
+                ('server_max_batch', server_max_batch),
+                ('backend', backend),
+                ('inference_mode', inference_mode),
+                ('backend_threads', backend_threads),
+                ('graph_optimization', graph_optimization),
+                ('io_binding', True if no_io_binding else None),
+            ) if value is not None
         }
+        self.profile = load_profile(profile)
+        if self.profile is not None:
+            apply_profile(
+                self.args,
+                self.profile,
+                network_config(size, resblocks, hiddenlayers, inputarrays),
+                explicit
+            )
+            print(f"Inference profile {resolve_profile(profile)}: {self.profile['best']}")
+        elif profile:
+            print(f"No inference profile at {resolve_profile(profile)}, see src/util/autotune.py")
         try: 
             os.makedirs(os.path.join(
                 "./models/", 
@@ -193,70 +287,102 @@ class AlphaZero:
         self.average_episodes = 0
         self.array_episodes = []
         self.mcts = MCTS(self.game, self.args, self.model)
+        if self.mcts.cache is not None:
+            # cached outputs are stale once train() changes the weights
+            self.mcts.cache.watch(self.optimizer)
+        # runs parallel_games self-play games against one batched model
+        self.lockstep = LockstepSelfPlay(self.game, self.args, self.mcts)
+        # self-play processes, started with the first iteration
+        self.model_config = (resblocks, hiddenlayers, inputarrays)
+        self.seed = seed
+        self.pool = None
+        # independent trees per search in sequential self-play
+        self.root_parallel = None
+        if self.args['root_parallel'] > 1:
+            if self.args['workers'] > 1:
+                print("--root-parallel only applies without --workers, the workers search one tree each")
+            else:
+                self.root_parallel = RootParallelMCTS(
+                    self.game,
+                    self.args,
+                    self.model,
+                    self.args['root_parallel'],
+                    self.args['root_parallel_mode'],
+                    seed
+                )
 
         self.learn(model_id)
 
     def selfPlay(self):
-        memory = []
-        player = 1 
-        state = self.game.restart(player)
-        episodes = 0
+        memory, episodes = self.mcts.run(self_play_steps(
+            self.game,
+            self.args,
+            self.mcts,
+            self.root_parallel
+        ))
+        self.record_episode(memory, episodes)
+        return memory
 
-        while True:
-            neutral_state = self.game.change_perspective(
-                state.copy(), 
-                player
-            )
-            action_probs = self.mcts.search(neutral_state)
-            memory.append((
-                neutral_state, 
-                action_probs, 
-                player
-            ))
-            action = numpy.random.choice(
-                self.game.actions, 
-                p = action_probs
-            )
-            state = self.game.step(state, action, player)
-            episodes += 1
-            value, is_terminal = self.game.terminated(
-                state,
-                action
-            )
-            if is_terminal:
-                print(f"\nEpisodes: {episodes}")
-                # append to per-group and global lists
-                self.array_episodes.append(episodes)
-                self.global_episode_lengths.append(episodes)
-                # log per-episode length to TensorBoard
-                try:
-                    if self.writer is not None:
-                        self.writer.add_scalar('alphazero/episode_length', episodes / 2, self.play_step)
-                except Exception:
-                    pass
-                # increment global episode counter
-                self.play_step += 1
-                # compute group average and reset group array if full
-                l = len(self.array_episodes)
-                if l == self.args['num_selfPlay_iterations']:
-                    self.average_episodes = sum(self.array_episodes) / len(self.array_episodes)
-                    print("\navg episodes " + str(self.average_episodes))
-                    self.array_episodes = []
-                returnMemory = []
-                for hist_neutral_state, hist_action_probs, hist_player in memory:
-                    if hist_player == player:
-                        hist_outcome = value
-                    else:
-                        hist_outcome = -value
-                    returnMemory.append((
-                        self.game.get_encoded_state(
-                            hist_neutral_state
-                        ),
-                        hist_action_probs,
-                        hist_outcome
-                    ))
-                return returnMemory
-            player = -player
+    def record_episode(self, memory, episodes):
+        print(f"\nEpisodes: {episodes}")
+        # append to per-group and global lists
+        self.array_episodes.append(episodes)
+        self.global_episode_lengths.append(episodes)
+        # log per-episode length to TensorBoard
+        try:
+            if self.writer is not None:
+                self.writer.add_scalar('alphazero/episode_length', episodes / 2, self.play_step)
+        except Exception:
+            pass
+        # increment global episode counter
+        self.play_step += 1
+        # compute group average and reset group array if full
+        l = len(self.array_episodes)
+        if l == self.args['num_selfPlay_iterations']:
+            self.average_episodes = sum(self.array_episodes) / len(self.array_episodes)
+            print("\navg episodes " + str(self.average_episodes))
+            self.array_episodes = []
+
+    def record_cache_stats(self):
+        if self.pool is not None:
+            # the workers search with caches of their own
+            stats = self.pool.cache_stats()
+        elif self.root_parallel is not None:
+            stats = self.root_parallel.cache_stats()
+        else:
+            stats = None if self.mcts.cache is None else self.mcts.cache.stats()
+        if stats is None:
+            return
+        print(
+            f"\nevaluation cache: hit rate {stats['hit_rate']:.2f}, "
+            f"{stats['entries']} entries, {stats['evictions']} evictions"
+        )
+        try:
+            if self.writer is not None:
+                self.writer.add_scalar('alphazero/cache_hit_rate', stats['hit_rate'], self.current_iteration)
+        except Exception:
+            pass
+
+    def record_server_stats(self, stats):
+        if stats is None:
+            return
+        print(
+            f"\ninference server: {stats['batches']} batches, "
+            f"mean batch {stats['mean_batch']:.1f}, "
+            f"batch sizes {stats['batch_histogram']}, "
+            f"queue depth {stats['queue_depth']}"
+        )
+        try:
+            if self.writer is not None:
+                self.writer.add_scalar('inference/mean_batch', stats['mean_batch'], self.current_iteration)
+                depth = stats['queue_depth']
+                self.writer.add_scalar(
+                    'inference/mean_queue_depth',
+                    sum(d * c for d, c in depth.items()) / max(1, sum(depth.values())),
+                    self.current_iteration
+                )
+        except Exception:
+            pass
 
     def train(self, memory):
         random.shuffle(memory)
@@ -320,9 +446,39 @@ class AlphaZero:
             self.current_iteration = iter_idx
             memory = []
             self.model.eval()
-            for _ in trange(
-                self.args['num_selfPlay_iterations']):
-                memory += self.selfPlay()
+            if self.args['workers'] > 1:
+                if self.pool is None:
+                    self.pool = SelfPlayPool(
+                        self.game,
+                        self.model,
+                        self.model_config,
+                        self.args,
+                        self.args['workers'],
+                        self.seed
+                    )
+                else:
+                    self.pool.publish(self.model)
+                games = self.pool.play(
+                    self.args['num_selfPlay_iterations'],
+                    self.record_episode
+                )
+                for game_memory, _ in games:
+                    memory += game_memory
+                self.record_server_stats(self.pool.stats())
+            elif self.args['parallel_games'] > 1 and self.root_parallel is None:
+                games = self.lockstep.play(
+                    self.args['num_selfPlay_iterations'],
+                    self.record_episode
+                )
+                for game_memory, _ in games:
+                    memory += game_memory
+            else:
+                if self.root_parallel is not None:
+                    self.root_parallel.publish(self.model)
+                for _ in trange(
+                    self.args['num_selfPlay_iterations']):
+                    memory += self.selfPlay()
+            self.record_cache_stats()
             self.model.train()
             for epoch in trange(self.args['num_epochs']):
                 self.train(memory)
@@ -334,6 +490,12 @@ class AlphaZero:
                     torch.save(self.model.state_dict(), "./models/" + modellocation + f"/main.pt")
                 except Exception:
                     pass
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+        if self.root_parallel is not None:
+            self.root_parallel.close()
+            self.root_parallel = None
 
 def _parse_args():
     p = argparse.ArgumentParser(description="AlphaZero training for Battleship")
@@ -343,7 +505,32 @@ def _parse_args():
     p.add_argument("--hiddenlayers", type=int, default=6)
     p.add_argument("--inputarrays", type=int, default=4)
     p.add_argument("--searches", type=int, default=4)
+    p.add_argument("--leaf-batch", type=int, default=1, help="leaves evaluated per forward pass during search")
     p.add_argument("--selfplayiterations", type=int, default=64)
+    p.add_argument("--parallel-games", type=int, default=None, help="self-play games sharing each forward pass, 1 unless a --profile sets it")
+    p.add_argument("--workers", type=int, default=0, help="self-play processes, 0 or 1 plays in this process")
+    p.add_argument("--seed", type=int, default=None)
+    p.add_argument("--inference-server", action="store_true", help="workers share one batching inference process")
+    p.add_argument("--server-max-batch", type=int, default=None, help="256 unless a --profile sets it")
+    p.add_argument("--server-max-wait-ms", type=float, default=2.0)
+    p.add_argument("--eval-cache", type=int, default=0, help="cached network evaluations, 0 disables the cache")
+    p.add_argument("--eval-cache-mb", type=float, default=None)
+    p.add_argument("--transpositions", action="store_true", help="share statistics of positions reached by different move orders")
+    p.add_argument("--tt-size", type=int, default=100000)
+    p.add_argument("--search-time-ms", type=float, default=None, help="wall clock budget per search, on top of --searches")
+    p.add_argument("--root-search", choices=["puct", "gumbel"], default="puct")
+    p.add_argument("--gumbel-actions", type=int, default=16, help="root actions sampled by a gumbel search")
+    p.add_argument("--expand-top-k", type=int, default=0, help="children kept per expanded node below the root, 0 keeps all")
+    p.add_argument("--expand-prior-mass", type=float, default=1.0, help="prior mass kept per expanded node below the root")
+    p.add_argument("--widening", type=float, default=0.0, help="progressive widening constant c in c * N ** alpha, 0 disables it")
+    p.add_argument("--widening-alpha", type=float, default=0.5)
+    p.add_argument("--backend", choices=sorted(BACKENDS), default=None, help="inference backend evaluating the search batches, torch unless a --profile sets it")
+    p.add_argument("--backend-path", type=str, default=None, help="ONNX file of the onnx backend or static INT8 TorchScript file of the quantized backend, built from the model if not given")
+    p.add_argument("--inference-mode", choices=["script", "compile", "eager"], default=None, help="compilation of the fused backend, script unless a --profile sets it")
+    p.add_argument("--backend-threads", type=int, default=None, help="intra-op threads of the onnx backend, 0 lets onnxruntime decide")
+    p.add_argument("--graph-optimization", choices=list(GRAPH_OPTIMIZATIONS), default=None, help="graph optimization level of the onnx backend, all unless a --profile sets it")
+    p.add_argument("--no-io-binding", action="store_true", help="let the onnx backend allocate its inputs and outputs per call")
+    p.add_argument("--profile", type=str, default=None, help="inference profile written by src/util/autotune.py, fills in the backend options that are not given; a relative path is also looked up below the repository root")
     p.add_argument("--timesteps", type=int, default=0)
     p.add_argument("--num-iterations", type=int, default=256)
     p.add_argument("--num-epochs", type=int, default=128)
@@ -353,6 +540,11 @@ def _parse_args():
     p.add_argument("--dirichlet-alpha", type=float, default=0.3)
     p.add_argument("--logdir", type=str, default=None)
     p.add_argument("--save", type=str, default=None)
+    p.add_argument("--engine", choices=["array", "bitboard"], default="array")
+    p.add_argument("--planes", choices=["float32", "uint8"], default="float32")
+    p.add_argument("--reuse-tree", action="store_true", help="keep the subtree of the played move between searches")
+    p.add_argument("--root-parallel", type=int, default=0, help="independent trees searched per move and merged at the root, 0 or 1 searches one tree")
+    p.add_argument("--root-parallel-mode", choices=["threads", "processes"], default="threads", help="whether the root-parallel trees run in threads or in processes")
     return p.parse_args()
 
 
@@ -374,6 +566,36 @@ def main():
         dirichlet_alpha=args.dirichlet_alpha,
         logdir=args.logdir,
         save=args.save,
+        engine=args.engine,
+        planes=args.planes,
+        reuse_tree=args.reuse_tree,
+        leaf_batch=args.leaf_batch,
+        parallel_games=args.parallel_games,
+        workers=args.workers,
+        seed=args.seed,
+        inference_server=args.inference_server,
+        server_max_batch=args.server_max_batch,
+        server_max_wait_ms=args.server_max_wait_ms,
+        eval_cache=args.eval_cache,
+        eval_cache_mb=args.eval_cache_mb,
+        transpositions=args.transpositions,
+        tt_size=args.tt_size,
+        search_time_ms=args.search_time_ms,
+        root_search=args.root_search,
+        gumbel_actions=args.gumbel_actions,
+        expand_top_k=args.expand_top_k,
+        expand_prior_mass=args.expand_prior_mass,
+        widening=args.widening,
+        widening_alpha=args.widening_alpha,
+        backend=args.backend,
+        backend_path=args.backend_path,
+        inference_mode=args.inference_mode,
+        backend_threads=args.backend_threads,
+        graph_optimization=args.graph_optimization,
+        no_io_binding=args.no_io_binding,
+        profile=args.profile,
+        root_parallel=args.root_parallel,
+        root_parallel_mode=args.root_parallel_mode,
     )
 
 
@@ -4,148 +4,435 @@ secondary author: Tim Straube
 licence: MIT
 """
 
+import time
 import torch
 import numpy
-from agents.alphazero.node import Node
+from agents.alphazero.cache import EvaluationCache
+from agents.alphazero.backends import make_backend
+from agents.alphazero.tree import Tree
 
 class MCTS:
-    def __init__(self, game, args, model):
+    def __init__(self, game, args, model, evaluator=None, seed=None):
         self.game = game
         self.args = args
         self.model = model
+        # own generator for the root noise, e.g. one per root-parallel tree
+        self.random = numpy.random if seed is None else numpy.random.default_rng(seed)
+        # evaluates the leaf batches, an InferenceBackend built from
+        # args['backend'] unless one is given, e.g. an InferenceClient
+        self.backend = evaluator if evaluator is not None else make_backend(args, model)
+        # network outputs of positions seen before, see args['eval_cache']
+        self.cache = EvaluationCache.from_args(args)
 
     @torch.no_grad()
-    def search(self, state):
-        root = Node(
-            self.game, 
-            self.args, 
-            state, 
-            visit_count = 1
-        )
-        policy, _ = self.model(
-            torch.tensor(
-                self.game.get_encoded_state(state), 
-                device = self.model.device
-            ).unsqueeze(0)
-        )
-        policy = (
-            torch.softmax(policy, axis = 1)
-            .squeeze(0)
-            .cpu()
-            .numpy()
+    def search(self, state, tree=None):
+        return self.run(self.search_steps(state, tree))
+
+    def search_steps(self, state, tree=None):
+        """`search` as a generator of network requests
+
+        Yields every batch of encoded states the search needs evaluated
+        and expects `(logits, values)` for it back through `send`, the
+        way `run` drives it with `evaluate`. The visit distribution is
+        the return value. Self-play drives many of these at once and
+        answers all their batches with one forward pass.
+        """
+        tree = yield from self.search_tree_steps(state, tree)
+        return tree.action_probs(0)
+
+    def search_tree_steps(self, state, tree=None):
+        """Like `search_steps`, returns the searched tree
+
+        With args['root_search'] = 'gumbel' the root is searched by
+        `gumbel_steps`, then `tree.chosen_action` is the move to play
+        and `tree.action_probs(0)` the completed-Q policy target.
+        """
+        gumbel = self.args.get('root_search', 'puct') == 'gumbel'
+        tree = yield from self.prepare_steps(state, tree, noise=not gumbel)
+        if gumbel:
+            yield from self.gumbel_steps(tree)
+        else:
+            yield from self.simulate_steps(tree)
+        return tree
+
+    @torch.no_grad()
+    def search_timed(
+        self,
+        state,
+        time_limit=None,
+        max_simulations=None,
+        tree=None):
+        """Anytime search within a wall clock and/or simulation budget
+
+        Runs simulations until `time_limit` seconds have passed since the
+        call or `max_simulations` are done, whichever comes first, and
+        returns the visit distribution at that point together with
+        statistics of the search. Without either limit the budget of
+        `search` applies. At least one simulation is run, even when the
+        time is up after the root evaluation. The deadline is checked
+        once per round of args['leaf_batch'] leaves, so it may be overrun
+        by one round.
+
+        With args['root_search'] = 'gumbel' the simulations are split
+        over the sampled root actions up front, so only
+        `max_simulations` can limit that search.
+        """
+        gumbel = self.args.get('root_search', 'puct') == 'gumbel'
+        if gumbel and time_limit is not None:
+            raise ValueError("The gumbel root search needs its budget up front, pass max_simulations instead of time_limit")
+        start = time.perf_counter()
+        deadline = None if time_limit is None else start + time_limit
+        if max_simulations is not None:
+            max_simulations = max(1, int(max_simulations))
+        tree = self.run(self.prepare_steps(state, tree, noise=not gumbel))
+        if gumbel:
+            visits = int(tree.visit_count[0])
+            self.run(self.gumbel_steps(tree, max_simulations))
+            simulations = int(tree.visit_count[0]) - visits
+        else:
+            simulations = self.run(self.simulate_steps(
+                tree,
+                max_simulations,
+                deadline
+            ))
+        elapsed = time.perf_counter() - start
+        return tree.action_probs(0), {
+            'simulations': simulations,
+            'nodes': len(tree),
+            'elapsed': elapsed,
+            'time_per_simulation': elapsed / simulations if simulations else None,
+            'stopped': (
+                'time' if deadline is not None and time.perf_counter() >= deadline
+                else 'simulations'
+            ),
+        }
+
+    @torch.no_grad()
+    def run(self, steps):
+        """Drives a step generator with this model, returns its result
+        """
+        try:
+            batch = next(steps)
+            while True:
+                batch = steps.send(self.evaluate(batch))
+        except StopIteration as stop:
+            return stop.value
+
+    @torch.no_grad()
+    def prepare(self, state, tree=None):
+        return self.run(self.prepare_steps(state, tree))
+
+    def prepare_steps(self, state, tree=None, noise=True):
+        """Root of a search
+
+        A fresh tree with an evaluated root, or `tree`, an expanded
+        subtree kept from earlier searches. Either way the root priors
+        get fresh Dirichlet noise, unless `noise` is off.
+        """
+        if tree is not None and tree.is_expanded(0):
+            if noise:
+                self.add_noise(tree)
+            else:
+                children = tree.children(0)
+                children = slice(children.start, children.stop)
+                if tree.root_prior is None:
+                    tree.root_prior = tree.prior[children].copy()
+                tree.prior[children] = tree.root_prior
+            if tree.root_value is None:
+                tree.root_value = float(tree.value_sum[0] / tree.visit_count[0])
+            return tree
+        tree = Tree(
+            self.game,
+            self.args,
+            state
         )
+        logits, values = yield self.encode_states([state])
+        tree.root_value = float(values[0])
+        policy = self.softmax(logits)[0]
+        root_prior = self.game.policy(policy.copy(), state)
+        if not noise:
+            tree.expand(0, root_prior)
+            children = tree.children(0)
+            tree.root_prior = tree.prior[children.start:children.stop].copy()
+            return tree
         policy = (
-            (1 - self.args['dirichlet_epsilon']) * 
-            policy + 
-            self.args['dirichlet_epsilon'] * 
-            numpy.random.dirichlet(
-                [self.args['dirichlet_alpha']] * 
+            (1 - self.args['dirichlet_epsilon']) *
+            policy +
+            self.args['dirichlet_epsilon'] *
+            self.random.dirichlet(
+                [self.args['dirichlet_alpha']] *
                 self.game.actions))
         policy = self.game.policy(policy, state)
-        root.expand(policy)
-        for search in range(self.args['num_searches']):
-            node = root
-            while node.is_fully_expanded():
-                node = node.select()
-            value, is_terminal = self.game.terminated(
-                node.state,
-                node.action_taken
-            )
-            value = -value
-            if not is_terminal:
-                policy, value = self.model(
-                    torch.tensor(
-                        self.game.get_encoded_state(
-                            node.state
-                        ),
-                        device = self.model.device
-                    ).unsqueeze(0)
+        tree.expand(0, policy)
+        children = tree.children(0)
+        tree.root_prior = root_prior[tree.action[children.start:children.stop]]
+        return tree
+
+    def add_noise(self, tree):
+        """Mixes fresh Dirichlet noise into the noise-free root priors
+        """
+        children = tree.children(0)
+        children = slice(children.start, children.stop)
+        if tree.root_prior is None:
+            tree.root_prior = tree.prior[children].copy()
+        policy = numpy.zeros(self.game.actions)
+        policy[tree.action[children]] = tree.root_prior
+        policy = (
+            (1 - self.args['dirichlet_epsilon']) *
+            policy +
+            self.args['dirichlet_epsilon'] *
+            self.random.dirichlet(
+                [self.args['dirichlet_alpha']] *
+                self.game.actions))
+        policy = self.game.policy(policy, tree.state(0))
+        tree.prior[children] = policy[tree.action[children]]
+
+    @torch.no_grad()
+    def evaluate(self, batch):
+        """Network output for a batch of encoded states
+
+        Returns the policy logits (K, actions) and values (K,) as numpy.
+        """
+        if self.cache is not None:
+            return self.cache.evaluate(batch, self.forward)
+        return self.forward(batch)
+
+    def forward(self, batch):
+        return self.backend.evaluate(batch)
+
+    def encode_states(self, states):
+        """Network input batch of the given states
+        """
+        return numpy.stack([
+            self.game.get_encoded_state(state, copy=False)
+            for state in states
+        ])
+
+    def softmax(self, logits):
+        return torch.softmax(
+            torch.from_numpy(logits),
+            axis=1
+        ).numpy()
+
+    def evaluate_states(self, states):
+        """Policy distribution and value of every state in one forward pass
+        """
+        policy, value = self.evaluate(self.encode_states(states))
+        return self.softmax(policy), value
+
+    @torch.no_grad()
+    def simulate(self, tree):
+        self.run(self.simulate_steps(tree))
+
+    def simulate_steps(self, tree, searches=None, deadline=None, starts=None):
+        """Runs `searches` simulations from the root of `tree`
+
+        `searches` defaults to args['num_searches'] unless a `deadline`
+        (time.perf_counter() value) is given, then the search runs until
+        it. args['search_time_ms'] caps the default `num_searches` with a
+        wall clock budget per search. Either way the first round runs
+        even when the deadline has passed. The number of simulations
+        done is returned.
+
+        `starts` runs a single round instead, one simulation through
+        each of the given root children, as sequential halving does.
+
+        With args['leaf_batch'] = K > 1 every round selects up to K
+        leaves, each under a virtual loss on its path so the next
+        selection prefers other branches, and evaluates them in one
+        forward pass. A round ends early when a selection reaches a
+        leaf that is already waiting for evaluation.
+        """
+        leaf_batch = max(1, int(self.args.get('leaf_batch', 1)))
+        if starts is not None:
+            searches = len(starts)
+            deadline = None
+        if searches is None and deadline is None:
+            searches = self.args['num_searches']
+            if self.args.get('search_time_ms'):
+                deadline = time.perf_counter() + self.args['search_time_ms'] / 1000
+        done = 0
+        rounds = 0
+        while (searches is None or done < searches) and (
+                deadline is None or not rounds or time.perf_counter() < deadline):
+            if starts is not None and rounds:
+                break
+            rounds += 1
+            leaves = []
+            states = []
+            paths = []
+            if starts is not None:
+                round_size = len(starts)
+            else:
+                round_size = leaf_batch if searches is None else min(leaf_batch, searches - done)
+            for index in range(round_size):
+                node = 0
+                path = [node]
+                if starts is not None:
+                    node = int(starts[index])
+                    path.append(node)
+                while True:
+                    while tree.is_expanded(node):
+                        node = tree.select(node)
+                        path.append(node)
+                    # a known position continues below its shared children
+                    if tree.virtual[node] > 0 or not tree.transpose(node):
+                        break
+                if tree.virtual[node] > 0:
+                    if starts is not None:
+                        continue
+                    break
+                done += 1
+                state = tree.state(node)
+                value, is_terminal = self.game.terminated(
+                    state,
+                    tree.action[node]
                 )
-                policy = torch.softmax(
-                    policy, 
-                    axis=1
-                ).squeeze(0).detach().cpu().numpy()
-                value = value.item()
+                if is_terminal:
+                    tree.backpropagate(node, -value, path)
+                    continue
+                tree.add_virtual_loss(node, path)
+                leaves.append(node)
+                states.append(state)
+                paths.append(path)
+            if not leaves:
+                continue
+            logits, values = yield self.encode_states(states)
+            policies = self.softmax(logits)
+            for node, state, path, policy, value in zip(
+                    leaves, states, paths, policies, values):
+                tree.remove_virtual_loss(node, path)
                 policy = self.game.policy(
-                    policy, 
-                    node.state
+                    policy,
+                    state
                 )
-                node.expand(policy)
-            node.backpropagate(value)
-        action_probs = numpy.zeros(self.game.actions)
-        for child in root.children:
-            action_probs[child.action_taken] = child.visit_count
-        action_probs /= numpy.sum(action_probs)
-        return action_probs
-    
-    @torch.no_grad()
-    def search_int8(self, state, sess):
-        root = Node(
-            self.game, 
-            self.args, 
-            state, 
-            visit_count = 1
-        )        
-        input_name = sess.get_inputs()[0].name
-         
-        input_data = self.game.get_encoded_state(state)
-        input_data = numpy.expand_dims(input_data, axis = 0)
-        policy, _ = sess.run(
-            None, 
-            {input_name: input_data}
+                # a leaf of the same position may have been expanded in this round
+                if not tree.is_expanded(node) and not tree.transpose(node):
+                    tree.expand(node, policy)
+                tree.backpropagate(node, float(value), path)
+        return done
+
+    def gumbel_steps(self, tree, budget=None):
+        """Gumbel top-k root search with sequential halving
+
+        Samples k = args['gumbel_actions'] root actions without
+        replacement by Gumbel-top-k on the noise-free prior logits and
+        splits `budget` simulations, args['num_searches'] by default,
+        over them in rounds, halving the candidates by
+        g + logits + sigma(q) after every phase (Danihelka et al.,
+        Policy improvement by planning with Gumbel). Below the root the usual PUCT selection is used. Sets
+        `tree.chosen_action`, the best remaining candidate, and
+        `tree.policy_target`, softmax(logits + sigma(completed q)).
+        """
+        children = numpy.arange(tree.first_child[0], tree.first_child[0] + tree.num_children[0])
+        logits = numpy.log(numpy.maximum(tree.root_prior, 1e-12))
+        gumbel = self.random.gumbel(size=len(children))
+        if budget is None:
+            budget = self.args['num_searches']
+        considered = min(
+            int(self.args.get('gumbel_actions', 16)),
+            len(children),
+            max(1, budget)
         )
-        policy = torch.tensor(policy)
+        order = numpy.argsort(-(gumbel + logits), kind='stable')[:considered]
+        phases = max(1, int(numpy.ceil(numpy.log2(considered))))
+        used = 0
+        while used < budget:
+            if len(order) == 1:
+                visits = budget - used
+            else:
+                visits = max(1, budget // (phases * len(order)))
+            before = used
+            for _ in range(visits):
+                if used >= budget:
+                    break
+                starts = children[order[:budget - used]]
+                used += yield from self.simulate_steps(tree, starts=starts)
+            if used == before:
+                break
+            # best half goes on, at least two until the budget is used
+            scores = gumbel + logits + self.sigma(tree, self.completed_q(tree))
+            order = order[numpy.argsort(-scores[order], kind='stable')]
+            order = order[:max(2, len(order) // 2)] if len(order) > 2 else order
+        scores = gumbel + logits + self.sigma(tree, self.completed_q(tree))
+        best = order[int(numpy.argmax(scores[order]))]
+        tree.chosen_action = int(tree.action[children[best]])
+        improved = logits + self.sigma(tree, self.completed_q(tree))
+        improved = numpy.exp(improved - improved.max())
+        tree.policy_target = numpy.zeros(self.game.actions)
+        tree.policy_target[tree.action[children]] = improved / improved.sum()
+        return tree
 
-        policy = (
-            torch.softmax(policy, axis = 1)
-            .squeeze(0)
-            .cpu()
-            .numpy()
+    def completed_q(self, tree):
+        """q in [0, 1] of every root child, the mixed value where unvisited
+        """
+        first = int(tree.first_child[0])
+        last = first + int(tree.num_children[0])
+        visits = tree.visit_count[first:last]
+        q = 1 - ((tree.value_sum[first:last] / numpy.maximum(visits, 1)) + 1) / 2
+        prior = tree.root_prior
+        visited = visits > 0
+        total = visits.sum()
+        value = (tree.root_value + 1) / 2
+        if total > 0:
+            value = (
+                value +
+                total / prior[visited].sum() * (prior[visited] * q[visited]).sum()
+            ) / (1 + total)
+        return numpy.where(visited, q, value)
+
+    def sigma(self, tree, q):
+        first = int(tree.first_child[0])
+        last = first + int(tree.num_children[0])
+        return (
+            (self.args.get('gumbel_c_visit', 50) + tree.visit_count[first:last].max()) *
+            self.args.get('gumbel_c_scale', 1.0) *
+            q
         )
-        policy = (
-            (1 - self.args['dirichlet_epsilon']) * 
-            policy + 
-            self.args['dirichlet_epsilon'] * 
-            numpy.random.dirichlet(
-                [self.args['dirichlet_alpha']] * 
-                self.game.action_size
-            )
+
+
+class MCTSSession:
+    """Search tree of one game kept between moves
+
+    After a move is played, `advance` re-roots the tree at the child of
+    that action so the statistics gathered below it are reused by the
+    next search. A fresh tree is built when the child was never
+    expanded or the next searched state does not match the kept root.
+    """
+    def __init__(self, mcts):
+        self.mcts = mcts
+        self.game = mcts.game
+        self.tree = None
+
+    def reset(self):
+        self.tree = None
+
+    def matches(self, state):
+        return numpy.array_equal(
+            self.game.get_encoded_state(self.tree.state(0), copy=False),
+            self.game.get_encoded_state(state, copy=False)
         )
-        policy = self.game.policy(policy, state)
-        root.expand(policy)
-        for search in range(self.args['num_searches']):
-            node = root
-            while node.is_fully_expanded():
-                node = node.select()
-            value, is_terminal = self.game.terminated(
-                node.state,
-                node.action_taken
-            )
-            value = -value
-            if not is_terminal:
-                policy, value = self.model(
-                    torch.tensor(
-                        self.game.get_encoded_state(
-                            node.state
-                        ),
-                        device = self.model.device
-                    ).unsqueeze(0)
-                )
-                policy = torch.softmax(
-                    policy, 
-                    axis=1
-                ).squeeze(0).detach().cpu().numpy()
-                value = value.item()
-                policy = self.game.policy(
-                    policy, 
-                    node.state
-                )
-                node.expand(policy)
-            node.backpropagate(value)
-        action_probs = numpy.zeros(self.game.action_size)
-        for child in root.children:
-            action_probs[child.action_taken] = (
-                child.visit_count
-            )
-        action_probs /= numpy.sum(action_probs)
-        return action_probs
\ No newline at end of file
+
+    def search(self, state):
+        return self.mcts.run(self.search_steps(state))
+
+    def search_steps(self, state):
+        tree = yield from self.search_tree_steps(state)
+        return tree.action_probs(0)
+
+    def search_tree_steps(self, state):
+        if self.tree is not None and not self.matches(state):
+            self.tree = None
+        self.tree = yield from self.mcts.search_tree_steps(state, self.tree)
+        return self.tree
+
+    def advance(self, action):
+        """Re-roots the tree at `action` played from the current root
+        """
+        if self.tree is None:
+            return
+        child = self.tree.child(0, action)
+        if child < 0 or not self.tree.is_expanded(child):
+            self.tree = None
+        else:
+            self.tree = self.tree.subtree(child)
@@ -5,81 +5,94 @@ licence: MIT
 """
 
 import math
-import numpy
 
 class Node:
-    def __init__(
-        self, 
-        game, 
-        args, 
-        state, 
-        parent=None, 
-        action_taken=None, 
-        prior=0, 
-        visit_count=0):
-        
-        self.game = game
-        self.args = args
-        self.state = state
-        self.parent = parent
-        self.action_taken = action_taken
-        self.children = []
-        self.prior = prior
-        self.visit_count = visit_count
-        self.value_sum = 0
-        
+    """Compact handle on one node of an array-backed `Tree`
+
+    The statistics live in the tree's arrays; a handle only stores the
+    tree and the node id and exposes the interface of the former object
+    based node.
+    """
+    __slots__ = ("tree", "index")
+
+    def __init__(self, tree, index=0):
+        self.tree = tree
+        self.index = int(index)
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, Node) and
+            self.tree is other.tree and
+            self.index == other.index
+        )
+
+    def __hash__(self):
+        return hash((id(self.tree), self.index))
+
+    @property
+    def game(self):
+        return self.tree.game
+
+    @property
+    def args(self):
+        return self.tree.args
+
+    @property
+    def state(self):
+        return self.tree.state(self.index)
+
+    @property
+    def parent(self):
+        parent = self.tree.parent[self.index]
+        return None if parent < 0 else Node(self.tree, parent)
+
+    @property
+    def action_taken(self):
+        action = self.tree.action[self.index]
+        return None if action < 0 else int(action)
+
+    @property
+    def children(self):
+        return [Node(self.tree, child) for child in self.tree.children(self.index)]
+
+    @property
+    def prior(self):
+        return float(self.tree.prior[self.index])
+
+    @property
+    def visit_count(self):
+        return int(self.tree.visit_count[self.index])
+
+    @property
+    def value_sum(self):
+        return float(self.tree.value_sum[self.index])
+
     def is_fully_expanded(self):
-        # return numpy.sum(self.expandable_moves) == 0 and len(self.children) > 0
-        return len(self.children) > 0
+        return self.tree.is_expanded(self.index)
 
     def select(self):
-        best_child = None
-        best_ucb = -numpy.inf
-
-        for child in self.children:
-            ucb = self.get_ucb(child)
-            if ucb > best_ucb:
-                best_child = child
-                best_ucb = ucb
-        return best_child
+        return Node(self.tree, self.tree.select(self.index))
 
     def get_ucb(self, child):
         if child.visit_count == 0:
             q_value = 0
         else:
             q_value = 1 - ((
-                child.value_sum / 
+                child.value_sum /
                 child.visit_count
             ) + 1) / 2
-        # return q_value + self.args['C'] * math.sqrt(math.log(self.visit_count) / child.visit_count)
         return (
-            q_value + 
-            self.args['C'] * 
+            q_value +
+            self.args['C'] *
             (
-                math.sqrt(self.visit_count) / 
+                math.sqrt(self.visit_count) /
                 (child.visit_count + 1)
-            ) * 
+            ) *
             child.prior
         )
 
     def expand(self, policy):
-        for action, prob in enumerate(policy):
-            if prob > 0:
-                child_state = self.state.copy()
-                child_state = self.game.step(child_state, action, 1)
-                child_state = self.game.change_perspective(child_state, player=-1)
-                child = Node(
-                    self.game,
-                    self.args,
-                    child_state,
-                    self, 
-                    action, 
-                    prob)
-                self.children.append(child)
-        return child
+        return Node(self.tree, self.tree.expand(self.index, policy))
 
     def backpropagate(self, value):
-        self.value_sum += value
-        self.visit_count += 1
-        if self.parent is not None:
-            self.parent.backpropagate(-value)
\ No newline at end of file
+        self.tree.backpropagate(self.index, value)
@@ -0,0 +1,65 @@
+"""
+description: Vectorized PUCT child selection for Monte Carlo Tree Search.
+secondary author: Tim Straube
+licence: MIT
+"""
+
+import math
+import numpy
+
+try:
+    import numba
+except Exception:
+    numba = None
+
+def puct_scores(visit_count, value_sum, prior, parent_visits, c):
+    """PUCT score of every child, same formula as `Node.get_ucb`
+
+    q is 0 for unvisited children and otherwise the mean value mapped
+    from [-1, 1] to [1, 0], since child values are stored from the
+    perspective of the child's player.
+    """
+    q_value = numpy.where(
+        visit_count == 0,
+        0.0,
+        1 - ((value_sum / numpy.maximum(visit_count, 1)) + 1) / 2
+    )
+    return (
+        q_value +
+        c *
+        (math.sqrt(parent_visits) / (visit_count + 1)) *
+        prior
+    )
+
+def _select_numpy(visit_count, value_sum, prior, parent_visits, c):
+    return int(numpy.argmax(
+        puct_scores(visit_count, value_sum, prior, parent_visits, c)
+    ))
+
+if numba is not None:
+    @numba.njit(cache=True)
+    def _select_numba(visit_count, value_sum, prior, parent_visits, c):
+        best_child = -1
+        best_ucb = -numpy.inf
+        sqrt_visits = math.sqrt(parent_visits)
+        for child in range(visit_count.shape[0]):
+            if visit_count[child] == 0:
+                q_value = 0.0
+            else:
+                q_value = 1 - ((value_sum[child] / visit_count[child]) + 1) / 2
+            ucb = q_value + c * (sqrt_visits / (visit_count[child] + 1)) * prior[child]
+            if ucb > best_ucb:
+                best_child = child
+                best_ucb = ucb
+        return best_child
+else:
+    _select_numba = None
+
+def select_child(visit_count, value_sum, prior, parent_visits, c, compiled=True):
+    """Offset of the child with the highest PUCT score, first one on ties
+    """
+    if compiled and _select_numba is not None:
+        return _select_numba(
+            visit_count, value_sum, prior, float(parent_visits), float(c)
+        )
+    return _select_numpy(visit_count, value_sum, prior, parent_visits, c)
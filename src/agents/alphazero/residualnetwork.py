@@ -4,6 +4,7 @@ secondary author: Tim Straube
 licence: MIT
 """
 
+import torch
 import torch.nn as nn
 from agents.alphazero.residualblock import ResidualBlock
 
@@ -72,6 +73,8 @@ class ResidualNetwork(nn.Module):
     def forward(self, x):
         """Feed-forward layer
         """
+        # accepts uint8 planes straight from the environment
+        x = x.to(torch.float32)
         x = self.startBlock(x)
         for resBlock in self.backBone:
             x = resBlock(x)
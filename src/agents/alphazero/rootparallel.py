@@ -0,0 +1,190 @@
+"""
+description: Root-parallel Monte Carlo Tree Search over threads or processes.
+secondary author: Tim Straube
+licence: MIT
+"""
+
+import concurrent.futures
+import multiprocessing
+import os
+import numpy
+import torch
+from agents.alphazero.cache import combine_stats
+from agents.alphazero.mcts import MCTS
+from agents.alphazero.workers import SharedWeights
+
+def root_summary(game, tree):
+    """(visit counts per action, policy target or None) of a searched root
+    """
+    children = tree.children(0)
+    visits = numpy.zeros(game.actions)
+    visits[tree.action[children.start:children.stop]] = (
+        tree.visit_count[children.start:children.stop]
+    )
+    target = None if tree.policy_target is None else tree.policy_target.copy()
+    return visits, target
+
+def search_root(game, mcts, state, seed):
+    """`root_summary` of a search by `mcts` with its noise seeded by `seed`
+    """
+    mcts.random = numpy.random.default_rng(seed)
+    return root_summary(game, mcts.run(mcts.search_tree_steps(state)))
+
+# per process state of a tree worker, see _init_tree_worker
+_worker = {}
+
+def _init_tree_worker(game_config, model, args, weights):
+    game_class, size, ship_sizes, encoded_dtype = game_config
+    # one tree per process, the processes already use the cores
+    torch.set_num_threads(1)
+    args = dict(args, backend_threads=1, backend_inter_threads=1)
+    game = game_class(
+        size,
+        ship_sizes=ship_sizes,
+        encoded_dtype=encoded_dtype
+    )
+    model = model.to(torch.device("cpu")).eval()
+    # the noise generator is reseeded per search, see search_root
+    _worker.update(
+        game=game,
+        model=model,
+        mcts=MCTS(game, args, model, seed=0),
+        weights=SharedWeights(*weights),
+        version=-1
+    )
+
+def _search_tree(state, seed):
+    """Task of a tree worker, returns its process id and evaluation cache
+    statistics (None without a cache) along with the `root_summary`
+    """
+    weights = _worker['weights']
+    mcts = _worker['mcts']
+    if weights.version != _worker['version']:
+        _worker['version'] = weights.load_into(_worker['model'])
+        if mcts.cache is not None:
+            mcts.cache.sync(_worker['version'])
+    summary = search_root(_worker['game'], mcts, state, seed)
+    return os.getpid(), None if mcts.cache is None else mcts.cache.stats(), summary
+
+
+class RootParallelMCTS:
+    """`trees` independent searches of the same root, merged at the root
+
+    Every tree is searched by an `MCTS` kept for the lifetime of this
+    object, so its backend and evaluation cache are built once. The
+    root noise of each search is drawn from a generator seeded per tree
+    and search (from `seed`, or from numpy.random). With mode "threads"
+    the trees share the model, torch releases the GIL during the
+    forward passes. With mode "processes" every worker process holds an
+    `MCTS` and a copy of the model, updated from a `SharedWeights`
+    block by `publish`. The root visit counts of all trees are summed
+    into one `action_probs`; Gumbel searches average their policy
+    targets instead. `close` ends the workers.
+    """
+    def __init__(
+        self,
+        game,
+        args,
+        model,
+        trees=4,
+        mode="threads",
+        seed=None):
+
+        self.game = game
+        self.args = args
+        self.model = model
+        self.trees = max(1, int(trees))
+        self.mode = mode
+        self.seeds = numpy.random.default_rng(seed) if seed is not None else None
+        self.weights = None
+        self.searchers = None
+        # latest evaluation cache statistics of every worker process
+        self.worker_cache_stats = {}
+        if mode == "threads":
+            # the noise generators are reseeded per search, see search_root
+            self.searchers = [
+                MCTS(game, args, model, seed=0)
+                for _ in range(self.trees)
+            ]
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.trees
+            )
+        elif mode == "processes":
+            self.weights = SharedWeights.create(model.state_dict())
+            self.executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.trees,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_tree_worker,
+                initargs=(
+                    (type(game), game.size, game.ship_sizes, game.encoded_dtype),
+                    model,
+                    dict(args),
+                    self.weights.attach()
+                )
+            )
+        else:
+            raise ValueError(f"Unknown root-parallel mode {mode!r}, use 'threads' or 'processes'")
+
+    def publish(self, model=None):
+        """Hands the current weights to the worker processes
+
+        In threads mode the trees share the model already, only their
+        cached evaluations of the old weights are dropped.
+        """
+        if self.weights is not None:
+            self.weights.publish((model or self.model).state_dict())
+        for mcts in self.searchers or []:
+            if mcts.cache is not None:
+                mcts.cache.invalidate()
+
+    def tree_seeds(self):
+        if self.seeds is not None:
+            return self.seeds.integers(0, 2**31, self.trees).tolist()
+        return numpy.random.randint(0, 2**31, self.trees).tolist()
+
+    def search_thread(self, mcts, state, seed):
+        return search_root(self.game, mcts, state, seed)
+
+    def search(self, state):
+        seeds = self.tree_seeds()
+        if self.mode == "threads":
+            # every tree steps its own copies, the caller's state is only read
+            results = list(self.executor.map(
+                self.search_thread,
+                self.searchers,
+                [state] * self.trees,
+                seeds
+            ))
+        else:
+            results = []
+            for pid, cache_stats, summary in self.executor.map(
+                    _search_tree,
+                    [state] * self.trees,
+                    seeds):
+                self.worker_cache_stats[pid] = cache_stats
+                results.append(summary)
+        return self.merge(results)
+
+    def cache_stats(self):
+        """Evaluation cache statistics summed over the trees, None without caches
+        """
+        if self.searchers is not None:
+            return combine_stats(
+                None if mcts.cache is None else mcts.cache.stats()
+                for mcts in self.searchers
+            )
+        return combine_stats(self.worker_cache_stats.values())
+
+    def merge(self, results):
+        targets = [target for _, target in results if target is not None]
+        if targets:
+            action_probs = numpy.mean(targets, axis=0)
+        else:
+            action_probs = numpy.sum([visits for visits, _ in results], axis=0)
+        return action_probs / numpy.sum(action_probs)
+
+    def close(self):
+        self.executor.shutdown()
+        if self.weights is not None:
+            self.weights.close()
+            self.weights = None
@@ -0,0 +1,157 @@
+"""
+description: Lockstep self-play of many games sharing batched inference.
+secondary author: Tim Straube
+licence: MIT
+"""
+
+import numpy
+import torch
+from agents.alphazero.mcts import MCTSSession
+
+def self_play_steps(game, args, mcts, searcher=None):
+    """One self-play game as a generator of network requests
+
+    Yields the leaf batches of every search like `MCTS.search_steps`
+    and returns `(memory, episodes)` once the game is over, where
+    memory holds the `(encoded_state, action_probs, outcome)` samples
+    consumed by `AlphaZero.train`. With a `searcher`, e.g. a
+    `RootParallelMCTS`, every position is searched by its blocking
+    `search(state)` instead and nothing is yielded.
+    """
+    memory = []
+    player = 1
+    state = game.restart(player)
+    episodes = 0
+    # keeps the subtree of the played move for the next search
+    session = MCTSSession(mcts) if args['reuse_tree'] and searcher is None else None
+
+    while True:
+        # perspective view of the live state, encoded right away
+        # so the history does not need a copy of the board
+        neutral_state = game.change_perspective(
+            state,
+            player
+        )
+        if searcher is not None:
+            action_probs = searcher.search(neutral_state)
+            chosen_action = None
+        else:
+            if session is not None:
+                tree = yield from session.search_tree_steps(neutral_state)
+            else:
+                tree = yield from mcts.search_tree_steps(neutral_state)
+            action_probs = tree.action_probs(0)
+            chosen_action = tree.chosen_action
+        memory.append((
+            game.get_encoded_state(neutral_state),
+            action_probs,
+            player
+        ))
+        if chosen_action is not None:
+            # a Gumbel search already sampled the move
+            action = chosen_action
+        else:
+            action = numpy.random.choice(
+                game.actions,
+                p = action_probs
+            )
+        state = game.step(state, action, player)
+        if session is not None:
+            session.advance(action)
+        episodes += 1
+        value, is_terminal = game.terminated(
+            state,
+            action
+        )
+        if is_terminal:
+            returnMemory = []
+            for hist_encoded_state, hist_action_probs, hist_player in memory:
+                if hist_player == player:
+                    hist_outcome = value
+                else:
+                    hist_outcome = -value
+                returnMemory.append((
+                    hist_encoded_state,
+                    hist_action_probs,
+                    hist_outcome
+                ))
+            return returnMemory, episodes
+        player = -player
+
+
+class LockstepSelfPlay:
+    """Plays up to `parallel_games` self-play games at once
+
+    Every game is a `self_play_steps` generator. In each round the
+    pending leaf batches of all running games are concatenated and
+    evaluated in a single forward pass of the model, then every game
+    gets its slice of the output back and runs on to its next request.
+    A finished game is replaced by a new one until `count` games have
+    been played.
+    """
+    def __init__(self, game, args, mcts, parallel_games=None):
+        self.game = game
+        self.args = args
+        self.mcts = mcts
+        if parallel_games is None:
+            parallel_games = args.get('parallel_games', 1)
+        self.parallel_games = max(1, int(parallel_games))
+        self.forward_passes = 0
+        self.evaluated_states = 0
+
+    def start(self):
+        return self_play_steps(self.game, self.args, self.mcts)
+
+    @torch.no_grad()
+    def play(self, count, on_finished=None):
+        """Plays `count` games, returns their memory in finishing order
+
+        `on_finished(memory, episodes)` is called for every game when
+        it ends.
+        """
+        results = []
+        started = 0
+        running = []
+
+        def finish(result):
+            if on_finished is not None:
+                on_finished(*result)
+            results.append(result)
+
+        def launch():
+            # first request of a new game, None when it needs none
+            nonlocal started
+            while started < count:
+                started += 1
+                steps = self.start()
+                try:
+                    running.append((steps, next(steps)))
+                    return
+                except StopIteration as stop:
+                    finish(stop.value)
+
+        for _ in range(min(self.parallel_games, count)):
+            launch()
+
+        while running:
+            sizes = [len(batch) for _, batch in running]
+            logits, values = self.mcts.evaluate(numpy.concatenate(
+                [batch for _, batch in running]
+            ))
+            self.forward_passes += 1
+            self.evaluated_states += len(values)
+            offsets = numpy.cumsum([0] + sizes)
+            waiting = []
+            for (steps, _), start, stop in zip(
+                    running, offsets[:-1], offsets[1:]):
+                try:
+                    waiting.append((steps, steps.send((
+                        logits[start:stop],
+                        values[start:stop]
+                    ))))
+                except StopIteration as stop_game:
+                    finish(stop_game.value)
+            running[:] = waiting
+            for _ in range(self.parallel_games - len(running)):
+                launch()
+        return results
@@ -0,0 +1,354 @@
+"""
+description: Array-backed search tree for Monte Carlo Tree Search.
+secondary author: Tim Straube
+licence: MIT
+"""
+
+import numpy
+from collections import OrderedDict
+from agents.alphazero.puct import select_child
+
+class Tree:
+    """Struct-of-arrays search tree
+
+    Node statistics live in preallocated numpy arrays indexed by node id,
+    the root is node 0. The children of a node occupy the contiguous id
+    range [first_child, first_child + num_children). A node's value_sum
+    is stored from the perspective of the player to move at the node
+    (the node's own player), so `select` maps a child's mean value
+    from [-1, 1] to [1, 0] for the parent, see puct.py.
+
+    Expansion only records (action, prior) of the children. The game
+    state of a child is built from its parent's state the first time it
+    is needed (`state`), so most children of a wide node never cost a
+    state copy and a game step.
+
+    With args['transpositions'] the tree becomes a DAG: a leaf whose
+    position (Zobrist hash) was already expanded elsewhere shares that
+    node's children block instead of growing its own (`transpose`).
+    A shared child has one `parent`, so backups follow the path of the
+    simulation rather than the parent links. The table of expanded
+    positions holds at most args['tt_size'] entries and forgets the
+    least recently used one first; a forgotten position is just not
+    shared any more.
+
+    Below the root, expansion can be narrowed (see `expand`): children
+    are then stored in descending prior order, cut to the top
+    args['expand_top_k'] or to args['expand_prior_mass'] of the prior,
+    and with args['widening'] only the first ceil(c * N ** alpha) of
+    them are selectable at a node with N visits. A narrowed node that
+    becomes the root of a reused tree gets all of its legal moves back.
+    """
+    def __init__(self, game, args, state, capacity=None):
+        self.game = game
+        self.args = args
+        if capacity is None:
+            capacity = 1 + game.actions * (args['num_searches'] + 1)
+        self.capacity = 0
+        self.visit_count = numpy.zeros(0, dtype=numpy.int64)
+        self.value_sum = numpy.zeros(0, dtype=numpy.float64)
+        self.prior = numpy.zeros(0, dtype=numpy.float64)
+        self.parent = numpy.zeros(0, dtype=numpy.int64)
+        self.first_child = numpy.zeros(0, dtype=numpy.int64)
+        self.num_children = numpy.zeros(0, dtype=numpy.int64)
+        self.action = numpy.zeros(0, dtype=numpy.int64)
+        # pending evaluations passing through a node, see add_virtual_loss
+        self.virtual = numpy.zeros(0, dtype=numpy.int64)
+        self.pending = 0
+        # position hash per node, -1 until computed
+        self.key = numpy.zeros(0, dtype=numpy.int64)
+        self.table = OrderedDict() if args.get('transpositions', False) else None
+        self.table_size = int(args.get('tt_size', 100_000))
+        self.aliases = 0
+        self.top_k = int(args.get('expand_top_k', 0) or 0)
+        self.prior_mass = float(args.get('expand_prior_mass', 1.0) or 1.0)
+        self.widening = float(args.get('widening', 0) or 0)
+        self.widening_alpha = float(args.get('widening_alpha', 0.5))
+        self.narrow = self.top_k > 0 or self.prior_mass < 1 or self.widening > 0
+        # (actions, priors) of all legal moves of the nodes expansion
+        # narrowed, restored when one becomes the root, see subtree
+        self.unpruned = {}
+        self.states = []
+        self.grow(capacity)
+        self.size = 1
+        self.states[0] = state
+        self.visit_count[0] = 1
+        # noise-free priors of the root's children, see MCTS.add_noise
+        self.root_prior = None
+        # network value of the root and results of MCTS.gumbel_steps
+        self.root_value = None
+        self.chosen_action = None
+        self.policy_target = None
+
+    def __len__(self):
+        return self.size
+
+    def grow(self, capacity):
+        """Enlarge the preallocated arrays to hold `capacity` nodes
+        """
+        if capacity <= self.capacity:
+            return
+        capacity = max(capacity, 2 * self.capacity)
+        extra = capacity - self.capacity
+        self.visit_count = numpy.concatenate(
+            (self.visit_count, numpy.zeros(extra, dtype=numpy.int64))
+        )
+        self.value_sum = numpy.concatenate(
+            (self.value_sum, numpy.zeros(extra, dtype=numpy.float64))
+        )
+        self.prior = numpy.concatenate(
+            (self.prior, numpy.zeros(extra, dtype=numpy.float64))
+        )
+        self.parent = numpy.concatenate(
+            (self.parent, numpy.full(extra, -1, dtype=numpy.int64))
+        )
+        self.first_child = numpy.concatenate(
+            (self.first_child, numpy.full(extra, -1, dtype=numpy.int64))
+        )
+        self.num_children = numpy.concatenate(
+            (self.num_children, numpy.zeros(extra, dtype=numpy.int64))
+        )
+        self.action = numpy.concatenate(
+            (self.action, numpy.full(extra, -1, dtype=numpy.int64))
+        )
+        self.virtual = numpy.concatenate(
+            (self.virtual, numpy.zeros(extra, dtype=numpy.int64))
+        )
+        self.key = numpy.concatenate(
+            (self.key, numpy.full(extra, -1, dtype=numpy.int64))
+        )
+        self.states.extend([None] * extra)
+        self.capacity = capacity
+
+    def is_expanded(self, node):
+        return self.num_children[node] > 0
+
+    def children(self, node):
+        first = self.first_child[node]
+        return range(first, first + self.num_children[node])
+
+    def child(self, node, action):
+        """Id of the child reached by `action`, -1 if there is none
+        """
+        first = int(self.first_child[node])
+        last = first + int(self.num_children[node])
+        match = numpy.flatnonzero(self.action[first:last] == action)
+        return first + int(match[0]) if len(match) else -1
+
+    def subtree(self, node):
+        """New tree holding the subtree below `node`, with `node` as root
+        """
+        tree = Tree(self.game, self.args, self.state(node), self.capacity)
+        tree.visit_count[0] = self.visit_count[node]
+        tree.value_sum[0] = self.value_sum[node]
+        tree.prior[0] = self.prior[node]
+        tree.key[0] = self.key[node]
+        # children blocks copied so far, shared blocks stay shared
+        blocks = {}
+        queue = [(node, 0)]
+        while queue:
+            old, new = queue.pop()
+            count = int(self.num_children[old])
+            if old in self.unpruned and new != 0:
+                tree.unpruned[new] = self.unpruned[old]
+            if count == 0:
+                continue
+            first = int(self.first_child[old])
+            if first in blocks:
+                tree.first_child[new] = blocks[first]
+                tree.num_children[new] = count
+                tree.aliases += 1
+                continue
+            new_first = tree.size
+            blocks[first] = new_first
+            tree.size += count
+            old_children = slice(first, first + count)
+            new_children = slice(new_first, new_first + count)
+            tree.visit_count[new_children] = self.visit_count[old_children]
+            tree.value_sum[new_children] = self.value_sum[old_children]
+            tree.prior[new_children] = self.prior[old_children]
+            tree.action[new_children] = self.action[old_children]
+            tree.key[new_children] = self.key[old_children]
+            tree.parent[new_children] = new
+            tree.states[new_children] = self.states[old_children]
+            tree.first_child[new] = new_first
+            tree.num_children[new] = count
+            queue.extend(zip(
+                range(first, first + count),
+                range(new_first, new_first + count)
+            ))
+            if new == 0 and old in self.unpruned:
+                tree.restore_root(*self.unpruned[old])
+        if tree.table is not None:
+            for new in range(tree.size):
+                if tree.key[new] >= 0 and tree.is_expanded(new):
+                    tree.table.setdefault(int(tree.key[new]), new)
+        return tree
+
+    def restore_root(self, actions, priors):
+        """Gives the root a child for every one of the legal `actions`
+
+        The moves expansion cut off are appended as unvisited children
+        and all children get their priors before narrowing back. The
+        root's block has to be the last one allocated.
+        """
+        first = int(self.first_child[0])
+        count = int(self.num_children[0])
+        policy = numpy.zeros(self.game.actions)
+        policy[actions] = priors
+        missing = numpy.setdiff1d(actions, self.action[first:first + count])
+        self.grow(first + count + len(missing))
+        added = slice(first + count, first + count + len(missing))
+        self.parent[added] = 0
+        self.action[added] = missing
+        self.num_children[0] = count + len(missing)
+        self.size = first + count + len(missing)
+        children = slice(first, self.size)
+        self.prior[children] = policy[self.action[children]]
+
+    def widened(self, node):
+        """Number of selectable children, all of them without widening
+        """
+        count = int(self.num_children[node])
+        if self.widening <= 0 or node == 0:
+            return count
+        return min(count, max(1, int(numpy.ceil(
+            self.widening * self.visit_count[node] ** self.widening_alpha
+        ))))
+
+    def select(self, node):
+        first = int(self.first_child[node])
+        last = first + self.widened(node)
+        visit_count = self.visit_count[first:last]
+        value_sum = self.value_sum[first:last]
+        parent_visits = self.visit_count[node]
+        if self.aliases:
+            # visits reaching a shared block through other parents count too
+            parent_visits = max(parent_visits, 1 + int(visit_count.sum()))
+        if self.pending:
+            # a virtual loss counts as a visit won by the child's player
+            virtual = self.virtual[first:last]
+            visit_count = visit_count + virtual
+            value_sum = value_sum + virtual
+            parent_visits = parent_visits + self.virtual[node]
+        return first + select_child(
+            visit_count,
+            value_sum,
+            self.prior[first:last],
+            parent_visits,
+            self.args['C'],
+            self.args.get('compiled_puct', True)
+        )
+
+    def expand(self, node, policy):
+        actions = numpy.flatnonzero(policy > 0)
+        if self.narrow and node != 0 and len(actions):
+            legal = actions
+            actions = actions[numpy.argsort(-policy[actions], kind='stable')]
+            if self.top_k > 0:
+                actions = actions[:self.top_k]
+            if self.prior_mass < 1:
+                mass = numpy.cumsum(policy[actions])
+                actions = actions[:int(numpy.searchsorted(
+                    mass,
+                    self.prior_mass * mass[-1]
+                )) + 1]
+            if len(actions) < len(legal):
+                self.unpruned[node] = (legal, policy[legal].copy())
+            # renormalized over the children that are kept
+            kept = policy[actions]
+            policy = numpy.zeros_like(policy)
+            policy[actions] = kept / kept.sum()
+        count = len(actions)
+        first = self.size
+        self.grow(first + count)
+        last = first + count
+        self.parent[first:last] = node
+        self.action[first:last] = actions
+        self.prior[first:last] = policy[actions]
+        self.first_child[node] = first
+        self.num_children[node] = count
+        self.size = last
+        if self.table is not None and self.key[node] >= 0:
+            self.table[int(self.key[node])] = node
+            self.table.move_to_end(int(self.key[node]))
+            if len(self.table) > self.table_size:
+                self.table.popitem(last=False)
+        return last - 1
+
+    def transpose(self, node):
+        """Links the leaf `node` to an expanded node of the same position
+
+        Returns True when `node` now shares that node's children, so the
+        selection can go on below it without evaluating the leaf.
+        """
+        if self.table is None:
+            return False
+        if self.key[node] < 0:
+            self.key[node] = self.game.position_hash(self.state(node))
+        other = self.table.get(int(self.key[node]))
+        if other is None or other == node or not self.is_expanded(other):
+            return False
+        self.table.move_to_end(int(self.key[node]))
+        self.first_child[node] = self.first_child[other]
+        self.num_children[node] = self.num_children[other]
+        self.aliases += 1
+        return True
+
+    def state(self, node):
+        """Game state of a node, materialized from its parent on first use
+        """
+        state = self.states[node]
+        if state is None:
+            state = self.state(self.parent[node]).copy()
+            state = self.game.step(state, int(self.action[node]), 1)
+            state = self.game.change_perspective(state, player=-1)
+            self.states[node] = state
+        return state
+
+    def path(self, node):
+        """Root to `node` along the parent links
+        """
+        path = []
+        while node >= 0:
+            path.append(int(node))
+            node = self.parent[node]
+        return path[::-1]
+
+    def add_virtual_loss(self, node, path=None):
+        self.pending += 1
+        for node in (self.path(node) if path is None else path):
+            self.virtual[node] += 1
+
+    def remove_virtual_loss(self, node, path=None):
+        self.pending -= 1
+        for node in (self.path(node) if path is None else path):
+            self.virtual[node] -= 1
+
+    def backpropagate(self, node, value, path=None):
+        """Backs `value` of `node` up to the root
+
+        `path` is the root to `node` list of the simulation; without it
+        the parent links are followed, which is only right in a tree.
+        """
+        if path is None:
+            path = self.path(node)
+        for node in reversed(path):
+            self.value_sum[node] += value
+            self.visit_count[node] += 1
+            value = -value
+
+    def action_probs(self, node=0):
+        """Visit count distribution over all actions of the node's children
+
+        At the root of a Gumbel search the completed-Q policy target.
+        """
+        if node == 0 and self.policy_target is not None:
+            return self.policy_target.copy()
+        children = self.children(node)
+        action_probs = numpy.zeros(self.game.actions)
+        action_probs[self.action[children.start:children.stop]] = (
+            self.visit_count[children.start:children.stop]
+        )
+        action_probs /= numpy.sum(action_probs)
+        return action_probs
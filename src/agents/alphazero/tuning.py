@@ -0,0 +1,104 @@
+"""
+description: Machine specific inference profiles written by util/autotune.py.
+secondary author: Tim Straube
+licence: MIT
+"""
+
+import json
+import os
+import torch
+
+# relative profile paths are looked up here too, whatever the working directory is
+REPOSITORY_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "..",
+    "..",
+    ".."
+)
+# where util/autotune.py writes the profile by default
+PROFILE_PATH = os.path.normpath(os.path.join(REPOSITORY_DIR, "inference_profile.json"))
+
+# args entries a profile sets, see apply_profile
+PROFILE_KEYS = (
+    'backend',
+    'inference_mode',
+    'backend_threads',
+    'backend_inter_threads',
+    'graph_optimization',
+    'io_binding',
+)
+
+def set_threads(threads=None, inter_threads=None):
+    """Sizes the torch thread pools of this process
+
+    The inter-op pool can only be sized before its first use, later
+    calls keep the size it already has.
+    """
+    if threads:
+        torch.set_num_threads(int(threads))
+    if inter_threads:
+        try:
+            torch.set_num_interop_threads(int(inter_threads))
+        except RuntimeError:
+            pass
+
+def network_config(size, resblocks, hiddenlayers, inputarrays):
+    return {
+        'size': int(size),
+        'resblocks': int(resblocks),
+        'hiddenlayers': int(hiddenlayers),
+        'inputarrays': int(inputarrays),
+    }
+
+def resolve_profile(path):
+    """`path`, or the same relative path below the repository root when
+    it does not exist relative to the working directory
+    """
+    if path and not os.path.isabs(path) and not os.path.exists(path):
+        return os.path.normpath(os.path.join(REPOSITORY_DIR, path))
+    return path
+
+def load_profile(path):
+    """The profile at `path` (see resolve_profile), None when there is none
+    """
+    path = resolve_profile(path)
+    if not path or not os.path.exists(path):
+        return None
+    with open(path) as file:
+        return json.load(file)
+
+def apply_profile(args, profile, config=None, explicit=()):
+    """Copies the tuned settings of `profile` into `args`
+
+    Sets the backend and its thread counts, sizes the torch thread
+    pools of this process and turns the tuned batch size into
+    args['parallel_games'] (lockstep rounds of about that many leaves)
+    and args['server_max_batch']. Entries named in `explicit`, the
+    options the user set, keep their value; the profile settings they
+    override are printed. A profile tuned for another network `config`
+    is applied anyway, with a warning.
+    """
+    best = profile['best']
+    if config is not None and profile.get('config') != config:
+        print(
+            f"Inference profile was tuned for {profile.get('config')}, "
+            f"not {config}"
+        )
+    batch_size = int(best.get('batch_size', 1))
+    settings = {key: best[key] for key in PROFILE_KEYS if key in best}
+    settings['parallel_games'] = max(1, batch_size // args.get('leaf_batch', 1))
+    settings['server_max_batch'] = batch_size
+    overridden = []
+    for key, value in settings.items():
+        if key in explicit:
+            if args.get(key) != value:
+                overridden.append(f"{key}={args.get(key)!r} (profile {value!r})")
+        else:
+            args[key] = value
+    if overridden:
+        print(f"Explicit options override the inference profile: {', '.join(overridden)}")
+    set_threads(
+        None if 'backend_threads' in explicit else best.get('threads'),
+        None if 'backend_inter_threads' in explicit else best.get('inter_threads')
+    )
+    return args
@@ -0,0 +1,270 @@
+"""
+description: Process pool running self-play games with shared memory weights.
+secondary author: Tim Straube
+licence: MIT
+"""
+
+import concurrent.futures
+import math
+import multiprocessing
+import random
+import numpy
+import torch
+from multiprocessing import shared_memory
+from agents.alphazero.backends import backend_args
+from agents.alphazero.cache import combine_stats
+from agents.alphazero.inference import InferenceClient, InferenceServer
+from agents.alphazero.mcts import MCTS
+from agents.alphazero.residualnetwork import ResidualNetwork
+from agents.alphazero.selfplay import LockstepSelfPlay
+
+# int64 version counter in front of the tensors
+HEADER_BYTES = 8
+
+class SharedWeights:
+    """`state_dict` of a model in one shared memory block
+
+    The block starts with a version counter followed by every tensor
+    of the state dict at a fixed offset (`layout`). The trainer
+    `publish`es new weights in place and bumps the version, workers
+    attached by name copy them into their model when the version they
+    loaded is outdated. Nothing is pickled per task.
+    """
+    def __init__(self, name, layout, create=False, size=0):
+        self.layout = layout
+        if create:
+            self.memory = shared_memory.SharedMemory(
+                create=True,
+                size=size
+            )
+        else:
+            try:
+                # the creating process owns the block and unlinks it
+                self.memory = shared_memory.SharedMemory(name=name, track=False)
+            except TypeError:
+                self.memory = shared_memory.SharedMemory(name=name)
+        self.name = self.memory.name
+        self.owner = create
+
+    @classmethod
+    def create(cls, state_dict):
+        layout = []
+        offset = HEADER_BYTES
+        for key, tensor in state_dict.items():
+            array = tensor.detach().cpu().numpy()
+            layout.append((key, array.dtype.str, array.shape, offset))
+            # keep every tensor 8 byte aligned
+            offset += -(-array.nbytes // 8) * 8
+        weights = cls(None, tuple(layout), create=True, size=max(offset, HEADER_BYTES))
+        weights.publish(state_dict)
+        return weights
+
+    def attach(self):
+        """Arguments to attach to this block from another process
+        """
+        return self.name, self.layout
+
+    @property
+    def version(self):
+        return int(numpy.ndarray(1, numpy.int64, self.memory.buf)[0])
+
+    def array(self, key, dtype, shape, offset):
+        return numpy.ndarray(shape, numpy.dtype(dtype), self.memory.buf, offset)
+
+    def publish(self, state_dict):
+        for key, dtype, shape, offset in self.layout:
+            self.array(key, dtype, shape, offset)[...] = (
+                state_dict[key].detach().cpu().numpy()
+            )
+        numpy.ndarray(1, numpy.int64, self.memory.buf)[0] += 1
+
+    def load_into(self, model):
+        """Copies the weights into `model`, returns the loaded version
+        """
+        version = self.version
+        model.load_state_dict({
+            key: torch.from_numpy(self.array(key, dtype, shape, offset))
+            for key, dtype, shape, offset in self.layout
+        })
+        return version
+
+    def close(self):
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+
+# per process state of a worker, see _init_worker
+_worker = {}
+
+def _init_worker(
+    game_config,
+    model_config,
+    args,
+    weights,
+    seed,
+    counter,
+    server=None):
+    game_class, size, ship_sizes, encoded_dtype = game_config
+    with counter.get_lock():
+        index = counter.value
+        counter.value += 1
+    # every worker draws its own games
+    worker_seed = (seed + index) % 2**32
+    random.seed(worker_seed)
+    numpy.random.seed(worker_seed)
+    torch.manual_seed(worker_seed)
+    # the workers already use every core, one thread each
+    torch.set_num_threads(1)
+    args = dict(args, backend_threads=1, backend_inter_threads=1)
+    game = game_class(
+        size,
+        ship_sizes=ship_sizes,
+        encoded_dtype=encoded_dtype
+    )
+    if server is not None:
+        # the inference server holds the only model
+        model = None
+        mcts = MCTS(game, args, None, InferenceClient(index, *server))
+    else:
+        model = ResidualNetwork(
+            game,
+            *model_config,
+            torch.device("cpu")
+        )
+        model.eval()
+        mcts = MCTS(game, args, model)
+    _worker.update(
+        index=index,
+        seed=worker_seed,
+        model=model,
+        weights=SharedWeights(*weights),
+        version=-1,
+        cache=mcts.cache,
+        lockstep=LockstepSelfPlay(game, args, mcts)
+    )
+
+def _play_games(count):
+    """Task of a worker, `count` self-play games with the latest weights
+
+    Returns the worker's index and evaluation cache statistics (None
+    without a cache) along with the games.
+    """
+    weights = _worker['weights']
+    if weights.version != _worker['version']:
+        if _worker['model'] is not None:
+            _worker['version'] = weights.load_into(_worker['model'])
+        else:
+            _worker['version'] = weights.version
+        if _worker['cache'] is not None:
+            _worker['cache'].sync(_worker['version'])
+    games = _worker['lockstep'].play(count)
+    cache = _worker['cache']
+    return _worker['index'], None if cache is None else cache.stats(), games
+
+
+class SelfPlayPool:
+    """Fans self-play games out over `workers` processes
+
+    Every worker builds its own game, model and `LockstepSelfPlay` and
+    gets the weights from a `SharedWeights` block, so a task is just a
+    game count. Call `publish` after every training phase.
+
+    With args['inference_server'] the workers keep no model and send
+    their leaf batches to one `InferenceServer` process instead, which
+    batches the requests of all workers.
+    """
+    def __init__(
+        self,
+        game,
+        model,
+        model_config,
+        args,
+        workers,
+        seed=None):
+
+        self.workers = max(1, int(workers))
+        self.args = args
+        if seed is None:
+            seed = random.randrange(2**31)
+        self.weights = SharedWeights.create(model.state_dict())
+        context = multiprocessing.get_context("spawn")
+        self.counter = context.Value("i", 0)
+        # latest evaluation cache statistics of every worker
+        self.worker_cache_stats = {}
+        self.server = None
+        server = None
+        if args.get('inference_server', False):
+            self.server = InferenceServer(
+                game,
+                model_config,
+                self.weights,
+                self.workers,
+                # largest batch of a worker's lockstep round
+                args.get('parallel_games', 1) * args.get('leaf_batch', 1),
+                args.get('server_max_batch', 256),
+                args.get('server_max_wait_ms', 2) / 1000,
+                backend=backend_args(args),
+                context=context
+            )
+            server = self.server.client_args()
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=context,
+            initializer=_init_worker,
+            initargs=(
+                (type(game), game.size, game.ship_sizes, game.encoded_dtype),
+                tuple(model_config),
+                dict(args),
+                self.weights.attach(),
+                int(seed),
+                self.counter,
+                server
+            )
+        )
+
+    def publish(self, model):
+        self.weights.publish(model.state_dict())
+
+    def play(self, count, on_finished=None):
+        """Plays `count` games, returns `(memory, episodes)` per game
+
+        The games are split into tasks of at most `parallel_games`
+        games so faster workers pick up more of them.
+        """
+        per_task = max(1, min(
+            self.args.get('parallel_games', 1),
+            math.ceil(count / self.workers)
+        ))
+        tasks = []
+        while count > 0:
+            tasks.append(self.executor.submit(
+                _play_games,
+                min(per_task, count)
+            ))
+            count -= per_task
+        results = []
+        for task in concurrent.futures.as_completed(tasks):
+            index, cache_stats, games = task.result()
+            self.worker_cache_stats[index] = cache_stats
+            for memory, episodes in games:
+                if on_finished is not None:
+                    on_finished(memory, episodes)
+                results.append((memory, episodes))
+        return results
+
+    def stats(self):
+        """Batching statistics of the inference server, None without one
+        """
+        return None if self.server is None else self.server.stats()
+
+    def cache_stats(self):
+        """Evaluation cache statistics summed over the workers, None without caches
+        """
+        return combine_stats(self.worker_cache_stats.values())
+
+    def close(self):
+        self.executor.shutdown()
+        if self.server is not None:
+            self.server.close()
+        self.weights.close()
@@ -10,13 +10,15 @@ except Exception:
         SummaryWriter = None
 
 from envs.battleship import Battleship
+from envs.batched import BatchedBattleship
 
 class RandomAgent:
-    def __init__(self, model_id="random", size=5, episodes=100, window: int = 100):
+    def __init__(self, model_id="random", size=5, episodes=100, window: int = 100, batch: int = 1):
         self.model_id = model_id
         self.size = int(size)
         self.episodes = int(episodes)
         self.window = int(window)
+        self.batch = max(1, int(batch))
         # create per-run log directory logs/<model_id>/<model_id>_N
         base_log = os.path.join("logs", model_id)
         try:
@@ -64,10 +66,33 @@ class RandomAgent:
                 return steps
             player = -player
 
+    def play_batched(self, episodes):
+        # plays `episodes` games on `batch` lanes of a batched env, finished lanes restart automatically
+        env = BatchedBattleship(self.size, min(self.batch, episodes))
+        players = np.ones(env.games, dtype=np.int64)
+        # lanes whose current game counts, a lane retires once all games are started
+        active = np.ones(env.games, dtype=bool)
+        started = env.games
+        lengths = []
+        while active.any():
+            valid_mask = env.valid_moves_many(players)
+            # uniform choice among valid moves: random scores, invalid moves scored 0
+            action = np.argmax(np.random.random(valid_mask.shape) * valid_mask, axis=1)
+            value, is_terminal = env.step_many(action, players)
+            for lane in np.flatnonzero(is_terminal & active):
+                lengths.append(int(env.final_moves[lane]))
+                if started < episodes:
+                    started += 1
+                else:
+                    active[lane] = False
+            players = np.where(is_terminal, 1, -players)
+        return lengths
+
     def run(self):
         lengths = []
+        batched = self.play_batched(self.episodes) if self.batch > 1 else None
         for i in range(self.episodes):
-            l = self.play_one()
+            l = batched[i] if batched is not None else self.play_one()
             lengths.append(l)
             print(f"Episode {i+1}/{self.episodes}: {l} actions")
             if self.writer is not None:
@@ -92,11 +117,12 @@ def _parse_args():
     p.add_argument("--size", type=int, default=5)
     p.add_argument("--episodes", type=int, default=100)
     p.add_argument("--window", type=int, default=100)
+    p.add_argument("--batch", type=int, default=1, help="number of games simulated at once")
     return p.parse_args()
 
 
 if __name__ == "__main__":
     args = _parse_args()
-    agent = RandomAgent(model_id=args.model_id, size=args.size, episodes=args.episodes, window=args.window)
+    agent = RandomAgent(model_id=args.model_id, size=args.size, episodes=args.episodes, window=args.window, batch=args.batch)
     avg = agent.run()
     print(f"Final average episode length: {avg}")
\ No newline at end of file
@@ -0,0 +1,166 @@
+"""
+description: Batched Battleship environment holding many games in one array.
+author: Tim Straube
+licence: MIT
+"""
+
+import numpy
+from envs.battleship import Battleship
+
+class BatchedBattleship:
+    """B independent Battleship games stored in one (B, 6, N, N) array
+
+    The layer layout of every game is the one of `Battleship`. All
+    methods take one action / player per game and work on the whole
+    batch at once, so the per-move Python overhead is paid once per
+    batch instead of once per game. Finished games are restarted by
+    `step_many` when `auto_reset` is set.
+
+    `remaining` holds the ship cells not yet hit of player -1 and
+    player 1 per game, so terminal detection never scans the boards.
+    """
+    def __init__(
+        self,
+        size,
+        games,
+        auto_reset=True,
+        debug=False,
+        ship_sizes=None,
+        check=False,
+        encoded_dtype=numpy.float32):
+
+        self.game = Battleship(size, debug, ship_sizes, check, encoded_dtype)
+        self.check = check
+        self.layouts = self.game.layouts
+        self.num_shipparts = self.game.num_shipparts
+        self.size = size
+        self.rows = size
+        self.columns = size
+        self.actions = self.game.actions
+        self.games = int(games)
+        self.auto_reset = auto_reset
+        self.index = numpy.arange(self.games)
+        self.states = numpy.zeros(
+            (self.games, 6, self.columns, self.rows),
+            dtype=numpy.uint8
+        )
+        self.moves = numpy.zeros(self.games, dtype=numpy.int64)
+        self.final_moves = numpy.zeros(self.games, dtype=numpy.int64)
+        self.repeat = numpy.zeros(self.games, dtype=bool)
+        self.remaining = numpy.zeros((self.games, 2), dtype=numpy.int64)
+        self.reset_many()
+
+    def __repr__(self):
+        return f"battleship_batched[{self.games}]"
+
+    def _players(self, players):
+        if players is None:
+            return numpy.ones(self.games, dtype=bool)
+        return numpy.asarray(players) > 0
+
+    def reset_many(self, indices=None):
+        """Restart the given games (all games if `indices` is None)
+        """
+        if indices is None:
+            indices = self.index
+        indices = numpy.asarray(indices).reshape(-1)
+        self.states[indices] = 0
+        for layer in (0, 3):
+            ships = self.layouts.fleet_planes(
+                self.layouts.sample_many(len(indices))
+            )
+            self.states[indices, layer] = (
+                ships.reshape(-1, self.columns, self.rows) * numpy.uint8(255)
+            )
+        self.moves[indices] = 0
+        self.repeat[indices] = False
+        self.remaining[indices] = self.num_shipparts
+        return self.states
+
+    def step_many(self, actions, players):
+        """Play one action per game for the given player of each game
+
+        Returns the value and terminal flag of every game as
+        `Battleship.terminated` does. `repeat` holds which games hit a
+        ship, `final_moves` the episode length of the games that just
+        finished (before they were restarted).
+        """
+        actions = numpy.asarray(actions, dtype=numpy.int64)
+        positive = self._players(players)
+        x = actions // self.size
+        y = actions % self.size
+        # hitIndex(player) and shipIndex(-player) per game
+        hit_layer = 3 * positive + 1
+        ship_layer = 3 * ~positive
+
+        fresh = self.states[self.index, hit_layer, x, y] == 0
+        ship = self.states[self.index, ship_layer, x, y] == 255
+        self.states[
+            self.index[fresh], hit_layer[fresh], x[fresh], y[fresh]
+        ] = 255
+        self.repeat = fresh & ship
+        self.states[
+            self.index[self.repeat],
+            hit_layer[self.repeat] + 1,
+            x[self.repeat],
+            y[self.repeat]
+        ] = 255
+        # hits of player 1 sink the fleet of player -1 (column 0) and vice versa
+        self.remaining[
+            self.index[self.repeat],
+            (~positive[self.repeat]).astype(numpy.int64)
+        ] -= 1
+        self.moves += 1
+
+        values, terminated = self.terminated_many()
+        self.final_moves = numpy.where(terminated, self.moves, 0)
+        if self.auto_reset and terminated.any():
+            self.reset_many(numpy.flatnonzero(terminated))
+        return values, terminated
+
+    def valid_moves_many(self, players):
+        """(B, actions) uint8 mask of cells not yet fired at per player
+        """
+        hit_layer = 3 * self._players(players) + 1
+        return (
+            self.states[self.index, hit_layer] == 0
+        ).astype(numpy.uint8).reshape(self.games, self.actions)
+
+    def count_remaining(self):
+        """Full board computation of `remaining`
+        """
+        # player 1 fires on the ships of player -1 and vice versa
+        hits_positive = numpy.count_nonzero(
+            self.states[:, 4] & self.states[:, 0], axis=(1, 2)
+        )
+        hits_negative = numpy.count_nonzero(
+            self.states[:, 1] & self.states[:, 3], axis=(1, 2)
+        )
+        return self.num_shipparts - numpy.stack(
+            (hits_positive, hits_negative), axis=1
+        )
+
+    def terminated_many(self):
+        """Value and terminal flag of every game
+        """
+        if self.check and not numpy.array_equal(
+                self.remaining, self.count_remaining()):
+            raise RuntimeError("Remaining ship cells out of sync with the boards")
+        terminated = (self.remaining == 0).any(axis=1)
+        return terminated.astype(numpy.int64), terminated
+
+    def encode_many(self, players=None):
+        """(B, 4, N, N) network input in the dtype of the env
+
+        With `players` every game is encoded from the perspective of
+        its player, i.e. as `get_encoded_state(change_perspective(...))`
+        of `Battleship` would, ready for one batched forward pass.
+        """
+        order = numpy.where(
+            self._players(players)[:, None],
+            numpy.array([1, 2, 4, 5]),
+            numpy.array([4, 5, 1, 2])
+        )
+        return (
+            self.states[self.index[:, None], order] == 255
+        ).astype(self.game.encoded_dtype)
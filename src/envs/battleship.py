@@ -4,11 +4,103 @@ author: Tim Straube
 licence: MIT
 """
 
+import os
+import json
 import numpy
-import random
+from envs.layouts import get_layouts
+
+HYPERPARAMETER_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "..",
+    "..",
+    "hyperparameter.json"
+)
+
+# seed of the Zobrist keys, identical for every process and engine
+ZOBRIST_SEED = 0x5EED
+
+def zobrist_keys(size):
+    """(6, size * size) random 63 bit keys, one per layer and cell
+    """
+    return numpy.random.default_rng(ZOBRIST_SEED + size).integers(
+        0,
+        2**63,
+        size=(6, size * size),
+        dtype=numpy.int64
+    )
+
+def default_ship_sizes():
+    """Ship lengths from `envs.battleship.ship_sizes` in hyperparameter.json
+    """
+    try:
+        with open(HYPERPARAMETER_PATH) as file:
+            return list(json.load(file)["envs"]["battleship"]["ship_sizes"])
+    except Exception:
+        return [4, 3, 2]
+
+class BattleshipState(numpy.ndarray):
+    """6xNxN uint8 state array carrying incremental ship bookkeeping
+
+    Lists are indexed like `Battleship.ships`, i.e. by int(player > 0)
+    of the player owning the fleet:
+    remaining: ship cells not yet hit per player
+    ship_left: cells not yet hit of every ship, in `ship_sizes` order
+    ship_ids: (2, N, N) int8 ship index per cell, -1 for water. It never
+    changes after the ships are placed and is shared between copies.
+
+    `perspective` is -1 for a view returned by `change_perspective`:
+    the data is not swapped, instead `Battleship` maps player p to the
+    stored player p * perspective whenever it reads or writes a layer.
+
+    `planes` holds the network input kept up to date by `step`, laid out
+    as (hit, knowledge) of player -1, of player 1 and of player -1
+    again, so the encoding of either perspective is a slice of it.
+
+    `zobrist` is the Zobrist hash of the stored layers followed by the
+    hash of the same layers with both players swapped, so views of
+    either perspective read their hash from the one shared list.
+    """
+    def __array_finalize__(self, obj):
+        self.perspective = getattr(obj, "perspective", 1)
+        self.remaining = getattr(obj, "remaining", None)
+        self.ship_left = getattr(obj, "ship_left", None)
+        self.ship_ids = getattr(obj, "ship_ids", None)
+        self.planes = getattr(obj, "planes", None)
+        self.zobrist = getattr(obj, "zobrist", None)
+
+    def __reduce__(self):
+        # ndarray pickles the data only, keep the bookkeeping too
+        reconstruct, arguments, state = super().__reduce__()
+        return reconstruct, arguments, (state, dict(self.__dict__))
+
+    def __setstate__(self, state):
+        array_state, attributes = state
+        super().__setstate__(array_state)
+        self.__dict__.update(attributes)
+
+    def copy(self, order="C"):
+        state = super().copy(order)
+        if self.planes is not None:
+            state.planes = self.planes.copy()
+        if self.remaining is not None:
+            state.remaining = list(self.remaining)
+            state.ship_left = [
+                list(self.ship_left[0]),
+                list(self.ship_left[1])
+            ]
+        if self.zobrist is not None:
+            state.zobrist = list(self.zobrist)
+        return state
 
 class Battleship:
-    def __init__(self, size, debug=False):
+    def __init__(
+        self,
+        size,
+        debug=False,
+        ship_sizes=None,
+        check=False,
+        encoded_dtype=numpy.float32):
+
         # player 0 and 3 as indices for map 
         self.rows = size
         self.columns = size
@@ -18,21 +110,39 @@ class Battleship:
         )
         self.moves = 0
         self.debug = debug
+        self.ship_sizes = list(ship_sizes or default_ship_sizes())
+        self.ships_possible = [list(self.ship_sizes), list(self.ship_sizes)]
+        self.num_shipparts = sum(self.ship_sizes)
+        self.layouts = get_layouts(size, self.ship_sizes)
+        # compare the incremental counters against the full board on every query
+        self.check = check
+        # dtype of the network input, uint8 planes are cast inside the model
+        self.encoded_dtype = numpy.dtype(encoded_dtype)
+        self.zobrist_array = zobrist_keys(size)
+        # python ints, xor on them is cheaper than on numpy scalars
+        self.zobrist_keys = self.zobrist_array.tolist()
 
     def __repr__(self):
         return "battleship"
 
     def restart(self, player):
         self.repeat = False
-        self.ships_possible = [[4, 3, 2], [4, 3, 2]]
-        self.num_shipparts = sum(self.ships_possible[0])
         # initalization of all submaps
         state = numpy.zeros(
             (6, self.columns, self.rows), dtype=numpy.uint8
+        ).view(BattleshipState)
+        state.remaining = [self.num_shipparts, self.num_shipparts]
+        state.ship_left = [list(self.ship_sizes), list(self.ship_sizes)]
+        state.ship_ids = numpy.full(
+            (2, self.columns, self.rows), -1, dtype=numpy.int8
+        )
+        state.planes = numpy.zeros(
+            (6, self.columns, self.rows), dtype=self.encoded_dtype
         )
         self.ships = [[], []]
         self.place_ships(state, player)
         self.place_ships(state, -player)
+        state.zobrist = self.compute_hash(state)
         return state
     
     def shipIndex(self, player):
@@ -47,7 +157,12 @@ class Battleship:
         # f: {-1, 1} -> {2, 5}
         return 3 * int(player > 0) + 2
 
+    def perspective(self, state):
+        return getattr(state, "perspective", 1)
+
     def step(self, state, action, player):
+        # map the player of a perspective view onto the stored layers
+        player = player * self.perspective(state)
         x = action // self.size
         y = action % self.size
 
@@ -57,16 +172,30 @@ class Battleship:
         self.repeat = False
 
         # Explicit numeric checks (0 == unknown, 255 == marked)
+        planes = getattr(state, "planes", None)
+
         if hit == 0 and ship == 0:
             # hit water
             state[self.hitIndex(player), x, y] = 255
+            if planes is not None:
+                self.set_plane(planes, 0, player, x, y)
+            self.toggle_hash(state, self.hitIndex(player), action)
             if self.debug:
                 print(f"Battleship.step: water at {(x,y)} by player {player}")
         elif hit == 0 and ship == 255:
             # hit ship
             state[self.hitIndex(player), x, y] = 255
             state[self.knowledgeIndex(player), x, y] = 255
-            # note: we keep ship bookkeeping but do not remove parts here
+            if planes is not None:
+                self.set_plane(planes, 0, player, x, y)
+                self.set_plane(planes, 1, player, x, y)
+            self.toggle_hash(state, self.hitIndex(player), action)
+            self.toggle_hash(state, self.knowledgeIndex(player), action)
+            remaining = getattr(state, "remaining", None)
+            if remaining is not None:
+                side = int(-player > 0)
+                remaining[side] -= 1
+                state.ship_left[side][state.ship_ids[side, x, y]] -= 1
             self.repeat = True
             if self.debug:
                 print(f"Battleship.step: HIT at {(x,y)} by player {player} (ship layer index {self.shipIndex(-player)})")
@@ -76,7 +205,48 @@ class Battleship:
                 print(f"Battleship.step: no-op at {(x,y)} hit={hit} ship={ship} player={player}")
         return state
 
+    def toggle_hash(self, state, layer, cell):
+        # layer l of the stored state is layer (l + 3) % 6 once swapped
+        zobrist = getattr(state, "zobrist", None)
+        if zobrist is not None:
+            zobrist[0] ^= self.zobrist_keys[layer][cell]
+            zobrist[1] ^= self.zobrist_keys[(layer + 3) % 6][cell]
+
+    def compute_hash(self, state):
+        """Full board [hash, swapped hash] of the stored layers
+        """
+        cells = numpy.asarray(state).reshape(6, -1) == 255
+        swapped = self.zobrist_array[[3, 4, 5, 0, 1, 2]]
+        return [
+            int(numpy.bitwise_xor.reduce(self.zobrist_array[cells])),
+            int(numpy.bitwise_xor.reduce(swapped[cells]))
+        ]
+
+    def position_hash(self, state):
+        """Zobrist hash of the position as seen from the state's perspective
+
+        Equal for equal positions no matter in which order the cells
+        were fired at. States without bookkeeping are hashed from
+        scratch.
+        """
+        zobrist = getattr(state, "zobrist", None)
+        if zobrist is None:
+            zobrist = self.compute_hash(state)
+        elif self.check and zobrist != self.compute_hash(state):
+            raise RuntimeError("Zobrist hash out of sync with the board")
+        return zobrist[1] if self.perspective(state) < 0 else zobrist[0]
+
+    def set_plane(self, planes, layer, player, x, y):
+        # layer 0 hit, 1 knowledge; player -1 is stored twice
+        if player > 0:
+            planes[2 + layer, x, y] = 1
+        else:
+            planes[layer, x, y] = 1
+            planes[4 + layer, x, y] = 1
+
     def get_valid_moves(self, state, player):
+        player = player * self.perspective(state)
+        state = numpy.asarray(state)
         return (
             (state[self.hitIndex(player), :, :] == 0)
             .astype(numpy.uint8)
@@ -84,8 +254,10 @@ class Battleship:
         )
     
     def policy(self, policy, state):
+        player = self.perspective(state)
+        state = numpy.asarray(state)
         valid_moves = (
-            (state[self.hitIndex(1), :, :] == 0)
+            (state[self.hitIndex(player), :, :] == 0)
             .astype(numpy.uint8)
             .flatten()
         )
@@ -93,50 +265,88 @@ class Battleship:
         policy /= numpy.sum(policy)
         return policy
 
-    def check_win(self, state, action, player):
+    def count_hits(self, state, player):
+        # full board computation of the ship parts `player` has hit
+        player = player * self.perspective(state)
+        state = numpy.asarray(state)
         state_hit = state[self.hitIndex(player)]
         state_ship = state[self.shipIndex(-player)]
-        if (numpy.sum(state_ship * state_hit) == 
-            self.num_shipparts):
-            
-            return True
-        else:
-            return False
+        return int(numpy.sum(state_ship * state_hit))
+
+    def check_counters(self, state):
+        for player in (1, -1):
+            remaining = self.num_shipparts - self.count_hits(state, player)
+            side = int(-player * self.perspective(state) > 0)
+            if state.remaining[side] != remaining:
+                raise RuntimeError(
+                    f"Remaining ship cells of player {-player} out of sync: "
+                    f"counter {state.remaining[side]}, board {remaining}"
+                )
+
+    def check_win(self, state, action, player):
+        remaining = getattr(state, "remaining", None)
+        if remaining is None:
+            return self.count_hits(state, player) == self.num_shipparts
+        if self.check:
+            self.check_counters(state)
+        return remaining[int(-player * self.perspective(state) > 0)] == 0
 
     def terminated(self, state, action):
-        if self.check_win(state, action, 1):
-            return 1, True
-        if self.check_win(state, action, -1):
+        remaining = getattr(state, "remaining", None)
+        if remaining is None:
+            if self.check_win(state, action, 1):
+                return 1, True
+            if self.check_win(state, action, -1):
+                return 1, True
+            return 0, False
+        if self.check:
+            self.check_counters(state)
+        if remaining[0] == 0 or remaining[1] == 0:
             return 1, True
         return 0, False
 
+    def sunk_ships(self, state, player):
+        """Sunk flag of every ship of `player`, in `ship_sizes` order
+        """
+        if getattr(state, "ship_left", None) is None:
+            raise ValueError("State carries no ship bookkeeping, create it with restart")
+        player = player * self.perspective(state)
+        return [left == 0 for left in state.ship_left[int(player > 0)]]
+
     def change_perspective(self, state, player):
-        # TODO test
-        return_state = numpy.zeros(
-            (6, self.columns, self.rows), 
-            dtype=numpy.uint8
-        )
+        # zero-copy: a view sharing the data and bookkeeping of `state`
+        # with the player mapping flipped
         if player == -1:
-            state_copy = state[0:3]
-            return_state[0:3] = state[3:6]
-            return_state[3:6] = state_copy
+            if isinstance(state, BattleshipState):
+                return_state = state.view()
+            else:
+                return_state = numpy.asarray(state).view(BattleshipState)
+            return_state.perspective = -self.perspective(state)
             return return_state
         else:
             return state
 
-    def get_encoded_state(self, state):
+    def get_encoded_state(self, state, copy=True):
+        # copy=False returns a view of the incrementally updated planes,
+        # only valid until the state is stepped again
+        player = self.perspective(state)
+        planes = getattr(state, "planes", None)
+        if planes is not None:
+            observation = planes[0:4] if player > 0 else planes[2:6]
+            return observation.copy() if copy else observation
+        state = numpy.asarray(state)
         obsA = (
             state[
-                self.hitIndex(1) : 
-                self.knowledgeIndex(1) + 1
+                self.hitIndex(player) : 
+                self.knowledgeIndex(player) + 1
             ] == 255
-        ).astype(numpy.float32)
+        ).astype(self.encoded_dtype)
         obsB = (
             state[
-                self.hitIndex(-1) : 
-                self.knowledgeIndex(-1) + 1
+                self.hitIndex(-player) : 
+                self.knowledgeIndex(-player) + 1
             ] == 255
-        ).astype(numpy.float32)
+        ).astype(self.encoded_dtype)
         observation = numpy.concatenate(
             (obsB, obsA), 
             axis=0
@@ -145,43 +355,17 @@ class Battleship:
         return observation
 
     def place_ships(self, state, player):
-        for ship in self.ships_possible[int(player > 0)]:
-            max_attempts = 1000
-            placed = False
-            attempts = 0
-            while not placed and attempts < max_attempts:
-                attempts += 1
-                random_direction = random.randint(0, 1)
-                possible_positions = []
-
-                # horizontal placement: x varies, y constant
-                if random_direction == 1:
-                    for x in range(0, self.size - ship + 1):
-                        for y in range(0, self.size):
-                            segment = [state[self.shipIndex(player), x + i, y] for i in range(ship)]
-                            if all(int(v) == 0 for v in segment):
-                                possible_positions.append(((x, y), (x + ship - 1, y)))
-                else:
-                    # vertical placement: y varies, x constant
-                    for y in range(0, self.size - ship + 1):
-                        for x in range(0, self.size):
-                            segment = [state[self.shipIndex(player), x, y + i] for i in range(ship)]
-                            if all(int(v) == 0 for v in segment):
-                                possible_positions.append(((x, y), (x, y + ship - 1)))
-
-                if not possible_positions:
-                    # try another random orientation / attempt
-                    continue
-
-                p1, p2 = random.choice(possible_positions)
-                ship_array = self.points_between([p1[0], p1[1]], [p2[0], p2[1]])
-                self.ships[int(player > 0)].append(ship_array)
-                for point in ship_array:
-                    state[self.shipIndex(player), point[0], point[1]] = 255
-                placed = True
-
-            if not placed:
-                raise ValueError(f"Could not place ship of length {ship} for player {player} after {max_attempts} attempts")
+        # samples a complete legal fleet from the precomputed layouts
+        ship_map = state[self.shipIndex(player)].reshape(-1)
+        ship_ids = getattr(state, "ship_ids", None)
+        for ship, cells in enumerate(
+                self.layouts.fleet_cells(self.layouts.sample())):
+            ship_map[cells] = 255
+            if ship_ids is not None:
+                ship_ids[int(player > 0)].reshape(-1)[cells] = ship
+            self.ships[int(player > 0)].append(
+                [[int(cell) // self.size, int(cell) % self.size] for cell in cells]
+            )
 
     def points_between(self, p1, p2):
         points = []
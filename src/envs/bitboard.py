@@ -0,0 +1,244 @@
+"""
+description: Bitboard engine for the Battleship game environment.
+author: Tim Straube
+licence: MIT
+"""
+
+import numpy
+from envs.battleship import Battleship
+
+class BitboardState:
+    """Battleship state packed into six integers
+
+    The layers follow the array layout of `Battleship` (ship, hit and
+    knowledge map for player -1 followed by the same maps for player 1).
+    Cell (x, y) is stored in bit x * size + y, which is the action index
+    of that cell. Python integers are arbitrary precision, so any board
+    size works; boards up to 11x11 fit into 128 bits.
+
+    `remaining` counts the ship cells not yet hit per player and `fleet`
+    holds the mask of every ship per player (shared between copies),
+    both indexed by int(player > 0) like `Battleship.ships`.
+    `zobrist` is the [hash, swapped hash] pair of `BattleshipState`.
+    """
+    __slots__ = ("layers", "remaining", "fleet", "zobrist")
+
+    def __init__(self, layers, remaining=None, fleet=None, zobrist=None):
+        self.layers = layers
+        self.remaining = remaining
+        self.fleet = fleet
+        self.zobrist = zobrist
+
+    def __repr__(self):
+        return "BitboardState(" + ", ".join(
+            hex(layer) for layer in self.layers
+        ) + ")"
+
+    def __eq__(self, other):
+        if not isinstance(other, BitboardState):
+            return NotImplemented
+        return self.layers == other.layers
+
+    def copy(self):
+        return BitboardState(
+            list(self.layers),
+            None if self.remaining is None else list(self.remaining),
+            self.fleet,
+            None if self.zobrist is None else list(self.zobrist)
+        )
+
+class BitboardBattleship(Battleship):
+    """Drop-in replacement for `Battleship` operating on `BitboardState`
+
+    Stepping, win detection, valid moves and the perspective swap are
+    plain integer operations. Only the results that leave the
+    environment (valid move masks and encoded states) are unpacked into
+    numpy arrays.
+    """
+    def __init__(
+        self,
+        size,
+        debug=False,
+        ship_sizes=None,
+        check=False,
+        encoded_dtype=numpy.float32):
+
+        super().__init__(size, debug, ship_sizes, check, encoded_dtype)
+        self.full = (1 << self.actions) - 1
+        self.num_bytes = (self.actions + 7) // 8
+
+    def __repr__(self):
+        return "battleship_bitboard"
+
+    def restart(self, player):
+        self.repeat = False
+        self.ships = [[], []]
+        layers = [0] * 6
+        fleets = [None, None]
+        for side in (player, -player):
+            fleet = self.layouts.sample()
+            layers[self.shipIndex(side)] = self.layouts.fleet_mask(fleet)
+            fleets[int(side > 0)] = tuple(
+                masks[index] for masks, index in zip(self.layouts.masks, fleet)
+            )
+            self.ships[int(side > 0)] = [
+                [[int(cell) // self.size, int(cell) % self.size] for cell in cells]
+                for cells in self.layouts.fleet_cells(fleet)
+            ]
+        state = BitboardState(
+            layers,
+            [self.num_shipparts, self.num_shipparts],
+            tuple(fleets)
+        )
+        state.zobrist = self.compute_hash(state)
+        return state
+
+    def step(self, state, action, player):
+        layers = state.layers
+        bit = 1 << int(action)
+        hit_index = self.hitIndex(player)
+
+        self.repeat = False
+
+        if layers[hit_index] & bit:
+            # already hit before; do nothing
+            if self.debug:
+                print(f"BitboardBattleship.step: no-op at {action} player={player}")
+        elif layers[self.shipIndex(-player)] & bit:
+            # hit ship
+            layers[hit_index] |= bit
+            layers[self.knowledgeIndex(player)] |= bit
+            self.toggle_hash(state, hit_index, action)
+            self.toggle_hash(state, self.knowledgeIndex(player), action)
+            if state.remaining is not None:
+                state.remaining[int(-player > 0)] -= 1
+            self.repeat = True
+            if self.debug:
+                print(f"BitboardBattleship.step: HIT at {action} by player {player}")
+        else:
+            # hit water
+            layers[hit_index] |= bit
+            self.toggle_hash(state, hit_index, action)
+            if self.debug:
+                print(f"BitboardBattleship.step: water at {action} by player {player}")
+        return state
+
+    def get_valid_moves(self, state, player):
+        return self.unpack(
+            ~state.layers[self.hitIndex(player)] & self.full
+        )
+
+    def policy(self, policy, state):
+        policy *= self.get_valid_moves(state, 1)
+        policy /= numpy.sum(policy)
+        return policy
+
+    def count_hits(self, state, player):
+        return (
+            state.layers[self.shipIndex(-player)] &
+            state.layers[self.hitIndex(player)]
+        ).bit_count()
+
+    def check_win(self, state, action, player):
+        if state.remaining is None:
+            return self.count_hits(state, player) == self.num_shipparts
+        if self.check:
+            self.check_counters(state)
+        return state.remaining[int(-player > 0)] == 0
+
+    def terminated(self, state, action):
+        if state.remaining is None:
+            return super().terminated(state, action)
+        if self.check:
+            self.check_counters(state)
+        if state.remaining[0] == 0 or state.remaining[1] == 0:
+            return 1, True
+        return 0, False
+
+    def sunk_ships(self, state, player):
+        if state.fleet is None:
+            raise ValueError("State carries no ship bookkeeping, create it with restart")
+        hits = state.layers[self.hitIndex(-player)]
+        return [
+            ship & hits == ship for ship in state.fleet[int(player > 0)]
+        ]
+
+    def compute_hash(self, state):
+        return super().compute_hash(self.to_array(state))
+
+    def change_perspective(self, state, player):
+        if player == -1:
+            layers = state.layers
+            return BitboardState(
+                layers[3:6] + layers[0:3],
+                None if state.remaining is None else state.remaining[::-1],
+                None if state.fleet is None else state.fleet[::-1],
+                None if state.zobrist is None else state.zobrist[::-1]
+            )
+        return state
+
+    def get_encoded_state(self, state, copy=True):
+        # always a fresh array, the planes are unpacked from the bitboard
+        layers = state.layers
+        # same plane order as Battleship.get_encoded_state
+        planes = self.unpack_many((
+            layers[self.hitIndex(-1)],
+            layers[self.knowledgeIndex(-1)],
+            layers[self.hitIndex(1)],
+            layers[self.knowledgeIndex(1)],
+        ))
+        return planes.reshape(
+            4, self.rows, self.columns
+        ).astype(self.encoded_dtype, copy=False)
+
+    def unpack(self, mask):
+        """Unpack a bitmask into a flat uint8 array of length `actions`
+        """
+        return numpy.unpackbits(
+            numpy.frombuffer(
+                mask.to_bytes(self.num_bytes, "little"),
+                dtype=numpy.uint8
+            ),
+            count=self.actions,
+            bitorder="little"
+        )
+
+    def unpack_many(self, masks):
+        """Unpack several bitmasks into a (len(masks), actions) uint8 array
+        """
+        buffer = b"".join(
+            mask.to_bytes(self.num_bytes, "little") for mask in masks
+        )
+        return numpy.unpackbits(
+            numpy.frombuffer(buffer, dtype=numpy.uint8).reshape(
+                len(masks), self.num_bytes
+            ),
+            axis=1,
+            count=self.actions,
+            bitorder="little"
+        )
+
+    def pack(self, plane):
+        """Pack a (size, size) array into a bitmask, nonzero means set
+        """
+        return int.from_bytes(
+            numpy.packbits(
+                numpy.asarray(plane).reshape(-1) != 0,
+                bitorder="little"
+            ).tobytes(),
+            "little"
+        )
+
+    def from_array(self, array):
+        """Convert a 6xNxN array state of `Battleship` into a bitboard
+        """
+        return BitboardState([self.pack(layer) for layer in array])
+
+    def to_array(self, state):
+        """Convert a bitboard into the 6xNxN uint8 layout of `Battleship`
+        """
+        return (
+            self.unpack_many(state.layers).reshape(
+                6, self.columns, self.rows
+            ) * numpy.uint8(255)
+        )
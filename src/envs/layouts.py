@@ -0,0 +1,187 @@
+"""
+description: Precomputed ship placements and fleet layouts for Battleship.
+author: Tim Straube
+licence: MIT
+"""
+
+import os
+import math
+import random
+import numpy
+
+# fleets are only enumerated if the placement product stays below this bound
+MAX_FLEETS = 1_000_000
+# below the repository root whatever the working directory is
+LAYOUT_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "..",
+    "..",
+    "models",
+    "layouts"
+)
+
+_layouts = {}
+
+def get_layouts(size, ship_sizes):
+    """Shared `FleetLayouts` instance for a (board size, ship lengths) config
+    """
+    key = (int(size), tuple(int(ship) for ship in ship_sizes))
+    if key not in _layouts:
+        _layouts[key] = FleetLayouts(*key)
+    return _layouts[key]
+
+class FleetLayouts:
+    """Index of all legal ship placements of one board configuration
+
+    Every placement of a ship is stored as a bitmask over the action
+    indices (x * size + y) and as the array of its cells. If the number
+    of fleets is small enough, every legal non overlapping fleet is
+    enumerated once, cached on disk as a table of placement indices
+    (one column per ship) and memory mapped, so all processes sampling
+    from the same config share one copy. Sampling a fleet is then a
+    single random row lookup; larger configs fall back to rejection
+    sampling over the placement masks.
+    """
+    def __init__(
+        self,
+        size,
+        ship_sizes,
+        max_fleets=MAX_FLEETS,
+        cache_dir=LAYOUT_DIR):
+
+        self.size = int(size)
+        self.ship_sizes = tuple(int(ship) for ship in ship_sizes)
+        self.actions = self.size * self.size
+        if not self.ship_sizes or max(self.ship_sizes) > self.size:
+            raise ValueError(
+                f"Ships {list(self.ship_sizes)} do not fit on a {self.size}x{self.size} board"
+            )
+        placements = {
+            length: self._placements(length)
+            for length in set(self.ship_sizes)
+        }
+        # per ship: (P, length) cell indices and P bitmasks
+        self.cells = [placements[length] for length in self.ship_sizes]
+        self.masks = [
+            [sum(1 << int(cell) for cell in cells) for cells in ship]
+            for ship in self.cells
+        ]
+        self.fleets = None
+        bound = math.prod(len(masks) for masks in self.masks)
+        if bound <= max_fleets:
+            self.fleets = self._load_fleets(cache_dir)
+
+    def __len__(self):
+        return len(self.fleets) if self.fleets is not None else 0
+
+    def _placements(self, length):
+        cells = []
+        # horizontal placement: x varies, y constant
+        for x in range(0, self.size - length + 1):
+            for y in range(0, self.size):
+                cells.append([(x + i) * self.size + y for i in range(length)])
+        # vertical placement: y varies, x constant
+        for y in range(0, self.size - length + 1):
+            for x in range(0, self.size):
+                cells.append([x * self.size + y + i for i in range(length)])
+        return numpy.array(cells, dtype=numpy.int64)
+
+    def _enumerate(self):
+        fleets = []
+        fleet = []
+
+        def place(ship, occupied):
+            if ship == len(self.masks):
+                fleets.append(list(fleet))
+                return
+            for index, mask in enumerate(self.masks[ship]):
+                if mask & occupied == 0:
+                    fleet.append(index)
+                    place(ship + 1, occupied | mask)
+                    fleet.pop()
+
+        place(0, 0)
+        if not fleets:
+            raise ValueError(
+                f"No legal layout for ships {list(self.ship_sizes)} on a {self.size}x{self.size} board"
+            )
+        return numpy.array(fleets, dtype=numpy.int16)
+
+    def _load_fleets(self, cache_dir):
+        name = "layouts_{}_{}.npy".format(
+            self.size,
+            "-".join(str(ship) for ship in self.ship_sizes)
+        )
+        path = os.path.join(cache_dir, name)
+        try:
+            return numpy.load(path, mmap_mode="r")
+        except Exception:
+            pass
+        fleets = self._enumerate()
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            # write to a private file first so readers never see a partial table
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as file:
+                numpy.save(file, fleets)
+            os.replace(tmp_path, path)
+            return numpy.load(path, mmap_mode="r")
+        except Exception:
+            return fleets
+
+    def sample(self, max_attempts=1000):
+        """Placement index of every ship of one random legal fleet
+        """
+        if self.fleets is not None:
+            return self.fleets[random.randrange(len(self.fleets))].tolist()
+        for _ in range(max_attempts):
+            occupied = 0
+            fleet = []
+            for masks in self.masks:
+                for _ in range(max_attempts):
+                    index = random.randrange(len(masks))
+                    if masks[index] & occupied == 0:
+                        break
+                else:
+                    break
+                fleet.append(index)
+                occupied |= masks[index]
+            else:
+                return fleet
+        raise ValueError(
+            f"Could not place ships {list(self.ship_sizes)} after {max_attempts} attempts"
+        )
+
+    def sample_many(self, count):
+        """(count, ships) placement indices of `count` random fleets
+        """
+        if self.fleets is not None:
+            rows = numpy.random.randint(0, len(self.fleets), size=count)
+            return numpy.asarray(self.fleets[rows], dtype=numpy.int64)
+        return numpy.array(
+            [self.sample() for _ in range(count)],
+            dtype=numpy.int64
+        ).reshape(count, len(self.ship_sizes))
+
+    def fleet_mask(self, fleet):
+        """Bitmask of all cells occupied by a fleet
+        """
+        mask = 0
+        for masks, index in zip(self.masks, fleet):
+            mask |= masks[index]
+        return mask
+
+    def fleet_cells(self, fleet):
+        """Cell indices of every ship of a fleet
+        """
+        return [cells[index] for cells, index in zip(self.cells, fleet)]
+
+    def fleet_planes(self, fleets):
+        """(len(fleets), actions) bool occupancy of several fleets
+        """
+        fleets = numpy.asarray(fleets)
+        planes = numpy.zeros((len(fleets), self.actions), dtype=bool)
+        rows = numpy.arange(len(fleets))[:, None]
+        for ship, cells in enumerate(self.cells):
+            planes[rows, cells[fleets[:, ship]]] = True
+        return planes
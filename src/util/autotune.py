@@ -0,0 +1,203 @@
+"""
+author: Tim Straube
+contact: hi@optimalpi.com
+licence: MIT
+
+Inference autotuner for the AlphaZero network on this machine.
+
+    PYTHONPATH=src python src/util/autotune.py
+
+sweeps intra-op threads, inter-op threads (onnx), batch size and
+backend for the network of the "alphazero" section of
+hyperparameter.json (or the one given on the command line), measures
+positions per second and p99 latency of every combination and writes
+the fastest one within the latency budget to inference_profile.json
+in the repository root. AlphaZero loads it with --profile, see
+agents/alphazero/tuning.py.
+"""
+
+import argparse
+import json
+import os
+import platform
+import torch
+from agents.alphazero.backends import make_backend
+from agents.alphazero.tuning import PROFILE_PATH, network_config, set_threads
+from util.benchmark import build_model, hyperparameters, measure, random_positions
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+def thread_counts(cpus):
+    """1, 2, 4, ... up to and including the number of cores
+    """
+    counts = []
+    count = 1
+    while count < cpus:
+        counts.append(count)
+        count *= 2
+    counts.append(cpus)
+    return counts
+
+def batch_sizes(largest):
+    sizes = []
+    size = 1
+    while size < largest:
+        sizes.append(size)
+        size *= 2
+    sizes.append(largest)
+    return sizes
+
+def sweep(
+    game,
+    model,
+    inputarrays,
+    backends,
+    threads,
+    inter_threads,
+    sizes,
+    seconds,
+    inference_mode="script"):
+    """Measures every (threads, backend, inter threads, batch size)
+
+    Inter-op threads only vary for the onnx backend, torch sizes its
+    inter-op pool once per process.
+    """
+    positions = random_positions(game, inputarrays, max(sizes))
+    results = []
+    print(
+        f"\n{'backend':<11}{'threads':>8}{'inter':>6}{'batch':>7}"
+        f"{'positions/s':>14}{'p50 ms':>10}{'p99 ms':>10}"
+    )
+    for count in threads:
+        set_threads(count)
+        for name in backends:
+            for inter in (inter_threads if name == 'onnx' else [1]):
+                try:
+                    backend = make_backend({
+                        'backend': name,
+                        'inference_mode': inference_mode,
+                        'backend_threads': count,
+                        'backend_inter_threads': inter,
+                        'leaf_batch': max(sizes),
+                    }, model)
+                    backend.evaluate(positions[:1])
+                except ImportError as error:
+                    print(f"Skipping {name}: {error}")
+                    break
+                for size in sizes:
+                    result = measure(backend, positions[:size], seconds)
+                    result.update(
+                        backend=name,
+                        threads=count,
+                        inter_threads=inter,
+                        batch_size=size
+                    )
+                    results.append(result)
+                    print(
+                        f"{name:<11}{count:>8}{inter:>6}{size:>7}"
+                        f"{result['positions_per_s']:>14.0f}"
+                        f"{result['p50_ms']:>10.3f}{result['p99_ms']:>10.3f}"
+                    )
+    return results
+
+def choose(results, max_p99_ms=None):
+    """Fastest result within the p99 budget, the lowest p99 if none is
+    """
+    allowed = [
+        result for result in results
+        if max_p99_ms is None or result['p99_ms'] <= max_p99_ms
+    ]
+    if not allowed:
+        return min(results, key=lambda result: result['p99_ms'])
+    return max(allowed, key=lambda result: result['positions_per_s'])
+
+def profile_settings(result, inference_mode="script"):
+    """args entries of a result, the `best` section of a profile
+    """
+    return {
+        'backend': result['backend'],
+        'inference_mode': inference_mode,
+        'backend_threads': result['threads'],
+        'backend_inter_threads': result['inter_threads'],
+        'graph_optimization': 'all',
+        'io_binding': True,
+        'threads': result['threads'],
+        'inter_threads': result['inter_threads'],
+        'batch_size': result['batch_size'],
+        'positions_per_s': result['positions_per_s'],
+        'p99_ms': result['p99_ms'],
+    }
+
+def _parse_args():
+    config = hyperparameters()
+    cpus = os.cpu_count() or 1
+    p = argparse.ArgumentParser(description="Thread, batch size and backend autotuner for AlphaZero inference")
+    p.add_argument("--size", type=int, default=config.get('size', 5))
+    p.add_argument("--resblocks", type=int, default=config.get('resblocks', 6))
+    p.add_argument("--hiddenlayers", type=int, default=config.get('hiddenlayers', 6))
+    p.add_argument("--inputarrays", type=int, default=config.get('inputarrays', 4))
+    p.add_argument("--backends", nargs="+", choices=["torch", "fused", "quantized", "onnx"], default=["torch", "fused", "quantized", "onnx"])
+    p.add_argument("--threads", type=int, nargs="+", default=thread_counts(cpus), help="intra-op thread counts, by default powers of two up to the cores")
+    p.add_argument("--inter-threads", type=int, nargs="+", default=[1, 2], help="inter-op thread counts of the onnx backend")
+    p.add_argument("--max-batch", type=int, default=max(1, config.get('leaf_batch', 1) * config.get('parallel_games', 1)), help="largest batch size, batch sizes are powers of two up to it")
+    p.add_argument("--max-p99-ms", type=float, default=None, help="latency budget of one forward pass")
+    p.add_argument("--inference-mode", choices=["script", "compile", "eager"], default=config.get('inference_mode', "script"))
+    p.add_argument("--seconds", type=float, default=0.5, help="measuring time per combination")
+    p.add_argument("--out", type=str, default=PROFILE_PATH, help="by default inference_profile.json in the repository root")
+    return p.parse_args()
+
+
+def main():
+    args = _parse_args()
+    game, model = build_model(
+        args.size,
+        args.resblocks,
+        args.hiddenlayers,
+        args.inputarrays
+    )
+    config = network_config(
+        args.size,
+        args.resblocks,
+        args.hiddenlayers,
+        args.inputarrays
+    )
+    print(f"Tuning {config} on {os.cpu_count()} cores")
+    results = sweep(
+        game,
+        model,
+        args.inputarrays,
+        args.backends,
+        args.threads,
+        args.inter_threads,
+        batch_sizes(args.max_batch),
+        args.seconds,
+        args.inference_mode
+    )
+    best = profile_settings(choose(results, args.max_p99_ms), args.inference_mode)
+    print(
+        f"\nBest: {best['backend']} with {best['threads']} threads, "
+        f"batch {best['batch_size']}: {best['positions_per_s']:.0f} positions/s, "
+        f"p99 {best['p99_ms']:.3f} ms"
+    )
+    with open(args.out, "w") as file:
+        json.dump({
+            'machine': {
+                'cpus': os.cpu_count(),
+                'platform': platform.platform(),
+                'processor': platform.processor(),
+                'torch': torch.__version__,
+                'onnxruntime': None if onnxruntime is None else onnxruntime.__version__,
+            },
+            'config': config,
+            'max_p99_ms': args.max_p99_ms,
+            'best': best,
+            'results': results,
+        }, file, indent=2)
+    print(f"Profile saved to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+author: Tim Straube
+contact: hi@optimalpi.com
+licence: MIT
+
+Throughput of the inference backends for the AlphaZero network.
+
+    PYTHONPATH=src python src/util/benchmark.py
+
+builds the network of the "alphazero" section of hyperparameter.json
+(or the one given on the command line) with random weights and
+measures positions per second and latency percentiles of eager torch
+and of onnxruntime with and without IO binding, for the batch sizes
+MCTS sends: single leaves, one leaf batch and one lockstep round.
+"""
+
+import argparse
+import json
+import time
+import numpy
+import torch
+from agents.alphazero.backends import make_backend
+from agents.alphazero.residualnetwork import ResidualNetwork
+from envs.battleship import Battleship
+
+def measure(backend, batch, seconds=1.0, min_calls=20):
+    """Positions per second and latency percentiles of `backend` on `batch`
+    """
+    backend.evaluate(batch)
+    times = []
+    start = time.perf_counter()
+    while len(times) < min_calls or time.perf_counter() - start < seconds:
+        call = time.perf_counter()
+        backend.evaluate(batch)
+        times.append(time.perf_counter() - call)
+    times = numpy.array(times)
+    return {
+        'positions_per_s': len(batch) * len(times) / float(times.sum()),
+        'p50_ms': 1000 * float(numpy.percentile(times, 50)),
+        'p99_ms': 1000 * float(numpy.percentile(times, 99)),
+        'calls': len(times),
+    }
+
+def hyperparameters(path="hyperparameter.json", agent="alphazero"):
+    try:
+        with open(path) as file:
+            return json.load(file).get(agent, {})
+    except (OSError, ValueError):
+        return {}
+
+def build_model(size, resblocks, hiddenlayers, inputarrays, seed=0):
+    torch.manual_seed(seed)
+    game = Battleship(size)
+    model = ResidualNetwork(
+        game,
+        resblocks,
+        hiddenlayers,
+        inputarrays,
+        torch.device("cpu")
+    )
+    return game, model.eval()
+
+def random_positions(game, inputarrays, count, seed=0):
+    """Random 0/1 planes, the network's speed does not depend on them
+    """
+    return numpy.random.default_rng(seed).integers(
+        0,
+        2,
+        (count, inputarrays, game.rows, game.columns)
+    ).astype(game.encoded_dtype)
+
+# (label, backend args) of the compared backends
+VARIANTS = (
+    ('torch', {'backend': 'torch'}),
+    ('onnx', {'backend': 'onnx', 'io_binding': False}),
+    ('onnx+iobind', {'backend': 'onnx', 'io_binding': True}),
+)
+
+def _parse_args():
+    config = hyperparameters()
+    p = argparse.ArgumentParser(description="Inference backend throughput of the AlphaZero network")
+    p.add_argument("--size", type=int, default=config.get('size', 5))
+    p.add_argument("--resblocks", type=int, default=config.get('resblocks', 6))
+    p.add_argument("--hiddenlayers", type=int, default=config.get('hiddenlayers', 6))
+    p.add_argument("--inputarrays", type=int, default=config.get('inputarrays', 4))
+    p.add_argument("--leaf-batch", type=int, default=config.get('leaf_batch', 1))
+    p.add_argument("--parallel-games", type=int, default=config.get('parallel_games', 1))
+    p.add_argument("--batch-sizes", type=int, nargs="+", default=None, help="batch sizes to measure, by default 1, the leaf batch and a lockstep round")
+    p.add_argument("--threads", type=int, default=torch.get_num_threads(), help="intra-op threads of torch and onnxruntime")
+    p.add_argument("--seconds", type=float, default=1.0, help="measuring time per backend and batch size")
+    p.add_argument("--json", type=str, default=None, help="also write the results to this file")
+    return p.parse_args()
+
+
+def main():
+    args = _parse_args()
+    game, model = build_model(
+        args.size,
+        args.resblocks,
+        args.hiddenlayers,
+        args.inputarrays
+    )
+    batch_sizes = args.batch_sizes or sorted({
+        1,
+        args.leaf_batch,
+        args.leaf_batch * args.parallel_games
+    })
+    positions = random_positions(game, args.inputarrays, max(batch_sizes))
+    torch.set_num_threads(args.threads)
+    print(
+        f"{args.size}x{args.size} board, {args.resblocks} blocks of "
+        f"{args.hiddenlayers} channels, {args.threads} threads"
+    )
+    print(f"\n{'backend':<14}{'batch':>7}{'positions/s':>14}{'p50 ms':>10}{'p99 ms':>10}")
+    results = []
+    for label, backend_args in VARIANTS:
+        backend = make_backend(
+            dict(
+                backend_args,
+                backend_threads=args.threads,
+                leaf_batch=max(batch_sizes)
+            ),
+            model
+        )
+        for batch_size in batch_sizes:
+            result = measure(backend, positions[:batch_size], args.seconds)
+            result.update(backend=label, batch_size=batch_size)
+            results.append(result)
+            print(
+                f"{label:<14}{batch_size:>7}{result['positions_per_s']:>14.0f}"
+                f"{result['p50_ms']:>10.3f}{result['p99_ms']:>10.3f}"
+            )
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump({'config': vars(args), 'results': results}, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
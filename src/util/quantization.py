@@ -2,303 +2,348 @@
 author: Tim Straube
 contact: hi@optimalpi.com
 licence: MIT
+
+Static INT8 quantization of AlphaZero checkpoints.
+
+    PYTHONPATH=src python src/util/quantization.py --model-id alphazero
+
+loads models/<id>/main.pt (or the newest run below models/<id>/),
+reads the architecture from the state dict, records calibration
+positions from self-play with the checkpoint, writes a static INT8
+TorchScript model and/or a static INT8 ONNX model to
+models/<id>/int8/ and reports latency, size, policy KL and value error
+of every variant against the FP32 model. The outputs are served by
+the "quantized" and "onnx" backends with --backend-path.
 """
 
-import torch
-import onnx
-import tensorflow
-# import onnx_tf
+import argparse
+import copy
+import glob
+import json
+import os
 import random
+import tempfile
+import time
+import warnings
 import numpy
-import onnxruntime as ort
-import os
-from onnxruntime.quantization import quantize_dynamic
-from onnxruntime.quantization import QuantType
+import torch
+from agents.alphazero.backends import OnnxBackend
+from agents.alphazero.backends import QuantizedBackend
+from agents.alphazero.backends import TorchBackend
+from agents.alphazero.backends import export_onnx
+from agents.alphazero.mcts import MCTS
 from agents.alphazero.residualnetwork import ResidualNetwork
+from agents.alphazero.selfplay import self_play_steps
 from envs.battleship import Battleship
-from src.agents.alphazero.mcts import MCTS
-        
-class ConvertModel():
-    def __init__(self):
-        self.board_size = 9
-        self.current_model_folder = "zeus9x9"
-        self.game = Battleship(self.board_size)
-        # self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        self.device = "cpu"
-        self.model = ResidualNetwork(
-            self.game, 
-            8, 
-            8, 
-            4, 
-            device = self.device
-        )
-        self.model.load_state_dict(
-            torch.load(
-                f'./models/{self.current_model_folder}/main.pt', 
-                map_location = self.device
-            )
-        )
-        # Ensure the model is on the correct device
-        self.model = self.model.to(self.device)  
-        self.model.eval()
-
-    def pytorch2coral(self):
-        model_prefix = 'vivalavida'
-        onnx_save_file = f"./models/{self.current_model_folder}/model_quantized.onnx"
-        tflite_save_file = model_prefix + '.tflite'
-        tflite_quant_save_file = model_prefix + '_quant.tflite'
-
-        print('Loading ONNX and checking...')
-        onnx_model = onnx.load(onnx_save_file)
-        onnx.checker.check_model(onnx_model)
-        print(onnx.helper.printable_graph(onnx_model.graph))
-
-        print('Converting ONNX to TF...')
-        tf_rep = onnx_tf.backend.prepare(onnx_model)
-        tf_rep.export_graph(model_prefix)
-
-        print('Converting TF to TFLite...')
-        converter = tensorflow.lite.TFLiteConverter.from_saved_model(model_prefix)
-        tflite_model = converter.convert()
-        with open(tflite_save_file, 'wb') as f:
-            f.write(tflite_model)
-
-        print('Converting TF to Quantised TFLite...')
-        state = numpy.zeros(
-            (6, 9, 9), dtype=numpy.int8
-        )
-        def representative_data_gen():
-            for i in range(100000):
-                yield [
-                    self.game.get_encoded_state(state).reshape(1, -1)
-                ]
-
-        converter_quant = tensorflow.lite.TFLiteConverter.from_saved_model(model_prefix)
-        converter_quant.optimizations = [
-            tensorflow.lite.Optimize.DEFAULT
-        ]
-        converter_quant.representative_dataset = representative_data_gen
-        converter_quant.target_spec.supported_ops = [
-            tensorflow.lite.OpsSet.TFLITE_BUILTINS_INT8,
-            tensorflow.lite.OpsSet.SELECT_TF_OPS
-        ]
-        converter_quant.target_spec.supported_types = [
-            tensorflow.int8
-        ]
-        # Just accept that observations and actions are inherently floaty, let Coral handle that on the CPU
-        converter_quant.inference_input_type = tensorflow.float32
-        converter_quant.inference_output_type = tensorflow.float32
-        tflite_quant_model = converter_quant.convert()
-        with open(tflite_quant_save_file, 'wb') as f:
-            f.write(tflite_quant_model)
-
-        print('Converting TFLite [nonquant] to Coral...')
-        system('edgetpu_compiler --show_operations -o ' + os.path.dirname(model_prefix) + ' ' + tflite_save_file)
-
-        print('Converting TFLite [quant] to Coral...')
-        system(
-            'edgetpu_compiler --show_operations -o ' + os.path.dirname(model_prefix) + ' ' + tflite_quant_save_file
-        )
 
-    def pytorch2tflite(self):
-        state = self.game.restart(0)
-
-        random_number_moves = random.randint(
-            28, 
-            2 * self.board_size * self.board_size
-        )
-        args = {
-            'C': 2,
-            'num_searches': 100,
-            'dirichlet_epsilon': 0,
-            'dirichlet_alpha': 0.1
-        }
-        mcts = MCTS(self.game, args, self.model)
-        player = -1
-
-        for _ in range(random_number_moves):
-            neutral_state = self.game.change_perspective(
-                self.game.state.copy(), player
-            )
-            mcts_probs = mcts.search(neutral_state)
-            action = numpy.argmax(mcts_probs)
-            state = self.game.step(
-                self.game.state, 
-                action, 
-                player
-            )
-            player = -player
-            yield state
-
-        encoded_state = self.game.get_encoded_state(state)
-        tensor_state = torch.tensor(
-            encoded_state, 
-            dtype=torch.float32
-        ).unsqueeze(0).to(self.device)
-
-        # Convert PyTorch model to ONNX
-        onnx_path = 'resnet_model.onnx'
-        self.torch_to_onnx(
-            self.model, 
-            tensor_state, 
-            onnx_path
-        )
-        print(f"ONNX model saved to {onnx_path}")
-
-        # Convert ONNX model to TensorFlow
-        # Load ONNX model
-        onnx_model = onnx.load(onnx_path)
-        tf_rep = onnx_tf.backend.prepare(onnx_model)
-        tf_rep.export_graph('resnet_model.pb')
-        print("TensorFlow model saved to resnet_model.pb")
-
-        # Convert TensorFlow model to TFLite
-        # Load the TensorFlow model
-        converter = tensorflow.lite.TFLiteConverter.from_saved_model(
-            'resnet_model.pb'
-        )
-        tflite_model = converter.convert()
-
-        # Save the TFLite model
-        with open('resnet_model.tflite', 'wb') as file:
-            file.write(tflite_model)
-            
-    def convert_to_onnx(self):
-        onnx_path = f"./models/{self.current_model_folder}/model.onnx"
-        
-        # Create a dummy input tensor
-        dummy_input = torch.randn(1, 4, self.board_size, self.board_size, device=self.device)
-        
-        # Export the model
-        torch.onnx.export(
-            self.model,  # model being run
-            dummy_input, # model input (or a tuple for multiple inputs)
-            onnx_path,                # where to save the model
-            export_params=True,       # store the trained parameter weights inside the model file
-            opset_version=11,         # the ONNX version to export the model to
-            do_constant_folding=True, # whether to execute constant folding for optimization
-            input_names = ['input'],  # the model's input names
-            output_names = ['policy', 'value'], # the model's output names
-            dynamic_axes={'input' : {0 : 'batch_size'},    # variable length axes
-            'policy' : {0 : 'batch_size'},
-            'value' : {0 : 'batch_size'}}
+try:
+    import onnxruntime
+    from onnxruntime import quantization as ort_quantization
+except ImportError:
+    onnxruntime = None
+    ort_quantization = None
+
+def find_checkpoint(model_id, checkpoint=None):
+    """models/<id>/main.pt, else the newest main.pt of a run below it
+    """
+    if checkpoint:
+        return checkpoint
+    path = os.path.join("models", model_id, "main.pt")
+    if os.path.exists(path):
+        return path
+    runs = glob.glob(os.path.join("models", model_id, "*", "main.pt"))
+    if not runs:
+        raise FileNotFoundError(f"No checkpoint found in models/{model_id}/")
+    return max(runs, key=os.path.getmtime)
+
+def infer_architecture(state_dict):
+    """ResidualNetwork arguments and board size of a state dict
+    """
+    start = state_dict['startBlock.0.weight']
+    blocks = {
+        int(key.split('.')[1])
+        for key in state_dict
+        if key.startswith('backBone.')
+    }
+    policy = state_dict['policyHead.4.weight']
+    # the policy head flattens 6 planes of the square board
+    size = int(round((policy.shape[1] // 6) ** 0.5))
+    return {
+        'size': size,
+        'resblocks': len(blocks),
+        'hiddenlayers': int(start.shape[0]),
+        'inputarrays': int(start.shape[1]),
+        'actions': int(policy.shape[0]),
+    }
+
+def load_model(path):
+    """(game, model, architecture) of a checkpoint, on the CPU in eval mode
+    """
+    state_dict = torch.load(path, map_location="cpu")
+    architecture = infer_architecture(state_dict)
+    game = Battleship(architecture['size'])
+    if game.actions != architecture['actions']:
+        raise ValueError(
+            f"Checkpoint has {architecture['actions']} actions, "
+            f"a {architecture['size']}x{architecture['size']} board {game.actions}"
         )
-        
-        print(f"Model exported to {onnx_path}")
-        
-        # Verify the model
-        onnx_model = onnx.load(onnx_path)
-        onnx.checker.check_model(onnx_model)
-        print("ONNX model is valid")
-
-    def quantize_onnx_model(self):
-        model_path = "./models/" + str(self.current_model_folder) + "/model.onnx"
-        quantized_model_path = model_path.replace('.onnx', '_quantized.onnx')
-        
-        quantize_dynamic(model_path,
-                        quantized_model_path,
-                        weight_type=QuantType.QUInt8)
-        
-        print(f"Quantized model saved to: {quantized_model_path}")
-        
-        sess = ort.InferenceSession(quantized_model_path)
-
-        input_name = sess.get_inputs()[0].name
-        print("input name", input_name)
-        input_shape = sess.get_inputs()[0].shape
-        print("input shape", input_shape)
-        input_type = sess.get_inputs()[0].type
-        print("input type", input_type)
-
-        dummy_input = numpy.random.randn(
-            1, 
-            4, 
-            self.board_size, 
-            self.board_size
-        ).astype(numpy.float32)
-        output = sess.run(None, {input_name: dummy_input})
-        print(output)
-        print("Quantized model inference successful")
-
-    def torch_to_onnx(self):
-        onnx_path = "./test.onnx"
-        input_tensor = torch.randn(1, 4, 9, 9)
-        input_tensor = input_tensor.to(self.device)
-
-        with torch.no_grad():
-            output = self.model(input_tensor)
-
-            print("Output")
-
-            torch.onnx.export(
-                self.model, 
-                input_tensor, 
-                onnx_path, 
-                input_names = ['input'], 
-                output_names = ['output'],
-                dynamic_axes = {'input': {0: 'batch_size'}, 'output': {0: 'batch_size'}},
-                opset_version = 11
-            )  
-            
-    def static_quantization(self):
-        pass
-
-    def dynamic_quantization(self):
-        model_quantized_dynamic = torch.ao.quantization.quantize_dynamic(
-            self.model, {torch.nn.Linear}, dtype=torch.qint8
+    model = ResidualNetwork(
+        game,
+        architecture['resblocks'],
+        architecture['hiddenlayers'],
+        architecture['inputarrays'],
+        torch.device("cpu")
+    )
+    model.load_state_dict(state_dict)
+    model.eval()
+    return game, model, architecture
+
+def calibration_positions(game, model, count, searches=32, seed=None):
+    """Encoded states of `count` positions from self-play with `model`
+
+    Whole games are played with the usual root noise and visit count
+    sampling, so the positions cover openings as well as endgames.
+    """
+    if seed is not None:
+        random.seed(seed)
+        numpy.random.seed(seed)
+    args = {
+        'C': 2,
+        'num_searches': searches,
+        'leaf_batch': 1,
+        'dirichlet_epsilon': 0.25,
+        'dirichlet_alpha': 0.3,
+        'reuse_tree': True,
+    }
+    mcts = MCTS(game, args, model)
+    positions = []
+    while len(positions) < count:
+        memory, _ = mcts.run(self_play_steps(game, args, mcts))
+        positions.extend(encoded_state for encoded_state, _, _ in memory)
+    positions = numpy.stack(positions).astype(numpy.float32)
+    numpy.random.shuffle(positions)
+    return positions[:count]
+
+def batches(positions, batch_size):
+    for start in range(0, len(positions), batch_size):
+        yield positions[start:start + batch_size]
+
+@torch.no_grad()
+def quantize_torch(model, calibration, batch_size=64, engine=None):
+    """Static INT8 TorchScript module of `model` calibrated on `calibration`
+
+    FX graph mode quantization folds the batch norms, fuses conv + relu
+    and the residual add + relu, and observes activation ranges on the
+    calibration batches.
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+    engine = engine or torch.backends.quantized.engine
+    torch.backends.quantized.engine = engine
+    example = torch.from_numpy(calibration[:1])
+    with warnings.catch_warnings():
+        # torch.ao quantization is deprecated in favour of torchao
+        warnings.simplefilter("ignore", DeprecationWarning)
+        warnings.simplefilter("ignore", UserWarning)
+        prepared = prepare_fx(
+            copy.deepcopy(model).eval(),
+            get_default_qconfig_mapping(engine),
+            (example,)
         )
-
-        # # Copy model to qunatize
-        # model_to_quantize = copy.deepcopy(self.model).to(self.device)
-        # model_to_quantize.eval()
-        # qconfig_mapping = QConfigMapping().set_global(torch.ao.quantization.default_dynamic_qconfig)
-
-        # example_inputs = torch.randn(32, 4, 3, 3)
-
-        # # prepare
-        # model_prepared = quantize_fx.prepare_fx(
-        #     model_to_quantize, 
-        #     qconfig_mapping, 
-        #     example_inputs
-        # )
-        # # no calibration needed when we only have dynamic/weight_only quantization
-        # # quantize
-        # model_quantized_dynamic = quantize_fx.convert_fx(model_prepared)
-
-        #         # Copy model to qunatize
-        # model_to_quantize = copy.deepcopy(self.model).to(self.device)
-        # model_to_quantize.eval()
-        # qconfig_mapping = QConfigMapping().set_global(
-        #     torch.ao.quantization.default_dynamic_qconfig
-        # )
-
-        # Save the quantized model
-        torch.save(
-            model_quantized_dynamic.state_dict(), 
-            "./models_int8/" + str(self.current_model_folder) + "/quantized_model.pth"
-        )
-
-        # If you want to save the entire model (architecture + weights)
-        torch.save(
-            model_quantized_dynamic, 
-            "./models_int8/" + str(self.current_model_folder) + "/quantized_model_full.pth"
+        for batch in batches(calibration, batch_size):
+            prepared(torch.from_numpy(batch))
+        quantized = convert_fx(prepared)
+        warnings.simplefilter("ignore", FutureWarning)
+        return torch.jit.freeze(torch.jit.trace(quantized, example))
+
+class CalibrationReader:
+    """Calibration batches in the data reader protocol of onnxruntime
+    """
+    def __init__(self, input_name, calibration, batch_size=64):
+        self.input_name = input_name
+        self.calibration = calibration
+        self.batch_size = batch_size
+        self.rewind()
+
+    def get_next(self):
+        batch = next(self.batches, None)
+        return None if batch is None else {self.input_name: batch}
+
+    def rewind(self):
+        self.batches = batches(self.calibration, self.batch_size)
+
+def quantize_onnx(model, calibration, fp32_path, int8_path, batch_size=64):
+    """Writes the FP32 ONNX export of `model` and its static INT8 version
+
+    The INT8 graph uses QDQ nodes with per channel weight scales.
+    """
+    if ort_quantization is None:
+        raise ImportError("ONNX quantization needs the onnxruntime package")
+    with open(fp32_path, "wb") as file:
+        file.write(export_onnx(model))
+    input_name = onnxruntime.InferenceSession(
+        fp32_path,
+        providers=['CPUExecutionProvider']
+    ).get_inputs()[0].name
+    with tempfile.TemporaryDirectory() as directory:
+        # shape inference and graph optimization ahead of quantization
+        prepared = os.path.join(directory, "prepared.onnx")
+        try:
+            ort_quantization.quant_pre_process(fp32_path, prepared)
+        except Exception:
+            prepared = fp32_path
+        ort_quantization.quantize_static(
+            prepared,
+            int8_path,
+            CalibrationReader(input_name, calibration, batch_size),
+            quant_format=ort_quantization.QuantFormat.QDQ,
+            per_channel=True,
+            activation_type=ort_quantization.QuantType.QUInt8,
+            weight_type=ort_quantization.QuantType.QInt8
         )
 
-    def test_int8_models(self):
-        # warnings.filterwarnings('ignore', category=UserWarning, message='TypedStorage is deprecated')
-
-        loaded_model = torch.load(
-            "./models_int8/" + str(self.current_model_folder) + "/quantized_model_full.pth",
-            map_location=self.device
+def latency(backend, positions, batch_size, repeats=50):
+    """Median milliseconds of one evaluation of `batch_size` positions
+    """
+    batch = positions[:batch_size]
+    backend.evaluate(batch)
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        backend.evaluate(batch)
+        times.append(time.perf_counter() - start)
+    return 1000 * float(numpy.median(times))
+
+def log_softmax(logits):
+    logits = logits - logits.max(axis=1, keepdims=True)
+    return logits - numpy.log(numpy.exp(logits).sum(axis=1, keepdims=True))
+
+def compare(reference, outputs):
+    """Policy KL(reference || outputs) and value errors, means over positions
+    """
+    reference_log = log_softmax(reference[0].astype(numpy.float64))
+    log = log_softmax(outputs[0].astype(numpy.float64))
+    kl = (numpy.exp(reference_log) * (reference_log - log)).sum(axis=1)
+    error = numpy.abs(reference[1] - outputs[1])
+    top = reference[0].argmax(axis=1) == outputs[0].argmax(axis=1)
+    return {
+        'policy_kl': float(kl.mean()),
+        'policy_kl_max': float(kl.max()),
+        'top1_agreement': float(top.mean()),
+        'value_mae': float(error.mean()),
+        'value_max_error': float(error.max()),
+    }
+
+def evaluate_all(backend, positions, batch_size):
+    policies = []
+    values = []
+    for batch in batches(positions, batch_size):
+        policy, value = backend.evaluate(batch)
+        policies.append(numpy.array(policy))
+        values.append(numpy.array(value))
+    return numpy.concatenate(policies), numpy.concatenate(values)
+
+def report(variants, positions, batch_size):
+    """Latency, size and accuracy of every (name, backend, path) variant
+
+    The first variant is the FP32 reference.
+    """
+    reference = None
+    rows = []
+    for name, backend, path in variants:
+        outputs = evaluate_all(backend, positions, batch_size)
+        if reference is None:
+            reference = outputs
+        row = {
+            'variant': name,
+            'bytes': os.path.getsize(path),
+            'latency_ms_1': latency(backend, positions, 1),
+            f'latency_ms_{batch_size}': latency(backend, positions, batch_size),
+        }
+        row.update(compare(reference, outputs))
+        rows.append(row)
+    print(
+        f"\n{'variant':<12}{'size kB':>10}{'ms @1':>10}{f'ms @{batch_size}':>10}"
+        f"{'KL':>12}{'top-1':>8}{'value MAE':>12}{'value max':>12}"
+    )
+    for row in rows:
+        print(
+            f"{row['variant']:<12}{row['bytes'] / 1024:>10.1f}"
+            f"{row['latency_ms_1']:>10.3f}{row[f'latency_ms_{batch_size}']:>10.3f}"
+            f"{row['policy_kl']:>12.2e}{row['top1_agreement']:>8.3f}"
+            f"{row['value_mae']:>12.2e}{row['value_max_error']:>12.2e}"
         )
+    return rows
+
+def _parse_args():
+    p = argparse.ArgumentParser(description="Static INT8 quantization of an AlphaZero checkpoint")
+    p.add_argument("--model-id", type=str, default="alphazero")
+    p.add_argument("--checkpoint", type=str, default=None, help="state dict to quantize, found in models/<model-id>/ if not given")
+    p.add_argument("--formats", nargs="+", choices=["torch", "onnx"], default=["torch", "onnx"])
+    p.add_argument("--positions", type=int, default=1024, help="self-play positions calibrating the activation ranges")
+    p.add_argument("--eval-positions", type=int, default=256, help="held out self-play positions of the report")
+    p.add_argument("--searches", type=int, default=32, help="MCTS searches per move of the calibration games")
+    p.add_argument("--batch-size", type=int, default=64)
+    p.add_argument("--engine", type=str, default=None, help="torch quantized engine, e.g. x86, fbgemm or qnnpack")
+    p.add_argument("--out", type=str, default=None, help="output directory, models/<model-id>/int8 by default")
+    p.add_argument("--seed", type=int, default=0)
+    return p.parse_args()
+
+
+def main():
+    args = _parse_args()
+    checkpoint = find_checkpoint(args.model_id, args.checkpoint)
+    game, model, architecture = load_model(checkpoint)
+    print(f"Loaded {checkpoint}: {architecture}")
+    out = args.out or os.path.join("models", args.model_id, "int8")
+    os.makedirs(out, exist_ok=True)
+
+    print(f"Recording {args.positions} calibration positions from self-play")
+    calibration = calibration_positions(
+        game,
+        model,
+        args.positions,
+        args.searches,
+        args.seed
+    )
+    # positions of other games, the report must not see the calibration set
+    held_out = calibration_positions(
+        game,
+        model,
+        args.eval_positions,
+        args.searches,
+        args.seed + 1
+    )
+
+    variants = [('torch fp32', TorchBackend(model), checkpoint)]
+    if "torch" in args.formats:
+        path = os.path.join(out, "model_int8.pt")
+        quantized = quantize_torch(model, calibration, args.batch_size, args.engine)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", FutureWarning)
+            torch.jit.save(quantized, path)
+        print(f"Static INT8 TorchScript model saved to {path}")
+        variants.append(('torch int8', QuantizedBackend(path=path), path))
+    if "onnx" in args.formats:
+        fp32_path = os.path.join(out, "model.onnx")
+        path = os.path.join(out, "model_int8.onnx")
+        quantize_onnx(model, calibration, fp32_path, path, args.batch_size)
+        print(f"Static INT8 ONNX model saved to {path}")
+        variants.append(('onnx fp32', OnnxBackend(path=fp32_path), fp32_path))
+        variants.append(('onnx int8', OnnxBackend(path=path), path))
+
+    rows = report(variants, held_out, args.batch_size)
+    with open(os.path.join(out, "report.json"), "w") as file:
+        json.dump({
+            'checkpoint': checkpoint,
+            'architecture': architecture,
+            'engine': args.engine or torch.backends.quantized.engine,
+            'calibration_positions': len(calibration),
+            'eval_positions': len(held_out),
+            'variants': rows,
+        }, file, indent=2)
+    print(f"Report saved to {os.path.join(out, 'report.json')}")
 
-        loaded_model.eval()
 
 if __name__ == "__main__":
-    convertModel = ConvertModel()
-    # convertModel.pytorch2coral()
-    # convertModel.torch_to_onnx()
-    convertModel.convert_to_onnx()
-    convertModel.quantize_onnx_model()
-    # convertModel.dynamic_quantization()
-    # convertModel.test_int8_models()
\ No newline at end of file
+    main()
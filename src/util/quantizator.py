@@ -2,69 +2,69 @@
 author: Tim Straube
 contact: hi@optimalpi.com
 licence: MIT
+
+Full INT8 TFLite conversion of a TensorFlow SavedModel of the network,
+e.g. for the Coral edge TPU.
+
+    PYTHONPATH=src python src/util/quantizator.py --saved-model <dir> --model-id alphazero
+
+The representative dataset consists of self-play positions of the
+PyTorch checkpoint the SavedModel was converted from, see
+util/quantization.py. TensorFlow is only imported when converting.
 """
 
-import tensorflow as tf
-import random
-import numpy
-from agents.alphazero.residualnetwork import ResidualNetwork
-from envs.battleship import Battleship
-from src.agents.alphazero.mcts import MCTS
+import argparse
+from util.quantization import calibration_positions
+from util.quantization import find_checkpoint
+from util.quantization import load_model
 
-def quantize_model(converter):
-    board_size = 9
-    game = Battleship(board_size)   
-    state = game.restart(0)
-    model = ResidualNetwork(
-                game, 
-                4, 
-                9, 
-                9, 
-                device = 'cpu'
-            )
-    random_number_moves = random.randint(
-        28, 
-        2 * board_size * board_size
-    )
-    args = {
-        'C': 2,
-        'num_searches': 100,
-        'dirichlet_epsilon': 0,
-        'dirichlet_alpha': 0.1
-    }
-    mcts = MCTS(game, args, model)
-    player = -1
+def quantize_model(saved_model_dir, calibration):
+    """INT8 TFLite flatbuffer of a SavedModel, calibrated on `calibration`
 
-    def representative_data_gen(game, state, mcts, player, random_number_moves):
-        for _ in range(random_number_moves):
-            neutral_state = game.change_perspective(
-                game.get_encoded_state(state), player
-            )
-            mcts_probs = mcts.search(neutral_state)
-            action = numpy.argmax(mcts_probs)
-            state = game.step(
-                game.get_encoded_state(state), 
-                action, 
-                player
-            )
-            player = -player
-            yield state
+    Inputs and outputs stay float32, the encoded planes are 0/1.
+    """
+    import tensorflow
 
-    converter.optimizations = [tf.lite.Optimize.DEFAULT]
-    converter.representative_dataset = representative_data_gen(game,state, mcts, player, random_number_moves)
-    converter.target_spec.supported_ops = [
-        tf.lite.OpsSet.TFLITE_BUILTINS_INT8,        
-        tf.lite.OpsSet.SELECT_TF_OPS # enable TensorFlow ops.   
-        ]
-    converter.inference_input_type = tf.uint8
-    converter.inference_output_type = tf.uint8
+    def representative_data_gen():
+        for encoded_state in calibration:
+            yield [encoded_state[None]]
 
+    converter = tensorflow.lite.TFLiteConverter.from_saved_model(saved_model_dir)
+    converter.optimizations = [tensorflow.lite.Optimize.DEFAULT]
+    converter.representative_dataset = representative_data_gen
+    converter.target_spec.supported_ops = [
+        tensorflow.lite.OpsSet.TFLITE_BUILTINS_INT8
+    ]
+    converter.inference_input_type = tensorflow.float32
+    converter.inference_output_type = tensorflow.float32
     return converter.convert()
 
+def _parse_args():
+    p = argparse.ArgumentParser(description="INT8 TFLite conversion of a SavedModel")
+    p.add_argument("--saved-model", type=str, required=True)
+    p.add_argument("--model-id", type=str, default="alphazero")
+    p.add_argument("--checkpoint", type=str, default=None, help="PyTorch state dict of the same network, for the calibration games")
+    p.add_argument("--positions", type=int, default=1024)
+    p.add_argument("--searches", type=int, default=32)
+    p.add_argument("--out", type=str, default="model_int8.tflite")
+    p.add_argument("--seed", type=int, default=0)
+    return p.parse_args()
 
-saved_model_dir = '.'
 
-converter = tf.lite.TFLiteConverter.from_saved_model(saved_model_dir)
+def main():
+    args = _parse_args()
+    game, model, _ = load_model(find_checkpoint(args.model_id, args.checkpoint))
+    calibration = calibration_positions(
+        game,
+        model,
+        args.positions,
+        args.searches,
+        args.seed
+    )
+    with open(args.out, "wb") as file:
+        file.write(quantize_model(args.saved_model, calibration))
+    print(f"INT8 TFLite model saved to {args.out}")
+
 
-tflite_model = quantize_model(converter)
-open("vivalavida.tflite", "wb").write(tflite_model)
+if __name__ == "__main__":
+    main()
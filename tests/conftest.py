@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the code imports its packages relative to src, as train.sh sets PYTHONPATH
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
@@ -0,0 +1,55 @@
+import numpy
+from agents.alphazero.cache import EvaluationCache, combine_stats
+
+def counting_forward(calls):
+    def forward(batch):
+        calls.append(len(batch))
+        flat = batch.reshape(len(batch), -1).astype(numpy.float32)
+        return flat * 2, flat.sum(axis=1)
+    return forward
+
+def test_duplicate_states_in_a_batch_are_evaluated_once():
+    rng = numpy.random.default_rng(0)
+    states = rng.integers(0, 2, (3, 2, 4, 4)).astype(numpy.uint8)
+    batch = states[[0, 1, 0, 2, 1, 0]]
+    calls = []
+    forward = counting_forward(calls)
+    cache = EvaluationCache(100)
+    logits, values = cache.evaluate(batch, forward)
+    assert calls == [3]
+    expected_logits, expected_values = forward(batch)
+    numpy.testing.assert_array_equal(logits, expected_logits)
+    numpy.testing.assert_array_equal(values, expected_values)
+    stats = cache.stats()
+    assert stats['entries'] == 3
+    assert stats['misses'] == 3
+    assert stats['hits'] == 3
+
+def test_cached_states_are_not_recomputed():
+    rng = numpy.random.default_rng(1)
+    states = rng.integers(0, 2, (4, 2, 4, 4)).astype(numpy.uint8)
+    calls = []
+    forward = counting_forward(calls)
+    cache = EvaluationCache(100)
+    cache.evaluate(states[:2], forward)
+    logits, values = cache.evaluate(states[[3, 0, 3, 1, 2]], forward)
+    assert calls == [2, 2]
+    numpy.testing.assert_array_equal(values, forward(states[[3, 0, 3, 1, 2]])[1])
+    assert cache.stats()['hits'] == 3
+    assert cache.stats()['misses'] == 4
+
+def test_combined_stats_add_up_the_caches():
+    rng = numpy.random.default_rng(2)
+    states = rng.integers(0, 2, (4, 2, 4, 4)).astype(numpy.uint8)
+    forward = counting_forward([])
+    first = EvaluationCache(100)
+    second = EvaluationCache(100)
+    first.evaluate(states[[0, 0, 1]], forward)
+    second.evaluate(states[[2, 3]], forward)
+    second.evaluate(states[[2]], forward)
+    total = combine_stats([first.stats(), None, second.stats()])
+    assert total['entries'] == 4
+    assert total['hits'] == 2
+    assert total['misses'] == 4
+    assert total['hit_rate'] == 2 / 6
+    assert combine_stats([None]) is None
@@ -0,0 +1,56 @@
+import random
+import numpy
+import pytest
+from envs.battleship import Battleship
+from envs.batched import BatchedBattleship
+from envs.bitboard import BitboardBattleship
+
+def play_random_game(game, rng):
+    """Plays a random game, comparing counters and board after every move
+    """
+    player = 1
+    state = game.restart(player)
+    while True:
+        valid = numpy.flatnonzero(game.get_valid_moves(state, player))
+        action = int(rng.choice(valid))
+        # check mode compares the counters with the board inside step
+        state = game.step(state, action, player)
+        game.check_counters(state)
+        value, is_terminal = game.terminated(state, action)
+        if is_terminal:
+            assert min(state.remaining) == 0
+            return
+        player = -player
+
+@pytest.mark.parametrize("engine", [Battleship, BitboardBattleship])
+@pytest.mark.parametrize("size", [5, 7])
+def test_counters_match_the_board(engine, size):
+    random.seed(size)
+    rng = numpy.random.default_rng(size)
+    game = engine(size, check=True)
+    for _ in range(5):
+        play_random_game(game, rng)
+
+@pytest.mark.parametrize("engine", [Battleship, BitboardBattleship])
+def test_check_mode_detects_a_stale_counter(engine):
+    random.seed(0)
+    game = engine(5, check=True)
+    state = game.restart(1)
+    state.remaining[0] -= 1
+    with pytest.raises(RuntimeError):
+        game.check_counters(state)
+
+def test_batched_counters_match_the_boards():
+    random.seed(3)
+    rng = numpy.random.default_rng(3)
+    env = BatchedBattleship(5, 16, check=True)
+    players = numpy.ones(env.games, dtype=numpy.int64)
+    finished = 0
+    while finished < 64:
+        valid = env.valid_moves_many(players)
+        actions = numpy.argmax(rng.random(valid.shape) * valid, axis=1)
+        # check mode compares `remaining` with count_remaining in every step
+        _, terminated = env.step_many(actions, players)
+        assert numpy.array_equal(env.remaining, env.count_remaining())
+        finished += int(terminated.sum())
+        players = numpy.where(terminated, 1, -players)
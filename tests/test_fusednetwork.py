@@ -0,0 +1,67 @@
+import pytest
+import torch
+from agents.alphazero.fusednetwork import FusedNetwork
+from agents.alphazero.fusednetwork import InferenceModel
+from agents.alphazero.fusednetwork import build_inference_model
+from agents.alphazero.fusednetwork import input_shape
+from agents.alphazero.fusednetwork import verify_equivalence
+from agents.alphazero.residualnetwork import ResidualNetwork
+from envs.battleship import Battleship
+
+def trained_model():
+    """Small network whose batch norms have non-trivial statistics
+    """
+    torch.manual_seed(0)
+    model = ResidualNetwork(Battleship(5), 1, 4, 4, torch.device("cpu"))
+    for module in model.modules():
+        if isinstance(module, torch.nn.BatchNorm2d):
+            torch.nn.init.uniform_(module.weight, 0.5, 1.5)
+            torch.nn.init.uniform_(module.bias, -0.5, 0.5)
+    model.train()
+    with torch.no_grad():
+        for _ in range(8):
+            model(torch.rand(16, *input_shape(model)) * 3)
+    return model.eval()
+
+def uint8_planes(model, batch_size=16):
+    return torch.randint(
+        0,
+        2,
+        (batch_size, *input_shape(model)),
+        dtype=torch.uint8,
+        generator=torch.Generator().manual_seed(1)
+    )
+
+@torch.no_grad()
+def test_folded_batch_norms_match_the_model_on_uint8_planes():
+    model = trained_model()
+    start = model.startBlock[1]
+    assert start.running_mean.abs().max() > 0.1
+    assert (start.running_var - 1).abs().max() > 0.1
+    x = uint8_planes(model)
+    policy, value = model(x)
+    fused_policy, fused_value = FusedNetwork(model).eval()(x)
+    torch.testing.assert_close(fused_policy, policy, atol=1e-5, rtol=1e-4)
+    torch.testing.assert_close(fused_value, value, atol=1e-5, rtol=1e-4)
+
+@pytest.mark.parametrize("mode", ["script", "compile", "eager"])
+@torch.no_grad()
+def test_build_inference_model(mode):
+    model = trained_model()
+    inference_model = build_inference_model(model, mode)
+    assert inference_model.mode == mode
+    errors = verify_equivalence(model, inference_model)
+    assert errors['policy'] < 1e-4 and errors['value'] < 1e-4
+    x = uint8_planes(model)
+    policy, value = model(x)
+    fused_policy, fused_value = inference_model(x)
+    torch.testing.assert_close(fused_policy, policy, atol=1e-4, rtol=1e-4)
+    torch.testing.assert_close(fused_value, value, atol=1e-4, rtol=1e-4)
+
+@torch.no_grad()
+def test_verify_equivalence_rejects_a_wrong_build():
+    model = trained_model()
+    fused = FusedNetwork(model).eval()
+    fused.policyLinear.bias += 1
+    with pytest.raises(RuntimeError):
+        verify_equivalence(model, InferenceModel(fused, model.device, "eager"))
@@ -0,0 +1,40 @@
+import numpy
+import pytest
+import torch
+from agents.alphazero.inference import InferenceClient, InferenceServer
+from agents.alphazero.residualnetwork import ResidualNetwork
+from agents.alphazero.workers import SharedWeights
+from envs.battleship import Battleship
+
+def serve(backend):
+    torch.manual_seed(0)
+    game = Battleship(5)
+    model_config = (1, 4, 4)
+    model = ResidualNetwork(game, *model_config, torch.device("cpu")).eval()
+    weights = SharedWeights.create(model.state_dict())
+    server = InferenceServer(game, model_config, weights, 1, 8, threads=1, backend=backend)
+    client = InferenceClient(0, *server.client_args())
+    batch = numpy.random.default_rng(0).integers(0, 2, (3, 4, 5, 5)).astype(game.encoded_dtype)
+    return model, weights, server, client, batch
+
+def test_client_gets_the_model_output():
+    model, weights, server, client, batch = serve({'backend': 'torch'})
+    try:
+        policy, value = client.evaluate(batch)
+        with torch.no_grad():
+            expected_policy, expected_value = model(torch.as_tensor(batch))
+        numpy.testing.assert_allclose(policy, expected_policy.numpy(), atol=1e-5)
+        numpy.testing.assert_allclose(value, expected_value.numpy().reshape(-1), atol=1e-5)
+    finally:
+        server.close()
+        weights.close()
+
+def test_client_raises_when_the_server_died():
+    # the server process fails while building its backend
+    _, weights, server, client, batch = serve({'backend': 'missing'})
+    try:
+        with pytest.raises(RuntimeError):
+            client.evaluate(batch)
+    finally:
+        server.close()
+        weights.close()
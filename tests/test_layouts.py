@@ -0,0 +1,9 @@
+import os
+from envs import layouts
+
+def test_layout_cache_is_below_the_repository_root(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    assert os.path.realpath(layouts.LAYOUT_DIR) == os.path.join(os.path.realpath(root), "models", "layouts")
+    layouts.FleetLayouts(4, (2, 2))
+    assert not os.path.exists(tmp_path / "models")
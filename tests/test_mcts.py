@@ -0,0 +1,57 @@
+import random
+import numpy
+import pytest
+import torch
+from agents.alphazero.mcts import MCTS
+from agents.alphazero.residualnetwork import ResidualNetwork
+from envs.battleship import Battleship
+
+def make_mcts(**args):
+    random.seed(0)
+    numpy.random.seed(0)
+    torch.manual_seed(0)
+    game = Battleship(5)
+    model = ResidualNetwork(game, 1, 4, 4, torch.device("cpu"))
+    model.eval()
+    args = dict({
+        'C': 2,
+        'num_searches': 16,
+        'dirichlet_epsilon': 0.25,
+        'dirichlet_alpha': 0.3,
+    }, **args)
+    return game, MCTS(game, args, model)
+
+@pytest.mark.parametrize("limits", [
+    {'time_limit': 0},
+    {'max_simulations': 0},
+    {'time_limit': 0, 'max_simulations': 0},
+])
+def test_search_timed_runs_at_least_one_simulation(limits):
+    game, mcts = make_mcts(leaf_batch=4)
+    probs, stats = mcts.search_timed(game.restart(1), **limits)
+    assert stats['simulations'] >= 1
+    assert numpy.isfinite(probs).all()
+    assert probs.sum() == pytest.approx(1)
+
+def test_search_timed_stops_at_max_simulations():
+    game, mcts = make_mcts()
+    probs, stats = mcts.search_timed(game.restart(1), time_limit=60, max_simulations=10)
+    assert stats['simulations'] == 10
+    assert stats['stopped'] == 'simulations'
+
+def test_search_time_ms_caps_num_searches():
+    game, mcts = make_mcts(search_time_ms=60_000)
+    tree = mcts.prepare(game.restart(1))
+    assert mcts.run(mcts.simulate_steps(tree)) == 16
+    game, mcts = make_mcts(search_time_ms=1e-6, num_searches=10_000)
+    tree = mcts.prepare(game.restart(1))
+    assert 1 <= mcts.run(mcts.simulate_steps(tree)) < 10_000
+
+def test_search_timed_with_gumbel_root_search():
+    game, mcts = make_mcts(root_search='gumbel', gumbel_actions=4)
+    with pytest.raises(ValueError):
+        mcts.search_timed(game.restart(1), time_limit=1)
+    probs, stats = mcts.search_timed(game.restart(1), max_simulations=8)
+    assert stats['simulations'] == 8
+    assert numpy.isfinite(probs).all()
+    assert probs.sum() == pytest.approx(1)
@@ -0,0 +1,94 @@
+import math
+import random
+import numpy
+import pytest
+from agents.alphazero import puct
+from agents.alphazero.puct import select_child
+from agents.alphazero.tree import Tree
+from envs.battleship import Battleship
+
+def reference_select(visit_count, value_sum, prior, parent_visits, c):
+    """The loop of the former `Node.select` / `Node.get_ucb`
+    """
+    best_child = None
+    best_ucb = -numpy.inf
+    for child in range(len(visit_count)):
+        if visit_count[child] == 0:
+            q_value = 0
+        else:
+            q_value = 1 - ((value_sum[child] / visit_count[child]) + 1) / 2
+        ucb = q_value + c * (math.sqrt(parent_visits) / (visit_count[child] + 1)) * prior[child]
+        if ucb > best_ucb:
+            best_child = child
+            best_ucb = ucb
+    return best_child
+
+def random_statistics(rng, children):
+    visit_count = rng.integers(0, 50, children).astype(numpy.int64)
+    # zero visits for some children
+    visit_count[rng.random(children) < 0.3] = 0
+    value_sum = (rng.uniform(-1, 1, children) * visit_count).astype(numpy.float64)
+    prior = rng.dirichlet(numpy.ones(children))
+    parent_visits = int(visit_count.sum()) + 1
+    return visit_count, value_sum, prior, parent_visits
+
+def implementations():
+    compiled = [True] if puct._select_numba is not None else []
+    return [False] + compiled
+
+@pytest.mark.parametrize("compiled", implementations())
+def test_selection_matches_the_reference_loop(compiled):
+    rng = numpy.random.default_rng(0)
+    for _ in range(500):
+        children = int(rng.integers(1, 40))
+        statistics = random_statistics(rng, children)
+        c = float(rng.choice([0.5, 1.0, 2.0]))
+        assert select_child(*statistics, c, compiled) == reference_select(*statistics, c)
+
+@pytest.mark.parametrize("compiled", implementations())
+def test_ties_pick_the_first_child(compiled):
+    visit_count = numpy.zeros(6, dtype=numpy.int64)
+    value_sum = numpy.zeros(6)
+    prior = numpy.full(6, 1 / 6)
+    assert select_child(visit_count, value_sum, prior, 1, 2.0, compiled) == 0
+    assert reference_select(visit_count, value_sum, prior, 1, 2.0) == 0
+    # equal scores behind a worse first child
+    visit_count = numpy.array([3, 1, 1, 1], dtype=numpy.int64)
+    value_sum = numpy.array([3.0, 0.0, 0.0, 0.0])
+    prior = numpy.full(4, 0.25)
+    expected = reference_select(visit_count, value_sum, prior, 7, 2.0)
+    assert expected == 1
+    assert select_child(visit_count, value_sum, prior, 7, 2.0, compiled) == expected
+
+@pytest.mark.parametrize("compiled", implementations())
+def test_tree_select_with_virtual_loss_matches_the_reference(compiled):
+    random.seed(0)
+    rng = numpy.random.default_rng(1)
+    game = Battleship(5)
+    args = {'C': 2, 'num_searches': 8, 'compiled_puct': compiled}
+    for _ in range(100):
+        tree = Tree(game, args, game.restart(1))
+        children = int(rng.integers(2, 25))
+        tree.expand(0, numpy.concatenate((
+            rng.dirichlet(numpy.ones(children)),
+            numpy.zeros(game.actions - children)
+        )))
+        block = slice(1, 1 + children)
+        visit_count, value_sum, _, parent_visits = random_statistics(rng, children)
+        tree.visit_count[block] = visit_count
+        tree.value_sum[block] = value_sum
+        tree.visit_count[0] = parent_visits
+        # pending evaluations through some children
+        virtual = numpy.zeros(children, dtype=numpy.int64)
+        for child in rng.choice(children, int(rng.integers(0, min(children, 4))), replace=False):
+            tree.add_virtual_loss(1 + int(child))
+            virtual[child] += 1
+        # a virtual loss counts as a visit won by the child's player
+        expected = reference_select(
+            visit_count + virtual,
+            value_sum + virtual,
+            tree.prior[block],
+            parent_visits + virtual.sum(),
+            2
+        )
+        assert tree.select(0) == 1 + expected
@@ -0,0 +1,27 @@
+import random
+import numpy
+from agents.random.main import RandomAgent
+
+def test_play_batched_finishes_every_started_game(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    random.seed(0)
+    numpy.random.seed(0)
+    agent = RandomAgent(size=5, episodes=10, batch=4)
+    lengths = agent.play_batched(10)
+    assert len(lengths) == 10
+    assert all(length > 0 for length in lengths)
+
+def test_play_batched_is_not_biased_to_short_games(tmp_path, monkeypatch):
+    # with one lane per game every lane plays exactly one game to the end,
+    # keeping the first games to finish would drop the longest ones
+    monkeypatch.chdir(tmp_path)
+    random.seed(1)
+    numpy.random.seed(1)
+    agent = RandomAgent(size=5, episodes=64, batch=64)
+    lengths = agent.play_batched(64)
+    assert len(lengths) == 64
+    random.seed(1)
+    numpy.random.seed(1)
+    sequential = [agent.play_one() for _ in range(64)]
+    # 64 games each, the means agree within a few moves
+    assert abs(numpy.mean(lengths) - numpy.mean(sequential)) < 6
@@ -0,0 +1,54 @@
+import random
+import numpy
+import pytest
+import torch
+from agents.alphazero.residualnetwork import ResidualNetwork
+from agents.alphazero.rootparallel import RootParallelMCTS
+from envs.battleship import Battleship
+
+ARGS = {
+    'C': 2,
+    'num_searches': 16,
+    'dirichlet_epsilon': 0.25,
+    'dirichlet_alpha': 0.3,
+}
+
+def search_twice(mode, seed, args=ARGS):
+    random.seed(0)
+    torch.manual_seed(0)
+    game = Battleship(5)
+    model = ResidualNetwork(game, 1, 4, 4, torch.device("cpu"))
+    model.eval()
+    state = game.restart(1)
+    searcher = RootParallelMCTS(game, args, model, trees=3, mode=mode, seed=seed)
+    try:
+        searchers = searcher.searchers
+        results = [searcher.search(state), searcher.search(state)]
+        # the trees keep their MCTS between searches
+        assert searcher.searchers is searchers
+        stats = searcher.cache_stats()
+    finally:
+        searcher.close()
+    return results, stats
+
+def test_threads_and_processes_agree():
+    threads, _ = search_twice("threads", 7)
+    processes, _ = search_twice("processes", 7)
+    for thread_probs, process_probs in zip(threads, processes):
+        assert thread_probs.sum() == pytest.approx(1)
+        numpy.testing.assert_allclose(thread_probs, process_probs)
+    # every search draws new noise
+    assert not numpy.array_equal(threads[0], threads[1])
+
+def test_cache_stats_cover_every_tree():
+    args = dict(ARGS, eval_cache=1000)
+    _, thread_stats = search_twice("threads", 7, args)
+    _, process_stats = search_twice("processes", 7, args)
+    assert thread_stats['misses'] > 0 and process_stats['misses'] > 0
+    # the same searches look up the same states, whichever cache they hit
+    assert (
+        thread_stats['hits'] + thread_stats['misses'] ==
+        process_stats['hits'] + process_stats['misses']
+    )
+    _, stats = search_twice("threads", 7)
+    assert stats is None
@@ -0,0 +1,67 @@
+import random
+import numpy
+import pytest
+from agents.alphazero.tree import Tree
+from envs.battleship import Battleship
+
+def narrowed_tree(**args):
+    random.seed(0)
+    game = Battleship(5)
+    args = dict({'C': 2, 'num_searches': 8, 'expand_prior_mass': 0.5}, **args)
+    tree = Tree(game, args, game.restart(1))
+    rng = numpy.random.default_rng(0)
+    tree.expand(0, rng.dirichlet(numpy.ones(game.actions)))
+    child = tree.first_child[0]
+    state = tree.state(child)
+    policy = game.policy(rng.dirichlet(numpy.ones(game.actions)), state)
+    tree.expand(child, policy)
+    return game, tree, child, policy
+
+@pytest.mark.parametrize("args", [
+    {'expand_prior_mass': 0.5},
+    {'expand_top_k': 3},
+    {'expand_top_k': 3, 'widening': 1.0},
+])
+def test_reused_root_gets_all_legal_moves_back(args):
+    game, tree, child, policy = narrowed_tree(**args)
+    legal = numpy.flatnonzero(policy > 0)
+    assert 0 < tree.num_children[child] < len(legal)
+    kept = tree.children(child)
+    grandchild = kept.start
+    tree.visit_count[grandchild] = 5
+    tree.value_sum[grandchild] = 2.0
+    subtree = tree.subtree(child)
+    children = subtree.children(0)
+    assert sorted(subtree.action[children.start:children.stop]) == list(legal)
+    numpy.testing.assert_allclose(
+        subtree.prior[children.start:children.stop],
+        policy[subtree.action[children.start:children.stop]]
+    )
+    # statistics of the children that were kept carry over
+    kept_child = subtree.child(0, int(tree.action[grandchild]))
+    assert subtree.visit_count[kept_child] == 5
+    assert subtree.value_sum[kept_child] == 2.0
+    assert subtree.widened(0) == len(legal)
+    # new children materialize their states from the root
+    added = children.stop - 1
+    assert subtree.visit_count[added] == 0
+    expected = game.change_perspective(
+        game.step(subtree.state(0).copy(), int(subtree.action[added]), 1),
+        player=-1
+    )
+    numpy.testing.assert_array_equal(
+        game.get_encoded_state(subtree.state(added)),
+        game.get_encoded_state(expected)
+    )
+
+def test_unpruned_priors_follow_deeper_nodes():
+    game, tree, child, _ = narrowed_tree()
+    grandchild = tree.first_child[child]
+    rng = numpy.random.default_rng(1)
+    policy = game.policy(rng.dirichlet(numpy.ones(game.actions)), tree.state(grandchild))
+    tree.expand(grandchild, policy)
+    assert grandchild in tree.unpruned
+    subtree = tree.subtree(child)
+    subtree = subtree.subtree(subtree.child(0, int(tree.action[grandchild])))
+    children = subtree.children(0)
+    assert sorted(subtree.action[children.start:children.stop]) == list(numpy.flatnonzero(policy > 0))
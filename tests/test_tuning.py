@@ -0,0 +1,49 @@
+from agents.alphazero.tuning import PROFILE_PATH, apply_profile, resolve_profile
+
+PROFILE = {
+    'config': {'size': 5},
+    'best': {
+        'backend': 'onnx',
+        'inference_mode': 'script',
+        'backend_threads': 4,
+        'graph_optimization': 'all',
+        'batch_size': 64,
+    },
+}
+
+def default_args():
+    return {
+        'leaf_batch': 4,
+        'parallel_games': 1,
+        'server_max_batch': 256,
+        'backend': 'torch',
+        'inference_mode': 'script',
+        'backend_threads': 0,
+        'graph_optimization': 'all',
+    }
+
+def test_profile_fills_unset_options():
+    args = apply_profile(default_args(), PROFILE)
+    assert args['backend'] == 'onnx'
+    assert args['backend_threads'] == 4
+    assert args['parallel_games'] == 16
+    assert args['server_max_batch'] == 64
+
+def test_explicit_options_win_over_the_profile(capsys):
+    args = dict(default_args(), backend='fused', parallel_games=2)
+    args = apply_profile(args, PROFILE, explicit={'backend', 'parallel_games'})
+    assert args['backend'] == 'fused'
+    assert args['parallel_games'] == 2
+    # the others still come from the profile
+    assert args['backend_threads'] == 4
+    assert args['server_max_batch'] == 64
+    output = capsys.readouterr().out
+    assert "backend='fused'" in output
+    assert "parallel_games=2" in output
+
+def test_relative_profile_paths_fall_back_to_the_repository_root(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    assert resolve_profile("inference_profile.json") == PROFILE_PATH
+    (tmp_path / "local.json").write_text("{}")
+    assert resolve_profile("local.json") == "local.json"
+    assert resolve_profile(None) is None